@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import fileutils
+
+log = logging.getLogger("omego.aio")
+
+# Asynchronous versions of the network functions in fileutils. Requests are
+# made by the fileutils functions on a shared pool of threads so they use the
+# same keep-alive connections, SSL contexts and authentication handling as
+# synchronous calls, whilst independent requests can be issued concurrently.
+_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def _call(f, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(_executor, functools.partial(
+        f, *args, **kwargs))
+
+
+async def call(f, *args, **kwargs):
+    """
+    Call a blocking function which makes requests on the shared pool
+    """
+    return await _call(f, *args, **kwargs)
+
+
+async def open_url(url, **kwargs):
+    """
+    See fileutils.open_url
+    """
+    return await _call(fileutils.open_url, url, **kwargs)
+
+
+async def dereference_url(url):
+    """
+    See fileutils.dereference_url
+    """
+    return await _call(fileutils.dereference_url, url)
+
+
+async def read(url, cache=None, **kwargs):
+    """
+    See fileutils.read
+    """
+    return await _call(fileutils.read, url, cache=cache, **kwargs)
+
+
+async def download(url, filename=None, **kwargs):
+    """
+    See fileutils.download
+    """
+    return await _call(fileutils.download, url, filename, **kwargs)
+
+
+async def gather(coros):
+    """
+    Run coroutines concurrently and return a list of their results
+    """
+    return await asyncio.gather(*coros)
+
+
+async def first_success(coros, exceptions):
+    """
+    Run coroutines concurrently and return the result of the first one in
+    the given order that doesn't raise one of exceptions, without waiting
+    for those after it. If they all fail the last exception is raised.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        error = None
+        for task in tasks:
+            try:
+                return await task
+            except exceptions as e:
+                error = e
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Prevent warnings about unretrieved exceptions
+                task.exception()
+
+
+def run(coro):
+    """
+    Run a coroutine to completion on a new event loop and return its
+    result, this allows synchronous code to make concurrent requests
+    """
+    return asyncio.run(coro)
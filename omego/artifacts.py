@@ -12,13 +12,19 @@ import os
 import logging
 
 from html.parser import HTMLParser
+from http.client import HTTPException
 from urllib.error import (
     HTTPError,
     URLError,
 )
 import re
 
+from . import aio
 from . import fileutils
+from . import mirrors
+from .cache import ArtifactCache, MetadataCache, TreeStore
+from .progress import events
+from .scheduler import scheduler
 from yaclifw.framework import Command, Stop
 from .env import FileUtilsParser, JenkinsParser
 
@@ -68,7 +74,7 @@ class Artifacts(object):
         filename = os.path.basename(componenturl)
         unzipped = filename.replace(".zip", "")
 
-        if os.path.exists(unzipped):
+        if os.path.exists(unzipped) and not self.args.unzip_incremental:
             self.create_symlink(unzipped)
             return unzipped
 
@@ -76,12 +82,58 @@ class Artifacts(object):
         if self.args.dry_run:
             return
 
+        if self.args.checksum:
+            checksums = fileutils.parse_checksum(self.args.checksum)
+        else:
+            checksums = self.artifacts.get_checksums(componenturl)
+
+        scheduler.configure(
+            self.args.max_downloads, self.args.download_bandwidth,
+            self.args.download_slots)
+        events.configure(self.args.progress_fd)
+        stream_unzip = None
+        # Incremental, stored and selective extraction must wait for the
+        # complete zip
+        if (self.args.stream_unzip and not self.args.skipunzip and
+                not self.args.unzip_incremental and
+                not self.args.unzip_store and
+                not self.args.unzip_include and
+                not self.args.unzip_exclude):
+            stream_unzip = {'match_dir': True, 'destdir': self.args.unzipdir,
+                            'workers': self.args.unzip_workers,
+                            'manifest': True}
+
+        delta_from = self.args.delta_from
+        if delta_from and not os.path.isfile(delta_from):
+            log.warning('Not using delta download, %s not found', delta_from)
+            delta_from = None
+
         progress = 0
         if self.args.verbose:
             progress = 20
-        ptype, localpath = fileutils.get_as_local_path(
-            componenturl, self.args.overwrite, progress=progress,
-            httpuser=self.args.httpuser, httppassword=self.args.httppassword)
+        alternatives = self.artifacts.alternatives(componenturl)
+        for n, url in enumerate(alternatives):
+            try:
+                ptype, localpath = fileutils.get_as_local_path(
+                    url, self.args.overwrite, progress=progress,
+                    httpuser=self.args.httpuser,
+                    httppassword=self.args.httppassword,
+                    connections=self.args.download_connections,
+                    resume=self.args.download_resume,
+                    cachedir=self.args.cachedir,
+                    cachesize=self.args.cachesize,
+                    checksums=checksums or None, stream_unzip=stream_unzip,
+                    delta_from=delta_from,
+                    write_index=self.args.write_block_index)
+                break
+            except (URLError, IOError, fileutils.FileException) as e:
+                if n == len(alternatives) - 1:
+                    raise
+                log.warning('Download of %s failed (%s), trying %s',
+                            url, e, alternatives[n + 1])
+        if ptype == 'unzipped':
+            self.create_symlink(localpath)
+            return localpath
         if ptype != 'file':
             raise ArtifactException('Expected local file', localpath)
 
@@ -89,8 +141,26 @@ class Artifacts(object):
             if localpath.endswith('.zip'):
                 try:
                     log.info('Unzipping %s', localpath)
+                    kwargs = {}
+                    if self.args.unzip_store:
+                        kwargs['store'] = TreeStore(
+                            self.args.cachedir or 'auto',
+                            self.args.unzip_store_size)
+                        if self.args.cachedir:
+                            # Avoid hashing a zip from the download cache
+                            sha256 = ArtifactCache(
+                                self.args.cachedir).checksum(url, localpath)
+                            if sha256:
+                                kwargs['sha256'] = sha256
+                    if self.args.unzip_include:
+                        kwargs['include'] = self.args.unzip_include
+                    if self.args.unzip_exclude:
+                        kwargs['exclude'] = self.args.unzip_exclude
                     unzipped = fileutils.unzip(
-                        localpath, match_dir=True, destdir=self.args.unzipdir)
+                        localpath, match_dir=True, destdir=self.args.unzipdir,
+                        workers=self.args.unzip_workers,
+                        incremental=self.args.unzip_incremental,
+                        manifest=True, **kwargs)
                     self.create_symlink(unzipped)
                     return unzipped
                 except Exception as e:
@@ -146,8 +216,14 @@ class ArtifactsList(object):
     Partial initial matching can be used except for full filenames
     """
 
-    def __init__(self):
+    def __init__(self, cachedir=None):
+        self.metadata = None
+        if cachedir:
+            self.metadata = MetadataCache(cachedir)
         self.filenames = {}
+        # Known checksums and checksum files of artifacts, keyed by URL
+        self.checksums = {}
+        self.checksumfiles = {}
         self.namedcomponents = {}
         self.omerozips = {}
         self.zips = {}
@@ -203,6 +279,34 @@ class ArtifactsList(object):
 
         raise ArtifactException('No match for component', component)
 
+    def alternatives(self, url):
+        """
+        Return a list of URLs from which an artifact can be downloaded, in
+        order of preference
+        """
+        return [url]
+
+    def get_checksums(self, url):
+        """
+        Return the known checksums of an artifact as a dictionary
+        {algorithm: hexdigest}, fetching any checksum files concurrently
+        """
+        checksums = dict(self.checksums.get(url, {}))
+
+        async def fetch(checksumfile):
+            algorithm = checksumfile.rsplit('.', 1)[1]
+            try:
+                content = await aio.read(checksumfile, cache=self.metadata)
+                checksums[algorithm] = fileutils.parse_checksum_file(
+                    content.decode(), url.split('/')[-1])
+            except (HTTPError, URLError, fileutils.FileException) as e:
+                log.warning('Failed to read checksum %s: %s', checksumfile, e)
+
+        checksumfiles = self.checksumfiles.get(url)
+        if checksumfiles:
+            aio.run(aio.gather([fetch(f) for f in checksumfiles]))
+        return checksums
+
     def __str__(self):
         s = ''
         if self.namedcomponents:
@@ -236,7 +340,7 @@ class ArtifactsList(object):
 class JenkinsArtifacts(ArtifactsList):
 
     def __init__(self, args):
-        super(JenkinsArtifacts, self).__init__()
+        super(JenkinsArtifacts, self).__init__(args.cachedir)
 
         self.args = args
         buildurl = args.build
@@ -269,6 +373,23 @@ class JenkinsArtifacts(ArtifactsList):
         artifacturls = [
             base_url + a.find("relativePath").text for a in artifacts]
         self.find_artifacts(artifacturls)
+        self.find_fingerprints(root, artifacturls)
+
+    def find_fingerprints(self, root, artifacturls):
+        """
+        Record the MD5 checksums of artifacts if the job records fingerprints
+        """
+        fingerprints = {}
+        for fp in root.findall('./fingerprint'):
+            try:
+                fingerprints[fp.find('fileName').text] = fp.find('hash').text
+            except AttributeError:
+                pass
+        for url in artifacturls:
+            md5 = fingerprints.get(url.split('/')[-1])
+            if md5:
+                self.checksums[url] = {'md5': md5}
+                log.debug('Fingerprint %s=%s', url, md5)
 
     def _expand_ci_server(self, ci):
         """
@@ -282,34 +403,32 @@ class JenkinsArtifacts(ArtifactsList):
             'https://%s.openmicroscopy.org/' % ci,
             'https://%s' % ci,
         ]
-        for guess in guesses:
+
+        async def lookup(guess):
+            log.debug('CI server %s: trying %s', ci, guess)
             try:
-                log.debug('CI server %s: trying %s', ci, guess)
-                return fileutils.dereference_url(guess)
+                return await aio.dereference_url(guess)
             except (URLError, HTTPError) as e:
                 log.debug('CI server %s not found %s', guess, e)
-                pass
-        log.error('Failed to lookup CI server %s, tried: %s', ci, guesses)
-        raise Stop(20, 'Failed to lookup CI server %s' % ci)
+                raise
+
+        # All guesses are tried concurrently, the first to succeed wins
+        try:
+            return aio.run(aio.first_success(
+                [lookup(guess) for guess in guesses], (URLError, HTTPError)))
+        except (URLError, HTTPError):
+            log.error('Failed to lookup CI server %s, tried: %s', ci, guesses)
+            raise Stop(20, 'Failed to lookup CI server %s' % ci)
 
     def read_xml(self, buildurl):
-        url = None
         try:
-            url = fileutils.open_url(buildurl + 'api/xml',
-                                     httpuser=self.args.httpuser,
-                                     httppassword=self.args.httppassword)
-            log.debug('Fetching xml from %s code:%d', url.url, url.code)
-            if url.code != 200:
-                log.error('Failed to get CI XML from %s (code %d)',
-                          url.url, url.code)
-                raise Stop(20, 'Job lookup failed, is the job name correct?')
-            ci_xml = url.read()
+            log.debug('Fetching xml from %s', buildurl)
+            ci_xml = fileutils.read(buildurl + 'api/xml', cache=self.metadata,
+                                    httpuser=self.args.httpuser,
+                                    httppassword=self.args.httppassword)
         except HTTPError as e:
             log.error('Failed to get CI XML (%s)', e)
             raise Stop(20, 'Job lookup failed, is the job name correct?')
-        finally:
-            if url:
-                url.close()
 
         root = XML(ci_xml)
         return root
@@ -395,16 +514,25 @@ class ReleaseArtifacts(ArtifactsList):
     """
 
     def __init__(self, args):
-        super(ReleaseArtifacts, self).__init__()
+        super(ReleaseArtifacts, self).__init__(args.cachedir)
         self.args = args
 
-        if re.match(r'[0-9]+\.[0-9]+\.[0-9]+', args.branch):
-            ver = args.branch
-            dl_url = '%s/omero/%s/' % (args.downloadurl, ver)
-        elif re.match(r'[0-9]+|latest$', args.branch):
-            dl_url = self.follow_latest_redirect(args)
+        self.mirrors = mirrors.rank(
+            mirrors.parse_mirrors(args.downloadurl),
+            cachedir=args.cachedir or 'auto',
+            ttl=args.mirror_ttl)
+        for n, downloadurl in enumerate(self.mirrors):
+            try:
+                dl_icever = self.read_mirror(args, downloadurl)
+                self.downloadurl = downloadurl
+                break
+            except (Stop, IOError, HTTPException, ValueError) as e:
+                # Includes URLError and timeouts or truncated responses
+                if n == len(self.mirrors) - 1:
+                    raise
+                log.warning('Mirror %s failed (%s), trying %s',
+                            downloadurl, e, self.mirrors[n + 1])
 
-        dl_icever = self.read_downloads(dl_url + 'artifacts/')
         if not args.ice:
             ice_ver = sorted(dl_icever.keys())[-1]
         else:
@@ -420,13 +548,39 @@ class ReleaseArtifacts(ArtifactsList):
                 "No artifacts, please check the downloads page.")
         self.find_artifacts(artifacturls)
 
-    def follow_latest_redirect(self, args):
+    def read_mirror(self, args, downloadurl):
+        """
+        Find the artifacts for the requested release on a downloads server
+        """
+        if re.match(r'[0-9]+\.[0-9]+\.[0-9]+', args.branch):
+            ver = args.branch
+            dl_url = '%s/omero/%s/' % (downloadurl, ver)
+        elif re.match(r'[0-9]+|latest$', args.branch):
+            dl_url = self.follow_latest_redirect(args, downloadurl)
+
+        return self.read_downloads(
+            dl_url + 'artifacts/', self.metadata, self.checksumfiles)
+
+    def alternatives(self, url):
+        """
+        The same artifact on each mirror of the downloads server, starting
+        with the one the artifacts were listed from
+        """
+        urls = [url]
+        if url.startswith(self.downloadurl + '/'):
+            path = url[len(self.downloadurl):]
+            urls.extend(m + path for m in self.mirrors
+                        if m != self.downloadurl)
+        return urls
+
+    def follow_latest_redirect(self, args, downloadurl=None):
         ver = ''
         if args.branch != 'latest':
             ver = args.branch
 
         try:
-            latesturl = '%s/latest/omero%s' % (args.downloadurl, ver)
+            latesturl = '%s/latest/omero%s' % (
+                downloadurl or args.downloadurl, ver)
             finalurl = fileutils.dereference_url(latesturl)
             log.debug('Checked %s: %s', latesturl, finalurl)
         except HTTPError as e:
@@ -435,33 +589,35 @@ class ReleaseArtifacts(ArtifactsList):
         return finalurl
 
     @staticmethod
-    def read_downloads(dlurl):
-        url = None
+    def read_downloads(dlurl, cache=None, checksumfiles=None):
+        """
+        Find the zip artifacts on a downloads page, grouped by Ice version
+        dlurl: The URL of the downloads page
+        cache: An optional MetadataCache
+        checksumfiles: If a dictionary is given the URLs of any checksum
+          files on the page are added to it as lists keyed by the artifact
+          URL
+        """
         parser = HtmlHrefParser()
         try:
-            url = fileutils.open_url(dlurl)
-            log.debug('Fetching html from %s code:%d', url.url, url.code)
-            if url.code != 200:
-                log.error('Failed to get HTML from %s (code %d)',
-                          url.url, url.code)
-                raise Stop(
-                    20, 'Downloads page failed, is the version correct?')
-            parser.feed(url.read().decode())
+            log.debug('Fetching html from %s', dlurl)
+            parser.feed(fileutils.read(dlurl, cache=cache).decode())
         except HTTPError as e:
             log.error('Failed to get HTML from %s (%s)', dlurl, e)
             raise Stop(20, 'Downloads page failed, is the version correct?')
-        finally:
-            if url:
-                url.close()
 
         dl_icever = {}
-        for href in parser.hrefs:
+        for href in sorted(parser.hrefs):
+            if re.match(r'\w+://', href):
+                fullurl = href
+            else:
+                fullurl = dlurl + href
+            m = re.search(r'(.*\.zip)\.(md5|sha1|sha256|sha512)$', fullurl)
+            if m and checksumfiles is not None:
+                checksumfiles.setdefault(m.group(1), []).append(fullurl)
+                log.debug('Found checksum: %s', fullurl)
             try:
                 icever = re.search(r'-(ice\d+).*zip$', href).group(1)
-                if re.match(r'\w+://', href):
-                    fullurl = href
-                else:
-                    fullurl = dlurl + href
                 try:
                     dl_icever[icever].append(fullurl)
                 except KeyError:
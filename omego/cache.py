@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from builtins import object
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from .locks import FileLock
+
+log = logging.getLogger("omego.cache")
+
+
+def cache_dir(cachedir, name):
+    """
+    Return the directory of a named cache under cachedir. If cachedir is
+    'auto' the XDG base directory specification is followed
+    (~/.cache/omego/NAME)
+    """
+    if cachedir == 'auto':
+        cachedir = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache'), 'omego')
+    return os.path.join(cachedir, name)
+
+
+def _makedirs(*dirs):
+    for d in dirs:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+
+def hash_file(filename, algorithm='sha256', blocksize=1024 * 1024):
+    """
+    Return the hex digest of a file
+    """
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def url_key(url):
+    """
+    Return a filesystem safe key for a URL
+    """
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def validators_match(cached, remote):
+    """
+    Compare the HTTP validators of a cached file with those of the remote
+    file. ETags are compared if both are known, otherwise Last-Modified and
+    Content-Length must both be known and equal.
+    """
+    if not cached or not remote:
+        return False
+    if cached.get('etag') and remote.get('etag'):
+        return cached['etag'] == remote['etag']
+    for k in ('last_modified', 'length'):
+        if cached.get(k) is None or cached.get(k) != remote.get(k):
+            return False
+    return True
+
+
+def _write_json(filename, d):
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpname, 'w') as f:
+        json.dump(d, f)
+    os.replace(tmpname, filename)
+
+
+def _read_json(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log.debug('Failed to read %s: %s', filename, e)
+        return None
+
+
+class ArtifactCache(object):
+    """
+    A persistent cache of downloaded files shared between omego invocations
+
+    Files are stored once under objects/ named by their SHA-256 checksum.
+    Each URL has an entry under urls/ recording the checksum and the HTTP
+    validators of the remote file, so a cached copy can be validated with a
+    cheap HEAD request. When the cache grows beyond its quota the least
+    recently used files are evicted.
+    """
+
+    def __init__(self, cachedir, quota=None):
+        """
+        cachedir: The omego cache directory, 'auto' for the default location
+        quota: The maximum size of the cache in MiB, None for unlimited
+        """
+        self.cachedir = cache_dir(cachedir, 'artifacts')
+        self.quota = quota
+        self.objects = os.path.join(self.cachedir, 'objects')
+        self.urls = os.path.join(self.cachedir, 'urls')
+        self.tmp = os.path.join(self.cachedir, 'tmp')
+        _makedirs(self.objects, self.urls, self.tmp)
+
+    def _entryname(self, url):
+        return os.path.join(self.urls, url_key(url) + '.json')
+
+    def _objectname(self, sha256):
+        return os.path.join(self.objects, sha256)
+
+    def tmpname(self, url):
+        """
+        Return a stable path in the cache for downloading url, so that
+        incomplete downloads can be resumed
+        """
+        return os.path.join(
+            self.tmp, '%s-%s' % (url_key(url)[:16], url.split('/')[-1]))
+
+    def find_object(self, sha256):
+        """
+        Return the path of the cached file with this SHA-256 checksum if it
+        exists, otherwise None
+        """
+        obj = self._objectname(sha256.lower())
+        if not os.path.exists(obj):
+            return None
+        # Record the access for LRU eviction
+        os.utime(obj, None)
+        return obj
+
+    def find(self, url, validators):
+        """
+        Return the path of the cached copy of url if the validators of the
+        remote file match those recorded in the cache, otherwise None
+        """
+        entryname = self._entryname(url)
+        entry = _read_json(entryname)
+        if not entry:
+            return None
+        if not validators_match(entry.get('validators'), validators):
+            log.debug('Cached %s is out of date', url)
+            return None
+        if not os.path.exists(self._objectname(entry['sha256'])):
+            log.debug('Cached %s has been evicted', url)
+            os.unlink(entryname)
+            return None
+        return self.find_object(entry['sha256'])
+
+    def checksum(self, url, filename):
+        """
+        Return the SHA-256 checksum of filename if it is a link to the cached
+        copy of url, otherwise None
+        """
+        entry = _read_json(self._entryname(url))
+        if not entry:
+            return None
+        try:
+            if os.path.samefile(self._objectname(entry['sha256']), filename):
+                return entry['sha256']
+        except OSError:
+            pass
+        return None
+
+    def add(self, url, validators, filename, sha256=None):
+        """
+        Move a downloaded file into the cache
+        url, validators: The source URL and HTTP validators of the file
+        filename: The downloaded file, this is moved into the cache
+        sha256: The checksum of the file if already known
+        return: The path of the cached object
+        """
+        if not sha256:
+            sha256 = hash_file(filename)
+        obj = self._objectname(sha256)
+        if os.path.exists(obj):
+            os.unlink(filename)
+            os.utime(obj, None)
+        else:
+            # Objects may be hardlinked so prevent modification
+            os.chmod(filename, 0o444)
+            # Another process may have added the same object
+            os.replace(filename, obj)
+        _write_json(self._entryname(url), {
+            'url': url,
+            'sha256': sha256,
+            'validators': validators,
+        })
+        log.debug('Cached %s as %s', url, obj)
+        self.evict(keep=obj)
+        return obj
+
+    def materialise(self, obj, filename):
+        """
+        Create filename from a cached object, using a hardlink if possible
+        otherwise a copy
+        """
+        try:
+            os.link(obj, filename)
+            log.debug('Linked %s to %s', obj, filename)
+        except (OSError, AttributeError) as e:
+            log.debug('Failed to link %s (%s), copying', obj, e)
+            shutil.copyfile(obj, filename)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used objects until the cache is within
+        its quota
+        keep: Never remove this object
+        """
+        if self.quota is None:
+            return
+        objects = []
+        for f in os.listdir(self.objects):
+            path = os.path.join(self.objects, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Evicted by another process
+                continue
+            objects.append((st.st_mtime, st.st_size, path))
+        total = sum(o[1] for o in objects)
+        limit = self.quota * 1024 * 1024
+        for mtime, size, path in sorted(objects):
+            if total <= limit:
+                break
+            if path == keep:
+                continue
+            log.info('Evicting %s from cache', path)
+            try:
+                os.unlink(path)
+            except OSError as e:
+                log.debug('Failed to evict %s: %s', path, e)
+                continue
+            total -= size
+
+
+class MetadataCache(object):
+    """
+    A persistent cache of small HTTP resources such as CI job descriptions
+    and download pages. The body of each response is stored with its ETag
+    and Last-Modified headers so that later requests can be conditional.
+    """
+
+    def __init__(self, cachedir):
+        """
+        cachedir: The omego cache directory, 'auto' for the default location
+        """
+        self.cachedir = cache_dir(cachedir, 'metadata')
+        _makedirs(self.cachedir)
+
+    def _basename(self, url):
+        return os.path.join(self.cachedir, url_key(url))
+
+    def conditional_headers(self, url):
+        """
+        Return the request headers for a conditional request, empty if the
+        URL is not cached
+        """
+        entry = _read_json(self._basename(url) + '.json')
+        headers = {}
+        if entry and os.path.exists(self._basename(url) + '.body'):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get(self, url):
+        """
+        Return the cached body of url
+        """
+        with open(self._basename(url) + '.body', 'rb') as f:
+            return f.read()
+
+    def put(self, url, headers, body):
+        """
+        Store a response body if it has a validator
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            log.debug('Not caching %s: no validator', url)
+            return
+        basename = self._basename(url)
+        tmpname = '%s.%d.tmp' % (basename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            f.write(body)
+        os.replace(tmpname, basename + '.body')
+        _write_json(basename + '.json', {
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+        })
+
+
+class MirrorCache(object):
+    """
+    A persistent cache of the ranking of a set of mirrors, so they don't
+    have to be probed on every run
+    """
+
+    def __init__(self, cachedir):
+        """
+        cachedir: The omego cache directory, 'auto' for the default location
+        """
+        self.cachedir = cache_dir(cachedir, 'mirrors')
+        _makedirs(self.cachedir)
+
+    def _filename(self, mirrors):
+        return os.path.join(self.cachedir, url_key(
+            '\n'.join(sorted(mirrors))) + '.json')
+
+    def get(self, mirrors, ttl):
+        """
+        Return the cached ranking of mirrors as a list of probe results if
+        it is less than ttl seconds old, otherwise None
+        """
+        entry = _read_json(self._filename(mirrors))
+        if not entry or time.time() - entry.get('time', 0) > ttl:
+            return None
+        return entry['ranking']
+
+    def put(self, mirrors, ranking):
+        _write_json(self._filename(mirrors), {
+            'time': time.time(),
+            'ranking': ranking,
+        })
+
+
+def remove_tree(path):
+    """
+    Remove a directory tree, including any read-only directories
+    """
+    def onerror(func, p, exc_info):
+        # Extracted trees may contain read-only directories
+        os.chmod(os.path.dirname(p), 0o700)
+        func(p)
+    shutil.rmtree(path, onerror=onerror)
+
+
+class TreeStore(object):
+    """
+    A persistent store of extracted archives shared between omego
+    invocations. Each archive is extracted once into a directory named by
+    its SHA-256 checksum, installations are cloned from this tree. The size
+    of each tree is recorded alongside it, when the store grows beyond its
+    quota the least recently used trees are evicted.
+    """
+
+    def __init__(self, cachedir, quota=None):
+        """
+        cachedir: The omego cache directory, 'auto' for the default location
+        quota: The maximum size of the store in MiB, None for unlimited
+        """
+        self.cachedir = cache_dir(cachedir, 'trees')
+        self.quota = quota
+        self.tmp = os.path.join(self.cachedir, 'tmp')
+        _makedirs(self.cachedir, self.tmp)
+
+    def _treename(self, sha256):
+        return os.path.join(self.cachedir, sha256.lower())
+
+    @contextmanager
+    def checkout(self, sha256, extract):
+        """
+        Return a context manager for the stored tree of an archive, creating
+        it if necessary. Only one process extracts an archive, others wait
+        for it to finish. The tree is locked so it can't be evicted until the
+        context exits.
+        sha256: The checksum of the archive
+        extract: A function extract(dirname) which extracts the archive into
+          the new directory dirname
+        return: The directory containing the extracted archive
+        """
+        tree = self._treename(sha256)
+        with FileLock(tree + '.lock'):
+            if os.path.isdir(tree):
+                # Record the access for LRU eviction
+                os.utime(tree, None)
+            else:
+                tmpdir = tempfile.mkdtemp(dir=self.tmp)
+                try:
+                    extract(tmpdir)
+                    _write_json(tree + '.json', {'size': _tree_size(tmpdir)})
+                    os.rename(tmpdir, tree)
+                except BaseException:
+                    remove_tree(tmpdir)
+                    raise
+                log.debug('Stored extracted tree %s', tree)
+                self.evict(keep=tree)
+            yield tree
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used trees until the store is within its
+        quota. Trees which are in use are skipped.
+        keep: Never remove this tree
+        """
+        if self.quota is None:
+            return
+        trees = []
+        for f in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, f)
+            if f == 'tmp' or not os.path.isdir(path):
+                continue
+            entry = _read_json(path + '.json')
+            size = entry['size'] if entry else _tree_size(path)
+            trees.append((os.stat(path).st_mtime, size, path))
+        total = sum(t[1] for t in trees)
+        limit = self.quota * 1024 * 1024
+        for mtime, size, path in sorted(trees):
+            if total <= limit:
+                break
+            if path == keep:
+                continue
+            lock = FileLock(path + '.lock')
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                log.info('Evicting %s from store', path)
+                # Move the tree out of the store first so a partially
+                # removed tree is never used
+                tmpdir = tempfile.mkdtemp(dir=self.tmp)
+                os.rename(path, os.path.join(tmpdir, 'tree'))
+                if os.path.exists(path + '.json'):
+                    os.unlink(path + '.json')
+                remove_tree(tmpdir)
+            finally:
+                lock.release()
+            total -= size
+
+
+def _tree_size(path):
+    """
+    Return the total size of the files in a directory tree
+    """
+    size = 0
+    for root, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            size += os.lstat(os.path.join(root, f)).st_size
+    return size
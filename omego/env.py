@@ -68,6 +68,22 @@ class EnvDefault(argparse.Action):
                             default=default, **kwargs)
 
 
+def compression_level(value):
+    """
+    argparse type for a compression level, the range allowed by the archive
+    format is checked once all arguments are known
+    """
+    try:
+        level = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid compression level: %r' % value)
+    if not 0 <= level <= 22:
+        raise argparse.ArgumentTypeError(
+            'compression level must be 0-22: %d' % level)
+    return level
+
+
 class DbParser(argparse.ArgumentParser):
 
     def __init__(self, parser):
@@ -128,8 +144,14 @@ class JenkinsParser(argparse.ArgumentParser):
             "https://downloads.openmicroscopy.org",
             help="Base URL of the downloads server. Since 0.6.0, the OMERO"
             " artifacts are expected to be found under "
-            " DOWNLOADURL/omero/<version>/artifacts. Default: "
+            " DOWNLOADURL/omero/<version>/artifacts. A comma separated list "
+            "of mirrors may be given, the fastest is used and the others are "
+            "tried if it fails. Default: "
             "http://downloads.openmicroscopy.org")
+        group.add_argument(
+            "--mirror-ttl", type=int, default=3600,
+            help="Cache the ranking of downloads server mirrors for this many "
+            "seconds, 0 to probe the mirrors every time (default 3600)")
 
         Add(group, "ice",
             "", help="Ice version, default is the latest (release only)")
@@ -156,6 +178,35 @@ class FileUtilsParser(argparse.ArgumentParser):
             help="Unzip archives into this directory")
         group.add_argument("--skipunzip", action="store_true",
                            help="Don't unzip archives")
+        group.add_argument("--stream-unzip", action="store_true",
+                           help="Unzip archives whilst they are downloaded")
+        group.add_argument(
+            "--unzip-workers", type=int, default=1,
+            help="Extract files from archives on this many parallel threads "
+            "(default 1)")
+        group.add_argument(
+            "--unzip-incremental", action="store_true",
+            help="If an archive has already been unzipped only extract files "
+            "which are missing or have changed, and remove extra files")
+        group.add_argument(
+            "--unzip-store", action="store_true",
+            help="Extract each archive once into a store in the cache "
+            "directory (the default location if --cachedir isn't set), and "
+            "clone it using reflinks where the filesystem supports them, "
+            "otherwise by copying")
+        group.add_argument(
+            "--unzip-store-size", type=int, default=4096,
+            help="Maximum size of the unzip store in MiB, the least recently "
+            "used archives are removed (default 4096)")
+        group.add_argument(
+            "--unzip-include", action="append", metavar="PATTERN",
+            help="Only extract files whose path in the archive matches this "
+            "glob pattern, may be repeated")
+        group.add_argument(
+            "--unzip-exclude", action="append", metavar="PATTERN",
+            help="Don't extract files whose path in the archive matches this "
+            "glob pattern, e.g. 'OMERO.server-*/share/docs/*', may be "
+            "repeated")
         # Choices from fileutils.get_as_local_path
         Add(group, "overwrite", "keep",
             choices=["error", "backup", "keep"],
@@ -165,6 +216,56 @@ class FileUtilsParser(argparse.ArgumentParser):
             help="Username for HTTP authentication")
         Add(group, "httppassword", None,
             help="Password for HTTP authentication")
+        group.add_argument(
+            "--download-connections", type=int, default=1,
+            help="Download byte ranges of a file over this many parallel "
+            "connections if the server supports it (default 1)")
+        group.add_argument(
+            "--download-resume", action="store_true",
+            help="Keep incomplete downloads and resume them next time")
+        group.add_argument(
+            "--delta-from",
+            help="A local copy of an earlier version of the file being "
+            "downloaded. If the server publishes a block index only the "
+            "changed blocks are downloaded. When upgrading use 'auto' for the "
+            "zip of the current server (see --keep-old-zip)")
+        group.add_argument(
+            "--write-block-index", action="store_true",
+            help="Write a block index next to downloaded files, so that a "
+            "mirror of the files can be used for delta downloads")
+        group.add_argument(
+            "--max-downloads", type=int, default=None,
+            help="Maximum number of concurrent downloads by all omego "
+            "processes sharing --download-slots, 0 for unlimited. Server "
+            "zips are started before other downloads "
+            "(default $OMEGO_MAX_DOWNLOADS or unlimited)")
+        group.add_argument(
+            "--download-bandwidth", type=int, default=None,
+            help="Maximum download bandwidth of this omego process in KiB/s, "
+            "0 for unlimited. This limit is not shared with other "
+            "processes (default $OMEGO_DOWNLOAD_BANDWIDTH or unlimited)")
+        group.add_argument(
+            "--download-slots", default=None,
+            help="Directory used to share --max-downloads between omego "
+            "processes. Use a directory on a shared filesystem to limit "
+            "downloads by several hosts, otherwise the limit applies to each "
+            "host separately (default $OMEGO_DOWNLOAD_SLOTS or "
+            "~/.cache/omego/slots)")
+        group.add_argument(
+            "--progress-fd", type=int, default=None,
+            help="Write progress events for downloads, extraction and "
+            "archiving as JSON lines to this file descriptor "
+            "(default $OMEGO_PROGRESS_FD)")
+        Add(group, "cachedir", "",
+            help="Cache downloads and server metadata in this directory, "
+            "reusing them while the remote files are unchanged. "
+            "Use 'auto' for ~/.cache/omego")
+        Add(group, "cachesize", 4096, type=int,
+            help="Maximum size of the download cache in MiB (default 4096)")
+        Add(group, "checksum", None,
+            help="Expected checksum of the downloaded file as "
+            "ALGORITHM:HEXDIGEST, e.g. sha256:0123... By default checksums "
+            "published by the CI or downloads server are verified")
 
     def __getattr__(self, key):
         return getattr(self.parser, key)
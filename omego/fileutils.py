@@ -6,22 +6,72 @@ from __future__ import print_function
 from future import standard_library
 from past.builtins import basestring
 from builtins import object
-from past.utils import old_div
+from collections import deque
 from datetime import datetime
+import errno
+import fnmatch
+import hashlib
+import json
+import lzma
 import os
 import logging
+import queue
 import re
-import ssl
+import shutil
+import struct
+import tarfile
 import urllib.request
 import urllib.error
 import urllib.parse
 import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from yaclifw.framework import Stop
 
+from .cache import ArtifactCache, hash_file, remove_tree
+from .locks import FileLock
+from .scheduler import default_priority, scheduler
+from .progress import Progress
+from .httppool import (
+    KeepAliveHTTPHandler,
+    KeepAliveHTTPSHandler,
+    ssl_context,
+)
+
 standard_library.install_aliases()  # noqa
 log = logging.getLogger("omego.fileutils")
 
+# Block indices for delta downloads are published next to the file
+BLOCK_INDEX_SUFFIX = '.blockindex'
+
+# The manifest of an unzipped tree is written next to it
+EXTRACT_MANIFEST_SUFFIX = '.manifest.json'
+
+# Content encodings which can be decompressed
+ACCEPT_ENCODING = 'gzip, deflate'
+if brotli:
+    ACCEPT_ENCODING += ', br'
+
+# Downloads of these resources ask for compressed content, other files such
+# as zips are already compressed
+COMPRESSIBLE = re.compile(
+    r'(/|\.(html?|xml|sql|txt|json|csv|log|ini|cfg|md|rst))$', re.I)
+
 
 class FileException(Exception):
 
@@ -34,51 +84,37 @@ class FileException(Exception):
             super(FileException, self).__str__(), self.path)
 
 
-class ProgressBar(object):
-    def __init__(self, ndots, total):
-        self.ndots = ndots
-        self.total = total
-        self.n = 0
-        self.marker = '*'
-        self.pad = True
-
-    def update(self, current):
-        nextn = int(old_div(current * self.ndots, self.total))
-        if nextn > self.n:
-            self.n = nextn
-            p = ''
-            if self.pad:
-                p = ' ' * (self.ndots - self.n) * len(self.marker)
-            print('%s%s (%d/%d bytes)' % (
-                self.marker * self.n, p, current, self.total))
-
-
-def open_url(url, httpuser=None, httppassword=None, method=None):
+def open_url(url, httpuser=None, httppassword=None, method=None,
+             headers=None, timeout=None):
     """
-    Open a URL using an opener that will simulate a browser user-agent
+    Open a URL using an opener that will simulate a browser user-agent.
+    HTTP connections are kept alive and reused by later calls.
     url: The URL
     httpuser, httppassword: HTTP authentication credentials (either both or
       neither must be provided)
     method: The HTTP method
+    headers: A dictionary of additional request headers
+    timeout: The timeout in seconds for blocking operations, default is the
+      global socket timeout
 
     Caller is reponsible for calling close() on the returned object
     """
     if os.getenv('OMEGO_SSL_NO_VERIFY') == '1':
-        # This needs to come first to override the default HTTPS handler
         log.debug('OMEGO_SSL_NO_VERIFY=1')
         try:
-            sslctx = ssl.create_default_context()
+            ssl_context(verify=False)
         except Exception as e:
             log.error('Failed to create Default SSL context: %s' % e)
             raise Stop(
                 'Failed to create Default SSL context, OMEGO_SSL_NO_VERIFY '
                 'is not supported on older versions of Python')
-        sslctx.check_hostname = False
-        sslctx.verify_mode = ssl.CERT_NONE
-        opener = urllib.request.build_opener(
-            urllib.request.HTTPSHandler(context=sslctx))
+        httpshandler = KeepAliveHTTPSHandler(verify=False)
     else:
-        opener = urllib.request.build_opener()
+        httpshandler = KeepAliveHTTPSHandler()
+    # Connections are shared between openers, but authentication handlers
+    # are per-call
+    opener = urllib.request.build_opener(
+        KeepAliveHTTPHandler(), httpshandler)
 
     if 'USER_AGENT' in os.environ:
         opener.addheaders = [('User-agent', os.environ.get('USER_AGENT'))]
@@ -95,10 +131,12 @@ def open_url(url, httpuser=None, httppassword=None, method=None):
             'httpuser and httppassword must be used together', url)
 
     # Override method http://stackoverflow.com/a/4421485
-    req = urllib.request.Request(url)
+    req = urllib.request.Request(url, headers=headers or {})
     if method:
         req.get_method = lambda: method
 
+    if timeout:
+        return opener.open(req, timeout=timeout)
     return opener.open(req)
 
 
@@ -112,19 +150,261 @@ def dereference_url(url):
     return res.url
 
 
-def read(url, **kwargs):
+def read(url, cache=None, **kwargs):
     """
     Read the contents of a URL into memory, return
+    cache: A MetadataCache, if given a conditional request is made and the
+      cached contents are returned if the resource has not been modified
     """
-    response = open_url(url, **kwargs)
+    headers = {'Accept-Encoding': ACCEPT_ENCODING}
+    if cache:
+        headers.update(cache.conditional_headers(url))
+    headers.update(kwargs.pop('headers', None) or {})
     try:
-        return response.read()
+        response = open_url(url, headers=headers, **kwargs)
+    except urllib.error.HTTPError as e:
+        if cache and e.code == 304:
+            log.debug('Not modified, using cached %s', url)
+            e.close()
+            return cache.get(url)
+        raise
+    try:
+        log.debug('Fetched %s code:%d', response.url, response.code)
+        body = response.read()
+        decoder = content_decoder(response)
+        if decoder:
+            body = decoder.decompress(body) + decoder.flush()
+            if not decoder.eof:
+                raise FileException('Incomplete compressed response', url)
+        if cache:
+            cache.put(url, response.headers, body)
+        return body
     finally:
         response.close()
 
 
+class _BrotliDecoder(object):
+    """
+    A brotli decompressor with the same interface as zlib
+    """
+
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    def decompress(self, data):
+        return self.decompressor.process(data)
+
+    def flush(self):
+        return b''
+
+    @property
+    def eof(self):
+        return self.decompressor.is_finished()
+
+
+def content_decoder(response):
+    """
+    Return a decompressor for the Content-Encoding of a response, with
+    zlib's decompress() and flush() methods and eof attribute, or None if
+    the response isn't compressed
+    """
+    encoding = response.headers.get('Content-Encoding', '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.decompressobj()
+    if encoding == 'br' and brotli:
+        return _BrotliDecoder()
+    raise FileException('Unsupported Content-Encoding: %s' % encoding,
+                        response.url)
+
+
+class Checksum(object):
+    """
+    Compute the digests of a file incrementally and compare them with
+    expected values
+    """
+
+    def __init__(self, expected=None, algorithms=()):
+        """
+        expected: A dictionary of {algorithm: hexdigest} to verify
+        algorithms: Additional digests to compute
+        """
+        self.expected = dict(
+            (a, d.lower()) for (a, d) in (expected or {}).items())
+        self.hashes = dict((a, hashlib.new(a)) for a in set(
+            algorithms).union(self.expected))
+
+    def update(self, data):
+        for h in self.hashes.values():
+            h.update(data)
+
+    def update_file(self, filename, length=None):
+        """
+        Add the contents of a file, optionally only the first length bytes
+        """
+        _feed_file(filename, [self], length)
+
+    def hexdigest(self, algorithm):
+        return self.hashes[algorithm].hexdigest()
+
+    def mismatches(self):
+        """
+        Return a list of descriptions of digests that don't match
+        """
+        return ['%s: expected %s got %s' % (a, d, self.hexdigest(a))
+                for (a, d) in sorted(self.expected.items())
+                if self.hexdigest(a) != d]
+
+
+def _feed_file(filename, sinks, length=None, blocksize=1024 * 1024):
+    """
+    Pass the contents of a file, optionally only the first length bytes, to
+    the update() method of each sink
+    """
+    with open(filename, 'rb') as f:
+        while length is None or length > 0:
+            n = blocksize if length is None else min(blocksize, length)
+            block = f.read(n)
+            if not block:
+                break
+            for sink in sinks:
+                sink.update(block)
+            if length is not None:
+                length -= len(block)
+
+
+def parse_checksum(s):
+    """
+    Parse a checksum of the form ALGORITHM:HEXDIGEST
+    return: A dictionary {algorithm: hexdigest}
+    """
+    m = re.match(r'(\w+):([0-9A-Fa-f]+)$', s)
+    if not m or m.group(1).lower() not in hashlib.algorithms_available:
+        raise FileException(
+            'Invalid checksum, expected ALGORITHM:HEXDIGEST', s)
+    return {m.group(1).lower(): m.group(2).lower()}
+
+
+def parse_checksum_file(content, filename=None):
+    """
+    Extract a digest from a checksum file, either in the format written by
+    sha256sum and similar tools (HEXDIGEST FILENAME on each line) or
+    containing only the digest
+    filename: The file to look for if there are multiple entries
+    """
+    lines = [line.split() for line in content.splitlines() if line.strip()]
+    for fields in lines:
+        if len(lines) == 1 or (
+                filename and fields[-1].lstrip('*') == filename):
+            if re.match('[0-9A-Fa-f]+$', fields[0]):
+                return fields[0].lower()
+    raise FileException('Checksum not found', filename)
+
+
+class DownloadState(object):
+    """
+    Records the byte ranges of a download and the validators of the remote
+    file so that an incomplete download can be resumed
+    """
+
+    def __init__(self, url, total, etag=None, last_modified=None,
+                 ranges=None):
+        self.url = url
+        self.total = total
+        self.etag = etag
+        self.last_modified = last_modified
+        # Each range is [start, end, position], end is exclusive
+        if ranges is None:
+            ranges = [[0, total, 0]]
+        self.ranges = ranges
+
+    @classmethod
+    def from_response(cls, url, response):
+        headers = response.headers
+        return cls(url, int(headers['Content-Length']),
+                   etag=headers.get('ETag'),
+                   last_modified=headers.get('Last-Modified'))
+
+    @classmethod
+    def load(cls, filename, url):
+        """
+        Load the state from a sidecar file, returns None if the file is
+        missing, unreadable or refers to a different URL
+        """
+        try:
+            with open(filename) as f:
+                d = json.load(f)
+            state = cls(d['url'], d['total'], d['etag'], d['last_modified'],
+                        d['ranges'])
+        except (IOError, OSError, ValueError, KeyError) as e:
+            log.debug('Ignoring download state %s: %s', filename, e)
+            return None
+        if state.url != url:
+            log.debug('Ignoring download state %s for %s', filename,
+                      state.url)
+            return None
+        return state
+
+    def save(self, filename):
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump({
+                'url': self.url,
+                'total': self.total,
+                'etag': self.etag,
+                'last_modified': self.last_modified,
+                'ranges': self.ranges,
+            }, f)
+        os.replace(tmpname, filename)
+
+    def split(self, n, minsize=1):
+        self.ranges = [[start, end, start] for (start, end) in split_ranges(
+            self.total, n, minsize)]
+
+    def downloaded(self):
+        return sum(pos - start for (start, end, pos) in self.ranges)
+
+    def remaining(self):
+        return [r for r in self.ranges if r[2] < r[1]]
+
+    def validator(self):
+        """
+        The value for an If-Range header. This requires a strong ETag,
+        otherwise Last-Modified is used.
+        """
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+    def range_headers(self, start, end):
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        validator = self.validator()
+        if validator:
+            headers['If-Range'] = validator
+        return headers
+
+    def matches(self, response, start):
+        """
+        Check whether a response to a range request starting at start is
+        partial content of the same remote file
+        """
+        if response.code != 206:
+            return False
+        m = re.match(r'bytes (\d+)-\d+/(\d+)',
+                     response.headers.get('Content-Range', ''))
+        if not m or int(m.group(1)) != start or int(
+                m.group(2)) != self.total:
+            return False
+        etag = response.headers.get('ETag')
+        return not (etag and self.etag and etag != self.etag)
+
+
 def download(url, filename=None, print_progress=0, delete_fail=True,
-             **kwargs):
+             connections=1, resume=False, checksum=None, pipe=None,
+             priority=None, delta_from=None, **kwargs):
     """
     Download a file, optionally printing a simple progress bar
     url: The URL to download
@@ -132,40 +412,608 @@ def download(url, filename=None, print_progress=0, delete_fail=True,
     print_progress: The length of the progress bar, use 0 to disable
     delete_fail: If True delete the file if the download was not successful,
       default is to keep the temporary file
+    connections: The maximum number of connections used to fetch byte ranges
+      of the file in parallel. If the server does not support range requests
+      a single connection is used.
+    resume: If True an incomplete download is kept as filename.part with
+      its state in filename.part.json (delete_fail is ignored), and the next
+      call continues where it stopped. The partial file is discarded if the
+      remote file has changed.
+    checksum: A Checksum which is updated with the downloaded data. If it
+      has expected digests these are verified before the file is renamed,
+      on a mismatch the download is discarded and an exception raised.
+      Digests are computed as the data is received unless the file is
+      fetched in multiple ranges, in which case it is read back once
+      complete.
+    pipe: An object whose update() method is passed the data in order as it
+      arrives, such as a ZipStreamExtractor. This disables parallel
+      connections.
+    priority: The priority class used by the download scheduler, default is
+      based on the filename
+    delta_from: A local file containing an earlier version of the remote
+      file. If a block index is published as url + BLOCK_INDEX_SUFFIX only
+      the blocks which aren't in this file are fetched, otherwise the whole
+      file is downloaded.
+    Text resources matching COMPRESSIBLE are requested with gzip or deflate
+    (or brotli if installed) content encoding and decompressed as they are
+    received. Compressed responses and those without a Content-Length are
+    read in a single stream and can't be resumed.
     return: The downloaded filename
     """
+    if not filename:
+        filename = os.path.basename(url)
+    if priority is None:
+        priority = default_priority(filename)
+    with scheduler.transfer(url, priority) as transfer:
+        if delta_from:
+            try:
+                tmpname = _download_delta(url, filename, delta_from,
+                                          print_progress, transfer, **kwargs)
+            except (FileException, IOError, OSError) as e:
+                log.warning('Delta download of %s failed, downloading the '
+                            'whole file: %s', url, e)
+            else:
+                sinks = [s for s in (checksum, pipe) if s]
+                if sinks:
+                    _feed_file(tmpname, sinks)
+                if checksum and checksum.mismatches():
+                    os.unlink(tmpname)
+                    log.error('Checksum mismatch: %s', checksum.mismatches())
+                    raise FileException('Checksum mismatch', url)
+                os.rename(tmpname, filename)
+                return filename
+        return _download(url, filename, print_progress, delete_fail,
+                         connections, resume, checksum, pipe, transfer,
+                         **kwargs)
+
+
+def _download(url, filename, print_progress, delete_fail, connections,
+              resume, checksum, pipe, transfer, **kwargs):
     blocksize = 1024 * 1024
-    downloaded = 0
-    progress = None
 
-    log.info('Downloading %s', url)
-    response = open_url(url, **kwargs)
+    partname = filename + '.part'
+    statename = partname + '.json'
 
-    if not filename:
-        filename = os.path.basename(url)
+    state = None
+    if resume and os.path.exists(partname):
+        state = DownloadState.load(statename, url)
+
+    log.info('Downloading %s', url)
+    if state and state.remaining():
+        start, end, pos = state.remaining()[0]
+        try:
+            response = open_url(url, headers=state.range_headers(pos, end),
+                                **kwargs)
+        except urllib.error.HTTPError as e:
+            # Range Not Satisfiable: the remote file is now shorter than the
+            # partial download
+            if e.code != 416:
+                raise
+            e.close()
+            log.info('Remote file has changed, restarting download')
+            for f in (partname, statename):
+                if os.path.exists(f):
+                    os.unlink(f)
+            state = None
+            response = open_url(url, **kwargs)
+        else:
+            if state.matches(response, pos):
+                log.info('Resuming download at %d/%d bytes',
+                         state.downloaded(), state.total)
+            else:
+                log.info('Remote file has changed, restarting download')
+                if response.code == 206:
+                    response.close()
+                    response = open_url(url, **kwargs)
+                state = None
+    else:
+        state = None
+        if COMPRESSIBLE.search(urllib.parse.urlparse(url).path):
+            response = open_url(url, headers={
+                'Accept-Encoding': ACCEPT_ENCODING}, **kwargs)
+        else:
+            response = open_url(url, **kwargs)
 
     output = None
+    discard = False
+    decoder = None
+    stream = False
     try:
-        total = int(response.headers['Content-Length'])
-
-        if print_progress:
-            progress = ProgressBar(print_progress, total)
-
-        with tempfile.NamedTemporaryFile(
-                prefix=filename + '.', dir='.', delete=False) as output:
-            while downloaded < total:
-                block = response.read(blocksize)
-                output.write(block)
-                downloaded += len(block)
-                if progress:
-                    progress.update(downloaded)
+        if state:
+            output = open(partname, 'r+b')
+        else:
+            decoder = content_decoder(response)
+            length = response.headers.get('Content-Length')
+            if decoder or length is None:
+                # The length of the file isn't known so it can't be fetched
+                # in ranges or resumed
+                stream = True
+                resume = False
+            else:
+                state = DownloadState.from_response(url, response)
+            if (state and connections > 1 and not pipe and
+                    state.total > blocksize and accepts_ranges(response)):
+                state.split(connections, blocksize)
+            if resume:
+                output = open(partname, 'w+b')
+            else:
+                output = tempfile.NamedTemporaryFile(
+                    prefix=os.path.basename(filename) + '.',
+                    dir=os.path.dirname(filename) or '.', delete=False)
+
+        if stream:
+            # Progress is measured in compressed bytes
+            progress = Progress('download', url, length and int(length),
+                                print_progress)
+        else:
+            progress = Progress('download', url, state.total, print_progress,
+                                state.downloaded())
+        with progress, output:
+            if stream:
+                _download_stream(url, response, output, decoder, progress,
+                                 checksum, pipe, transfer)
+            else:
+                _download_ranges(url, response, output, state, blocksize,
+                                 progress, resume and statename, checksum,
+                                 pipe, transfer, **kwargs)
+        if checksum and checksum.mismatches():
+            discard = True
+            log.error('Checksum mismatch: %s', checksum.mismatches())
+            raise FileException('Checksum mismatch', url)
         os.rename(output.name, filename)
         output = None
+        if resume and os.path.exists(statename):
+            os.unlink(statename)
         return filename
     finally:
         response.close()
-        if delete_fail and output:
-            os.unlink(output.name)
+        if output:
+            if resume and not discard:
+                state.save(statename)
+                log.info('Incomplete download kept in %s', output.name)
+            elif delete_fail or discard:
+                os.unlink(output.name)
+        if discard and os.path.exists(statename):
+            os.unlink(statename)
+
+
+def http_validators(response):
+    """
+    Return the HTTP validators of a response as a dictionary
+    """
+    length = response.headers.get('Content-Length')
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'length': int(length) if length is not None else None,
+    }
+
+
+def cached_download(url, filename, cache, print_progress=0, httpuser=None,
+                    httppassword=None, checksums=None, **kwargs):
+    """
+    Download a file through an ArtifactCache. If the expected SHA-256
+    checksum is given and the file is in the cache it is used directly,
+    otherwise a HEAD request is used to check whether the cached copy is
+    current. Cached files are linked or copied to filename.
+    url: The URL to download
+    filename: The filename to save to
+    cache: An ArtifactCache
+    print_progress: The length of the progress bar, use 0 to disable
+    httpuser, httppassword: HTTP authentication credentials
+    checksums: A dictionary of expected {algorithm: hexdigest}
+    kwargs: Additional arguments passed to download
+    return: The downloaded filename
+    """
+    obj = None
+    if checksums and 'sha256' in checksums:
+        obj = cache.find_object(checksums['sha256'])
+
+    if not obj:
+        response = open_url(url, httpuser=httpuser,
+                            httppassword=httppassword, method='HEAD')
+        try:
+            validators = http_validators(response)
+        finally:
+            response.close()
+        obj = cache.find(url, validators)
+
+    if obj:
+        log.info('Using cached copy of %s', url)
+    else:
+        # Only one process downloads a URL into the cache, the others wait
+        # for it and use the cached copy
+        with FileLock(cache.tmpname(url) + '.lock') as lock:
+            if lock.waited:
+                obj = cache.find(url, validators)
+            if obj:
+                log.info('Using copy of %s cached by another process', url)
+            else:
+                checksum = Checksum(checksums, ['sha256'])
+                tmpname = download(
+                    url, cache.tmpname(url), print_progress,
+                    httpuser=httpuser, httppassword=httppassword,
+                    checksum=checksum, **kwargs)
+                obj = cache.add(
+                    url, validators, tmpname, checksum.hexdigest('sha256'))
+    cache.materialise(obj, filename)
+    return filename
+
+
+def accepts_ranges(response):
+    """
+    Returns True if the server advertised support for byte range requests
+    """
+    return response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+
+def split_ranges(total, n, minsize=1):
+    """
+    Split a file of length total into at most n contiguous byte ranges
+    return: A list of (start, end) tuples, end is exclusive
+    """
+    size = max(-(-total // n), minsize)
+    return [(start, min(start + size, total))
+            for start in range(0, total, size)]
+
+
+def _download_ranges(url, response, output, state, blocksize, progress,
+                     statename=None, checksum=None, pipe=None, transfer=None,
+                     **kwargs):
+    """
+    Fetch the remaining byte ranges of a download and write them into the
+    output file. The first remaining range is read from the already open
+    response, the others are fetched in parallel on separate connections.
+    If statename is given the download state is periodically saved.
+    If checksum is given it is updated with the contents of the file.
+    If pipe is given the file must be a single range, pipe.update() is
+    called with the contents of the file.
+    If transfer is given its update() method is called with the number of
+    bytes received, this may block to limit the bandwidth.
+    """
+    ranges = state.remaining()
+    # Data can only be processed as it arrives if the file is fetched in order
+    sinks = []
+    if len(state.ranges) == 1:
+        sinks = [s for s in (checksum, pipe) if s]
+        if sinks and ranges[0][2] > 0:
+            _feed_file(output.name, sinks, ranges[0][2])
+    if len(ranges) > 1:
+        log.debug('Downloading %s in %d ranges', url, len(ranges))
+    _preallocate(output, state.total)
+
+    lock = threading.Lock()
+    failed = threading.Event()
+    done = [state.downloaded()]
+    saved = [time.time()]
+
+    def fetch(rng, r, sinks=()):
+        start, end, pos = rng
+        # HTTP responses support readinto, but other file-like responses
+        # such as those from custom handlers may only provide read
+        readinto = getattr(r, 'readinto', None)
+        size = blocksize
+        buf = memoryview(bytearray(size))
+        with open(output.name, 'r+b') as f:
+            f.seek(pos)
+            while pos < end and not failed.is_set():
+                n = min(size, end - pos)
+                t = time.time()
+                if readinto:
+                    nread = readinto(buf[:n])
+                else:
+                    data = r.read(n)
+                    nread = len(data)
+                    buf[:nread] = data
+                if not nread:
+                    raise FileException(
+                        'Incomplete range %d-%d' % (start, end - 1), url)
+                if nread == size:
+                    size = _adapt_blocksize(size, time.time() - t)
+                block = buf[:nread]
+                f.write(block)
+                for sink in sinks:
+                    sink.update(block)
+                if size > len(buf):
+                    buf = memoryview(bytearray(size))
+                pos += nread
+                if transfer:
+                    transfer.update(nread)
+                with lock:
+                    rng[2] = pos
+                    done[0] += nread
+                    progress.update(done[0])
+                    if statename and time.time() - saved[0] > 1:
+                        state.save(statename)
+                        saved[0] = time.time()
+
+    def fetch_range(rng):
+        """
+        return: False if the server ignored the range request and returned
+          the whole file
+        """
+        r = open_url(url, headers=state.range_headers(rng[2], rng[1]),
+                     **kwargs)
+        try:
+            if r.code == 200:
+                return False
+            if not state.matches(r, rng[2]):
+                raise FileException(
+                    'Range request failed (code %d)' % r.code, url)
+            fetch(rng, r)
+            return True
+        finally:
+            r.close()
+
+    def skip(r, n):
+        while n > 0:
+            nread = len(r.read(min(n, blocksize)))
+            if not nread:
+                raise FileException('Incomplete download', url)
+            if transfer:
+                transfer.update(nread)
+            n -= nread
+
+    if len(ranges) == 1:
+        fetch(ranges[0], response, sinks)
+    else:
+        ignored = []
+        with ThreadPoolExecutor(max_workers=len(ranges) - 1) as executor:
+            futures = [executor.submit(fetch_range, rng)
+                       for rng in ranges[1:]]
+            try:
+                fetch(ranges[0], response)
+                for n, future in enumerate(futures):
+                    if not future.result():
+                        ignored.append(ranges[n + 1])
+            except BaseException:
+                failed.set()
+                raise
+        if ignored:
+            # Some servers advertise range support but return the whole
+            # file. The first response is then the whole file too, so read
+            # the missing ranges from it.
+            if response.code != 200:
+                raise FileException('Range request failed (code 200)', url)
+            log.warning('Server ignored range requests, reading the rest of '
+                        '%s from one connection', url)
+            pos = ranges[0][1]
+            for rng in ignored:
+                skip(response, rng[2] - pos)
+                fetch(rng, response)
+                pos = rng[1]
+
+    if checksum and checksum not in sinks:
+        checksum.update_file(output.name)
+
+
+def _download_stream(url, response, output, decoder, progress, checksum=None,
+                     pipe=None, transfer=None, blocksize=1024 * 1024):
+    """
+    Read a response until it ends and write it to the output file. This is
+    used if the length isn't known, for instance if the response is chunked
+    or compressed.
+    decoder: If given a content_decoder() used to decompress the response
+    See _download_ranges for the other arguments
+    """
+    sinks = [s for s in (checksum, pipe) if s]
+
+    def write(data):
+        output.write(data)
+        for sink in sinks:
+            sink.update(data)
+
+    received = 0
+    while True:
+        data = response.read(blocksize)
+        if not data:
+            break
+        received += len(data)
+        if transfer:
+            transfer.update(len(data))
+        progress.update(received)
+        if decoder:
+            data = decoder.decompress(data)
+        write(data)
+    if decoder:
+        write(decoder.flush())
+        if not decoder.eof:
+            raise FileException('Incomplete compressed response', url)
+
+
+def _adapt_blocksize(blocksize, elapsed, target=0.25, minsize=64 * 1024,
+                     maxsize=2 * 1024 * 1024):
+    """
+    Return the size of the next read of a download given the time taken to
+    read a full block, aiming for reads of about target seconds so that
+    progress is still reported regularly on slow connections. Larger blocks
+    than maxsize no longer fit in the CPU cache and are slower to copy.
+    """
+    if elapsed < target / 2:
+        return min(blocksize * 2, maxsize)
+    if elapsed > target * 2:
+        return max(blocksize // 2, minsize)
+    return blocksize
+
+
+def _preallocate(f, size):
+    """
+    Reserve space for a file so that it isn't fragmented and a full disk is
+    detected before downloading. Falls back to extending a sparse file if
+    the filesystem doesn't support allocation.
+    """
+    f.flush()
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError) as e:
+        if getattr(e, 'errno', None) == errno.ENOSPC:
+            raise
+        log.debug('Unable to preallocate %s: %s', f.name, e)
+        f.truncate(size)
+
+
+def _hash_blocks(filename, blocksize, checksum=None):
+    """
+    Split a file into blocks and return a list of (offset, length, digest).
+    Zip files are split at the start of each entry and its data so that an
+    unchanged entry produces the same blocks wherever it is in the archive,
+    other files are split into fixed size blocks.
+    checksum: If given a Checksum which is updated with the whole file
+    """
+    size = os.path.getsize(filename)
+    starts = set([0, size])
+    with open(filename, 'rb') as f:
+        try:
+            with zipfile.ZipFile(filename) as z:
+                for info in z.infolist():
+                    f.seek(info.header_offset)
+                    header = f.read(30)
+                    if header[:4] != b'PK\x03\x04':
+                        raise zipfile.BadZipfile(
+                            'Invalid local header: %s' % info.filename)
+                    n, m = struct.unpack('<HH', header[26:30])
+                    data = info.header_offset + 30 + n + m
+                    starts.update([info.header_offset, data,
+                                   data + info.compress_size])
+        except zipfile.BadZipfile as e:
+            log.debug('Using fixed size blocks for %s: %s', filename, e)
+        bounds = sorted(s for s in starts if s <= size)
+
+        blocks = []
+        f.seek(0)
+        # zip() is shadowed in this module
+        for i in range(len(bounds) - 1):
+            start, end = bounds[i], bounds[i + 1]
+            for offset in range(start, end, blocksize):
+                length = min(blocksize, end - offset)
+                block = f.read(length)
+                if checksum:
+                    checksum.update(block)
+                blocks.append((offset, length, hashlib.sha256(
+                    block).hexdigest()[:32]))
+    return blocks
+
+
+def block_index(filename, blocksize=128 * 1024):
+    """
+    Create the block index of a file which is used for delta downloads.
+    This is a dictionary which can be serialised as JSON.
+    """
+    checksum = Checksum(algorithms=['sha256'])
+    blocks = _hash_blocks(filename, blocksize, checksum)
+    return {
+        'version': 1,
+        'blocksize': blocksize,
+        'length': os.path.getsize(filename),
+        'sha256': checksum.hexdigest('sha256'),
+        'blocks': [[length, digest] for (offset, length, digest) in blocks],
+    }
+
+
+def write_block_index(filename, blocksize=128 * 1024):
+    """
+    Write the block index of a file to filename + BLOCK_INDEX_SUFFIX so that
+    the file can be served by a mirror which supports delta downloads
+    return: The name of the index file
+    """
+    indexname = filename + BLOCK_INDEX_SUFFIX
+    tmpname = indexname + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(block_index(filename, blocksize), f)
+    os.rename(tmpname, indexname)
+    log.info('Wrote block index %s', indexname)
+    return indexname
+
+
+def _download_delta(url, filename, basis, print_progress, transfer,
+                    maxgap=64 * 1024, **kwargs):
+    """
+    Rebuild a remote file from the blocks of a local file that it shares
+    with it, fetching the other blocks with range requests. Ranges
+    separated by less than maxgap bytes are fetched in one request.
+    return: The name of a temporary file, this has been verified against the
+      block index
+    """
+    try:
+        index = json.loads(read(url + BLOCK_INDEX_SUFFIX, **kwargs))
+        blocksize = index['blocksize']
+        total = index['length']
+        blocks = index['blocks']
+        expected = index['sha256']
+    except (ValueError, KeyError, TypeError) as e:
+        raise FileException('Invalid block index: %s' % e, url)
+    if sum(length for (length, digest) in blocks) != total:
+        raise FileException('Invalid block index: incorrect length', url)
+
+    local = {}
+    for (offset, length, digest) in _hash_blocks(basis, blocksize):
+        local.setdefault(digest, offset)
+
+    output = tempfile.NamedTemporaryFile(
+        prefix=os.path.basename(filename) + '.',
+        dir=os.path.dirname(filename) or '.', delete=False)
+    try:
+        with output, open(basis, 'rb') as src:
+            _preallocate(output, total)
+            missing = []
+            offset = 0
+            for length, digest in blocks:
+                if digest in local:
+                    src.seek(local[digest])
+                    output.seek(offset)
+                    output.write(src.read(length))
+                elif missing and missing[-1][1] + maxgap >= offset:
+                    missing[-1][1] = offset + length
+                else:
+                    missing.append([offset, offset + length])
+                offset += length
+
+            nfetch = sum(end - start for (start, end) in missing)
+            log.info('Delta download: reusing %d bytes from %s, fetching %d '
+                     'bytes in %d ranges', total - nfetch, basis, nfetch,
+                     len(missing))
+            with Progress('download', url, nfetch,
+                          print_progress) as progress:
+                _fetch_ranges(url, output, DownloadState(url, total),
+                              missing, progress, transfer, **kwargs)
+
+        checksum = Checksum({'sha256': expected})
+        checksum.update_file(output.name)
+        if checksum.mismatches():
+            raise FileException('Delta download does not match the block '
+                                'index: %s' % checksum.mismatches(), url)
+        return output.name
+    except BaseException:
+        os.unlink(output.name)
+        raise
+
+
+def _fetch_ranges(url, output, state, ranges, progress, transfer,
+                  **kwargs):
+    """
+    Fetch a list of [start, end] byte ranges of a file, one at a time, and
+    write them into the output file
+    """
+    for start, end in ranges:
+        r = open_url(url, headers=state.range_headers(start, end), **kwargs)
+        try:
+            if not state.matches(r, start):
+                raise FileException(
+                    'Range request failed (code %d)' % r.code, url)
+            output.seek(start)
+            pos = start
+            while pos < end:
+                data = r.read(min(1024 * 1024, end - pos))
+                if not data:
+                    raise FileException('Incomplete range %d-%d' % (
+                        start, end - 1), url)
+                output.write(data)
+                pos += len(data)
+                if transfer:
+                    transfer.update(len(data))
+                progress.add(len(data))
+        finally:
+            r.close()
 
 
 def rename_backup(name, suffix='.bak'):
@@ -238,13 +1086,27 @@ def check_extracted_paths(namelist, subdir=None):
                 'Path in zipfile is not in required subdir', name)
 
 
-def unzip(filename, match_dir=False, destdir=None):
+def unzip(filename, match_dir=False, destdir=None, workers=1,
+          incremental=False, store=None, include=None, exclude=None,
+          manifest=False, sha256=None):
     """
     Extract all files from a zip archive
     filename: The path to the zip file
     match_dir: If True all files in the zip must be contained in a subdirectory
       named after the archive file with extension removed
     destdir: Extract the zip into this directory, default current directory
+    workers: Extract files on this many threads in parallel
+    incremental: If True only extract files which are missing or differ
+      from those already in destdir. If match_dir is also True files in the
+      subdirectory that aren't in the zip are removed.
+    store: If a TreeStore is given the zip is extracted into the store once
+      and the files are cloned from there, ignored if incremental is True
+    include, exclude: Only extract the files selected by these lists of
+      glob patterns, see select_members()
+    manifest: If True and match_dir is True write a manifest of the
+      extracted files next to the subdirectory, see write_extract_manifest()
+    sha256: The SHA-256 checksum of the zip if already known, this is used
+      to find it in the store
 
     return: If match_dir is True then returns the subdirectory (including
       destdir), otherwise returns destdir or '.'
@@ -253,35 +1115,576 @@ def unzip(filename, match_dir=False, destdir=None):
         destdir = '.'
 
     z = zipfile.ZipFile(filename)
-    unzipped = '.'
+    unzipped = unzip_subdir(filename, match_dir)
+    check_extracted_paths(z.namelist(), unzipped)
+    infolist = z.infolist()
+    if include or exclude:
+        n = len(infolist)
+        infolist = select_members(infolist, include, exclude)
+        log.info('Selected %d of %d entries in %s', len(infolist), n,
+                 filename)
+
+    if store and not incremental:
+        # The store always contains the whole archive
+        paths = None
+        if include or exclude:
+            paths = set(os.path.relpath(i.filename, unzipped or '.')
+                        for i in infolist)
+        target = os.path.join(destdir, unzipped or '.')
+        with store.checkout(sha256 or hash_file(filename), lambda d: unzip(
+                filename, destdir=d, workers=workers)) as tree:
+            counts = clone_tree(
+                os.path.join(tree, unzipped or '.'), target, paths)
+        log.info('Cloned %s from %s: %d reflinked, %d copied',
+                 filename, tree, counts['reflink'], counts['copy'])
+    elif incremental:
+        unchanged, extracted, removed = _unzip_incremental(
+            filename, infolist, destdir, unzipped, workers)
+        log.info('Unzipped %s incrementally: %d unchanged, %d extracted, '
+                 '%d removed', filename, unchanged, extracted, removed)
+    elif workers > 1:
+        _unzip_parallel(filename, infolist, destdir, workers)
+    else:
+        with Progress('unzip', filename,
+                      sum(i.file_size for i in infolist)) as progress:
+            for info in infolist:
+                log.debug('Extracting %s to %s', info.filename, destdir)
+                z.extract(info, destdir)
+                _set_permissions([info], destdir)
+                progress.add(info.file_size)
+
+    if manifest and unzipped:
+        write_extract_manifest(filename, infolist, destdir, unzipped)
+    return os.path.join(destdir, unzipped or '.')
+
+
+def extract_manifest_path(tree):
+    """
+    The manifest of an unzipped tree
+    """
+    return os.path.normpath(tree) + EXTRACT_MANIFEST_SUFFIX
 
-    if match_dir:
-        if not filename.endswith('.zip'):
-            raise FileException('Expected .zip file extension', filename)
-        unzipped = os.path.basename(filename)[:-4]
-        check_extracted_paths(z.namelist(), unzipped)
+
+def write_extract_manifest(filename, infolist, destdir, subdir):
+    """
+    Record the size, permissions, CRC-32 and modification time of each file
+    extracted from a zip, so the tree can later be checked against the zip
+    filename: The zip file
+    infolist: The extracted entries
+    destdir, subdir: The zip was extracted into destdir, all entries are in
+      subdir
+    return: The manifest file
+    """
+    tree = os.path.join(destdir, subdir)
+    files = {}
+    for info in infolist:
+        if info.filename.endswith('/'):
+            continue
+        path = os.path.join(destdir, info.filename)
+        st = os.stat(path)
+        files[os.path.relpath(path, tree)] = {
+            'size': info.file_size,
+            'mode': st.st_mode & 0o7777,
+            'crc32': info.CRC,
+            'mtime': st.st_mtime,
+        }
+    manifest = extract_manifest_path(tree)
+    tmpname = manifest + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump({
+            'version': 1,
+            'archive': os.path.basename(filename),
+            'files': files,
+        }, f, indent=1, sort_keys=True)
+    os.replace(tmpname, manifest)
+    log.debug('Wrote manifest %s', manifest)
+    return manifest
+
+
+def _unzip_parallel(filename, infolist, destdir, workers):
+    """
+    Extract the files in infolist on a pool of threads. Directories are
+    created first so the workers don't race to create them, and
+    permissions are applied once all files have been extracted.
+    """
+    dirs = set()
+    files = []
+    for info in infolist:
+        if info.filename.endswith('/'):
+            dirs.add(info.filename)
+        else:
+            dirs.add(os.path.dirname(info.filename))
+            files.append(info)
+    for d in sorted(dirs):
+        target = os.path.join(destdir, d)
+        if not os.path.isdir(target):
+            os.makedirs(target)
+
+    # Balance the uncompressed size of the files extracted by each worker,
+    # the largest files are assigned first
+    batches = [[] for n in range(workers)]
+    sizes = [0] * workers
+    for info in sorted(files, key=lambda i: i.file_size, reverse=True):
+        n = sizes.index(min(sizes))
+        batches[n].append(info)
+        sizes[n] += info.file_size
+
+    def extract(batch):
+        # ZipFile objects can't be shared between threads
+        with zipfile.ZipFile(filename) as z:
+            for info in batch:
+                log.debug('Extracting %s to %s', info.filename, destdir)
+                z.extract(info, destdir)
+                progress.add(info.file_size)
+
+    with Progress('unzip', filename, sum(sizes)) as progress:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(extract, [b for b in batches if b]):
+                pass
+
+    # Apply permissions deepest first so that read-only directories don't
+    # prevent changes to their contents
+    _set_permissions(reversed(infolist), destdir)
+
+
+def _unzip_incremental(filename, infolist, destdir, subdir, workers):
+    """
+    Extract the files in infolist which are missing or differ from those in
+    destdir, and remove files in subdir that aren't in infolist
+    return: A tuple of the number of (unchanged files, extracted files,
+      removed paths)
+    """
+    names = set()
+    extract = []
+    for info in infolist:
+        name = info.filename.rstrip('/')
+        while name:
+            names.add(os.path.normpath(name))
+            name = os.path.dirname(name)
+        target = os.path.join(destdir, info.filename)
+        if info.filename.endswith('/'):
+            if os.path.lexists(target) and not os.path.isdir(target):
+                os.unlink(target)
+            if not os.path.isdir(target):
+                os.makedirs(target)
+        elif not _unchanged(info, target):
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                # The file may be read-only
+                os.unlink(target)
+            extract.append(info)
+
+    removed = 0
+    if subdir:
+        for root, dirs, files in os.walk(
+                os.path.join(destdir, subdir), topdown=False):
+            for f in files + dirs:
+                path = os.path.join(root, f)
+                if os.path.normpath(os.path.relpath(path, destdir)) in names:
+                    continue
+                log.debug('Removing %s', path)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    os.rmdir(path)
+                else:
+                    os.unlink(path)
+                removed += 1
+
+    if workers > 1:
+        _unzip_parallel(filename, extract, destdir, workers)
     else:
-        check_extracted_paths(z.namelist())
+        with zipfile.ZipFile(filename) as z, Progress(
+                'unzip', filename,
+                sum(i.file_size for i in extract)) as progress:
+            for info in extract:
+                log.debug('Extracting %s to %s', info.filename, destdir)
+                z.extract(info, destdir)
+                progress.add(info.file_size)
+    _set_permissions(reversed(infolist), destdir)
+
+    nfiles = len([i for i in infolist if not i.filename.endswith('/')])
+    return nfiles - len(extract), len(extract), removed
+
 
+def _unchanged(info, path):
+    """
+    Check whether a file matches a zip entry. If the size and modification
+    time match the file is assumed to be unchanged, otherwise the CRC-32 is
+    compared.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if not os.path.isfile(path) or os.path.islink(path):
+        return False
+    if st.st_size != info.file_size:
+        return False
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    # Zip timestamps have a resolution of two seconds
+    if abs(st.st_mtime - mtime) < 2:
+        return True
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xFFFFFFFF == info.CRC
+
+
+def select_members(infolist, include=None, exclude=None):
+    """
+    Filter the entries of a zip by glob patterns matched against their full
+    names, * also matches /. Directories match with or without a trailing
+    /, an entry also matches if one of its parent directories does.
+    Directories are kept if they contain a selected file.
+    infolist: A list of ZipInfo
+    include: If given only select entries matching at least one pattern
+    exclude: Don't select entries matching any of these patterns
+    return: The selected entries
+    """
+    def match(name, patterns):
+        name = name.rstrip('/')
+        while name:
+            if any(fnmatch.fnmatchcase(name, p) or
+                   fnmatch.fnmatchcase(name + '/', p) for p in patterns):
+                return True
+            name = os.path.dirname(name)
+        return False
+
+    def selected(name):
+        if include and not match(name, include):
+            return False
+        return not (exclude and match(name, exclude))
+
+    parents = set()
+    for info in infolist:
+        if not info.filename.endswith('/') and selected(info.filename):
+            name = os.path.dirname(info.filename)
+            while name:
+                parents.add(name)
+                name = os.path.dirname(name)
+    return [i for i in infolist if selected(i.filename) or (
+        i.filename.endswith('/') and i.filename.rstrip('/') in parents)]
+
+
+def unzip_subdir(filename, match_dir):
+    """
+    Return the subdirectory that all files in a zip must be contained in,
+    or None if match_dir is False
+    """
+    if not match_dir:
+        return None
+    if not filename.endswith('.zip'):
+        raise FileException('Expected .zip file extension', filename)
+    return os.path.basename(filename)[:-4]
+
+
+def _set_permissions(infolist, destdir):
     # File permissions, see
     # http://stackoverflow.com/a/6297838
     # http://stackoverflow.com/a/3015466
-    for info in z.infolist():
-        log.debug('Extracting %s to %s', info.filename, destdir)
-        z.extract(info, destdir)
+    for info in infolist:
         perms = info.external_attr >> 16 & 4095
         if perms > 0:
             os.chmod(os.path.join(destdir, info.filename), perms)
 
-    return os.path.join(destdir, unzipped)
+
+class _UnsupportedZip(Exception):
+    pass
 
 
-def zip(filename, paths, strip_prefix=''):
+class _QueueReader(object):
     """
-    Create a new zip archive containing files
-    filename: The name of the zip file to be created
-    paths: A list of files or directories
-    strip_dir: Remove this prefix from all file-paths before adding to zip
+    Read a byte stream from blocks placed on a queue, a block of None marks
+    the end of the stream
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.buf = b''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        block = self.queue.get()
+        if block is None:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def read(self, n):
+        """
+        Read exactly n bytes, or fewer at the end of the stream
+        """
+        while len(self.buf) - self.pos < n and self._fill():
+            pass
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def read_some(self, n):
+        """
+        Read up to n bytes, blocking only if nothing is buffered
+        """
+        if self.pos >= len(self.buf):
+            self._fill()
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def unread(self, data):
+        """
+        Push back the tail of the data returned by the last read
+        """
+        self.pos -= len(data)
+
+    def drain(self):
+        while self._fill():
+            self.buf = b''
+
+
+class ZipStreamExtractor(object):
+    """
+    Extract a zip file while it is being downloaded by parsing the local
+    file headers as the data arrives. Data is passed to update() and the
+    entries are extracted on a background thread, so network and disk
+    transfers overlap.
+
+    File permissions are only stored in the central directory at the end of
+    the zip, so they are applied by close() once the download is complete.
+    Entries are extracted into a temporary directory in destdir which is
+    moved into place by close(), so a failed or rejected download doesn't
+    leave a partial tree behind.
+    Archives that can't be streamed (for instance encrypted entries, or
+    stored entries with a trailing data descriptor) are extracted with
+    unzip() when the download has finished.
+    """
+
+    def __init__(self, filename, match_dir=False, destdir=None, workers=1,
+                 manifest=False):
+        """
+        Arguments are as for unzip(), workers is only used if the zip can't
+        be streamed
+        """
+        self.filename = filename
+        self.match_dir = match_dir
+        self.destdir = destdir or '.'
+        self.workers = workers
+        self.manifest = manifest
+        self.subdir = unzip_subdir(filename, match_dir)
+        if not os.path.isdir(self.destdir):
+            os.makedirs(self.destdir)
+        self.tmpdir = tempfile.mkdtemp(
+            prefix='.%s.' % os.path.basename(filename), dir=self.destdir)
+        self.queue = queue.Queue(32)
+        self.thread = None
+        self.extracted = set()
+        self.complete = False
+        self.unsupported = None
+        self.error = None
+
+    def update(self, data):
+        if self.error:
+            raise self.error
+        if not self.thread:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(bytes(data))
+
+    def _finish(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+
+    def abort(self):
+        """
+        Stop extracting and remove the extracted files, for instance if the
+        download failed
+        """
+        self._finish()
+        self._remove_tmpdir()
+
+    def _remove_tmpdir(self):
+        if os.path.exists(self.tmpdir):
+            remove_tree(self.tmpdir)
+
+    def close(self):
+        """
+        Wait for extraction to finish, move the extracted files into destdir
+        and apply file permissions. If the zip could not be streamed it is
+        extracted with unzip().
+        return: As for unzip()
+        """
+        self._finish()
+        if self.error:
+            self._remove_tmpdir()
+            raise self.error
+        if not self.thread:
+            self._remove_tmpdir()
+            return unzip(self.filename, self.match_dir, self.destdir,
+                         self.workers, manifest=self.manifest)
+        if self.complete:
+            z = zipfile.ZipFile(self.filename)
+            if set(z.namelist()) == self.extracted:
+                for name in os.listdir(self.tmpdir):
+                    _move_into(os.path.join(self.tmpdir, name),
+                               os.path.join(self.destdir, name))
+                os.rmdir(self.tmpdir)
+                _set_permissions(z.infolist(), self.destdir)
+                if self.manifest and self.subdir:
+                    write_extract_manifest(self.filename, z.infolist(),
+                                           self.destdir, self.subdir)
+                return os.path.join(self.destdir, self.subdir or '.')
+            self.unsupported = 'central directory does not match entries'
+        log.info('Unable to extract %s whilst downloading (%s)',
+                 self.filename, self.unsupported or 'incomplete')
+        self._remove_tmpdir()
+        return unzip(self.filename, self.match_dir, self.destdir,
+                     self.workers, manifest=self.manifest)
+
+    def _run(self):
+        reader = _QueueReader(self.queue)
+        try:
+            while True:
+                sig = reader.read(4)
+                if sig == b'PK\x03\x04':
+                    self._extract_entry(reader)
+                elif sig in (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06'):
+                    self.complete = True
+                    break
+                else:
+                    raise _UnsupportedZip('unexpected signature')
+        except _UnsupportedZip as e:
+            self.unsupported = str(e)
+        except Exception as e:
+            self.error = e
+        finally:
+            reader.drain()
+
+    def _extract_entry(self, reader):
+        header = reader.read(26)
+        if len(header) < 26:
+            raise _UnsupportedZip('truncated header')
+        (version, flags, method, mtime, mdate, crc, csize, usize, namelen,
+         extralen) = struct.unpack('<HHHHHIIIHH', header)
+        name = reader.read(namelen)
+        extra = reader.read(extralen)
+        if flags & 0x800:
+            name = name.decode('utf-8')
+        else:
+            name = name.decode('cp437')
+        if flags & 0x1:
+            raise _UnsupportedZip('encrypted entry')
+
+        zip64 = False
+        if csize == 0xFFFFFFFF or usize == 0xFFFFFFFF:
+            zip64 = True
+            usize, csize = _zip64_sizes(extra, usize, csize)
+
+        check_extracted_paths([name], self.subdir)
+        target = os.path.join(self.tmpdir, name)
+        log.debug('Extracting %s to %s', name, self.tmpdir)
+        isdir = name.endswith('/')
+        parent = target if isdir else os.path.dirname(target)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        descriptor = flags & 0x8
+        crc32 = 0
+        with open(os.devnull if isdir else target, 'wb') as f:
+            if method == zipfile.ZIP_STORED:
+                if descriptor and isdir:
+                    # Directories have no data
+                    csize = 0
+                elif descriptor:
+                    raise _UnsupportedZip('stored entry with data descriptor')
+                remaining = csize
+                while remaining > 0:
+                    data = reader.read_some(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise _UnsupportedZip('truncated entry')
+                    remaining -= len(data)
+                    crc32 = zlib.crc32(data, crc32)
+                    f.write(data)
+            elif method == zipfile.ZIP_DEFLATED:
+                d = zlib.decompressobj(-15)
+                remaining = None if descriptor else csize
+                while not d.eof:
+                    n = 1024 * 1024
+                    if remaining is not None:
+                        n = min(n, remaining)
+                    data = reader.read_some(n) if n else b''
+                    if not data:
+                        raise _UnsupportedZip('truncated entry')
+                    if remaining is not None:
+                        remaining -= len(data)
+                    # Limit the size of each decompressed chunk
+                    while data:
+                        out = d.decompress(data, 16 * 1024 * 1024)
+                        crc32 = zlib.crc32(out, crc32)
+                        f.write(out)
+                        data = d.unconsumed_tail
+                reader.unread(d.unused_data)
+            else:
+                raise _UnsupportedZip('compression method %d' % method)
+
+        if descriptor:
+            sig = reader.read(4)
+            if sig != b'PK\x07\x08':
+                reader.unread(sig)
+            crc = struct.unpack('<I', reader.read(4))[0]
+            reader.read(16 if zip64 else 8)
+        if crc32 & 0xFFFFFFFF != crc:
+            raise FileException('Bad CRC-32 for file', name)
+        self.extracted.add(name)
+
+
+def _move_into(src, dst):
+    """
+    Move a file or directory, merging directories with any existing
+    directory at dst and replacing existing files
+    """
+    if os.path.isdir(dst) and not os.path.islink(dst) and (
+            os.path.isdir(src) and not os.path.islink(src)):
+        for name in os.listdir(src):
+            _move_into(os.path.join(src, name), os.path.join(dst, name))
+        os.rmdir(src)
+        return
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        remove_tree(dst)
+    elif os.path.lexists(dst):
+        os.unlink(dst)
+    os.rename(src, dst)
+
+
+def _zip64_sizes(extra, usize, csize):
+    """
+    Read the sizes from the zip64 extended information extra field
+    """
+    while len(extra) >= 4:
+        tag, size = struct.unpack('<HH', extra[:4])
+        if tag == 1:
+            data = extra[4:4 + size]
+            if usize == 0xFFFFFFFF:
+                usize = struct.unpack('<Q', data[:8])[0]
+                data = data[8:]
+            if csize == 0xFFFFFFFF:
+                csize = struct.unpack('<Q', data[:8])[0]
+            return usize, csize
+        extra = extra[4 + size:]
+    raise _UnsupportedZip('missing zip64 extra field')
+
+
+def list_archive_files(paths, strip_prefix):
+    """
+    List the files under paths
+    return: A sorted list of (filename, arcname), arcname is the filename
+      without strip_prefix
     """
     if isinstance(paths, basestring):
         paths = [paths]
@@ -295,21 +1698,465 @@ def zip(filename, paths, strip_prefix=''):
                 for f in files:
                     filelist.add(os.path.join(root, f))
 
-    z = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+    files = []
     for f in sorted(filelist):
         arcname = f
         if arcname.startswith(strip_prefix):
             arcname = arcname[len(strip_prefix):]
         if arcname.startswith(os.path.sep):
             arcname = arcname[1:]
+        files.append((f, arcname))
+    return files
+
+
+def archive(filename, paths, strip_prefix='', workers=1, level=None):
+    """
+    Create a new archive containing files, the format is chosen from the
+    extension of filename: .tar, .tar.gz, .tar.xz, .tar.zst (if the
+    zstandard module is installed), otherwise zip.
+    See zip() for the other arguments, workers is only used by zip and zstd
+    """
+    for ext, compressor in TAR_FORMATS:
+        if filename.endswith(ext):
+            tar(filename, paths, strip_prefix, compressor, workers, level)
+            return
+    zip(filename, paths, strip_prefix, workers, level)
+
+
+def check_archive_level(filename, level):
+    """
+    Raise ValueError if level isn't a valid compression level for the
+    archive format chosen by the extension of filename, see archive()
+    """
+    if filename.endswith(('.tar.zst', '.tzst')):
+        lowest, highest = 1, 22
+    else:
+        lowest, highest = 0, 9
+    if not lowest <= level <= highest:
+        raise ValueError('Compression level for %s must be %d-%d: %d' % (
+            filename, lowest, highest, level))
+
+
+def _gzip_compressor(level, workers):
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    # wbits 16 + 15 writes a gzip header and trailer
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+def _xz_compressor(level, workers):
+    if level is None:
+        return lzma.LZMACompressor()
+    return lzma.LZMACompressor(preset=level)
+
+
+def _zstd_compressor(level, workers):
+    kwargs = {}
+    if level is not None:
+        kwargs['level'] = level
+    if workers > 1:
+        kwargs['threads'] = workers
+    return zstandard.ZstdCompressor(**kwargs).compressobj()
+
+
+# Extensions of tar formats and a function returning a compressor object
+# with compress() and flush() methods given the level and number of threads
+TAR_FORMATS = [
+    ('.tar', None),
+    ('.tar.gz', _gzip_compressor),
+    ('.tgz', _gzip_compressor),
+    ('.tar.xz', _xz_compressor),
+    ('.txz', _xz_compressor),
+    ('.tar.zst', _zstd_compressor),
+    ('.tzst', _zstd_compressor),
+]
+
+
+def tar(filename, paths, strip_prefix='', compressor=None, workers=1,
+        level=None):
+    """
+    Create a new tar archive containing files. The archive is written as a
+    pipeline of generators so only one block of a file is held in memory.
+    compressor: A function from TAR_FORMATS, None for an uncompressed tar
+    See zip() for the other arguments
+    """
+    if compressor is _zstd_compressor and not zstandard:
+        raise FileException(
+            'The zstandard module is required for zstd compression, '
+            'use .tar.xz or .tar.gz', filename)
+    files = list_archive_files(paths, strip_prefix)
+    for f, arcname in files:
         log.debug('Adding %s to %s[%s]', f, filename, arcname)
-        z.write(f, arcname)
+    total = sum(os.path.getsize(f) for (f, arcname) in files)
+    with Progress('tar', filename, total) as progress:
+        stream = _tar_stream(files, progress)
+        if compressor:
+            stream = _compress_stream(stream, compressor(level, workers))
+        with open(filename, 'wb') as f:
+            for data in stream:
+                f.write(data)
+
+
+def _tar_stream(files, progress, blocksize=1024 * 1024):
+    """
+    Generate the contents of a tar archive of files
+    files: A list of (filename, arcname)
+    progress: A Progress which is updated with the size of the files read
+    """
+    written = 0
+    for filename, arcname in files:
+        st = os.stat(filename)
+        info = tarfile.TarInfo(arcname.replace(os.path.sep, '/'))
+        info.size = st.st_size
+        info.mtime = st.st_mtime
+        info.mode = st.st_mode & 0o7777
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+        header = info.tobuf(tarfile.PAX_FORMAT)
+        yield header
+        written += len(header)
+        remaining = info.size
+        with open(filename, 'rb') as f:
+            while remaining:
+                data = f.read(min(blocksize, remaining))
+                if not data:
+                    raise FileException(
+                        'File shrank whilst it was archived', filename)
+                yield data
+                remaining -= len(data)
+                progress.add(len(data))
+        padding = -info.size % tarfile.BLOCKSIZE
+        yield tarfile.NUL * padding
+        written += info.size + padding
+    # End of archive marker, padded to a whole record
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield tarfile.NUL * end
+
+
+def _compress_stream(stream, compressor):
+    """
+    Compress a stream of data
+    compressor: An object with compress() and flush() methods
+    """
+    for data in stream:
+        data = compressor.compress(data)
+        if data:
+            yield data
+    yield compressor.flush()
+
 
+def zip(filename, paths, strip_prefix='', workers=1, level=None):
+    """
+    Create a new zip archive containing files
+    filename: The name of the zip file to be created
+    paths: A list of files or directories
+    strip_dir: Remove this prefix from all file-paths before adding to zip
+    workers: Compress files on this many parallel threads, large files are
+      split into chunks which are compressed separately
+    level: The compression level from 0 to 9, default is the zlib default
+    """
+    filelist = list_archive_files(paths, strip_prefix)
+    kwargs = {}
+    if level is not None:
+        kwargs['compresslevel'] = level
+    sizes = dict((f, os.path.getsize(f)) for (f, arcname) in filelist)
+    z = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, **kwargs)
+    if workers > 1 and not _zip_parallel_supported(z):
+        log.warning('Parallel zip is not supported by this version of '
+                    'Python, using one thread')
+        workers = 1
+    with Progress('zip', filename, sum(sizes.values())) as progress:
+        files = []
+        for f, arcname in filelist:
+            log.debug('Adding %s to %s[%s]', f, filename, arcname)
+            if workers > 1:
+                files.append((f, arcname))
+            else:
+                z.write(f, arcname)
+                progress.add(sizes[f])
+
+        if files:
+            if level is None:
+                level = zlib.Z_DEFAULT_COMPRESSION
+            _zip_parallel(z, files, workers, level, progress)
     z.close()
 
 
+def _deflate(data, level, zdict, last):
+    """
+    Compress a chunk of a file as raw deflate data which can be
+    concatenated with the following chunks. zdict is the end of the
+    previous chunk so that repeated strings are still found.
+    """
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+# Private ZipFile attributes used by _zip_parallel to write entries whose
+# data is compressed separately
+ZIP_INTERNALS = ('_writecheck', '_didModify', 'start_dir', 'fp', 'filelist',
+                 'NameToInfo')
+
+
+def _zip_parallel_supported(z):
+    """
+    Check whether the ZipFile internals used by _zip_parallel exist
+    """
+    return (all(hasattr(z, a) for a in ZIP_INTERNALS) and
+            hasattr(zipfile.ZipInfo, 'FileHeader') and
+            hasattr(zipfile.ZipInfo, 'from_file'))
+
+
+def _zip_parallel(z, files, workers, level, progress,
+                  chunksize=1024 * 1024):
+    """
+    Add files to an open zip, compressing chunks of the files on a pool of
+    threads. Chunks are written in order as soon as they are compressed,
+    and at most a few chunks per thread are held in memory.
+    z: A ZipFile opened for writing to a seekable file
+    files: A list of (filename, arcname)
+    progress: A Progress which is updated with the size of the files read
+    """
+    pending = deque()
+
+    def write(entry, future, last):
+        zinfo, zip64 = entry
+        if zinfo.header_offset is None:
+            zinfo.header_offset = z.fp.tell()
+            z.fp.write(zinfo.FileHeader(zip64))
+        data = future.result()
+        z.fp.write(data)
+        zinfo.compress_size += len(data)
+        if not last:
+            return
+        if not zip64 and max(zinfo.file_size, zinfo.compress_size) > (
+                zipfile.ZIP64_LIMIT):
+            raise FileException('File grew whilst it was archived',
+                                zinfo.filename)
+        # Rewrite the local header now the sizes and CRC are known
+        end = z.fp.tell()
+        z.fp.seek(zinfo.header_offset)
+        z.fp.write(zinfo.FileHeader(zip64))
+        z.fp.seek(end)
+        z.start_dir = end
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename] = zinfo
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filename, arcname in files:
+            zinfo = zipfile.ZipInfo.from_file(filename, arcname)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.header_offset = None
+            # The local header must have space for the zip64 sizes if the
+            # file might need them
+            entry = (zinfo, zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT)
+            z._writecheck(zinfo)
+            z._didModify = True
+            zinfo.file_size = 0
+            zinfo.compress_size = 0
+            zinfo.CRC = 0
+            with open(filename, 'rb') as f:
+                data = f.read(chunksize)
+                zdict = None
+                while True:
+                    following = f.read(chunksize)
+                    zinfo.CRC = zlib.crc32(data, zinfo.CRC)
+                    zinfo.file_size += len(data)
+                    progress.add(len(data))
+                    pending.append((entry, executor.submit(
+                        _deflate, data, level, zdict, not following),
+                        not following))
+                    while len(pending) > 2 * workers:
+                        write(*pending.popleft())
+                    if not following:
+                        break
+                    zdict = data[-32768:]
+                    data = following
+        while pending:
+            write(*pending.popleft())
+
+
+# Linux ioctl to share the data of two files on a copy-on-write filesystem
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def clone_tree(src, dst, paths=None):
+    """
+    Copy a directory tree sharing data if possible: files are reflinked if
+    the filesystem supports it, otherwise copied. Files are never hardlinked
+    since a change to a clone, even of a read-only file whose mode is
+    changed first, would alter src. Existing files in dst are replaced.
+    src: The tree to be cloned
+    dst: The destination directory, this may already exist
+    paths: If given only clone these paths relative to src and their
+      parent directories
+    return: A dictionary of the number of files cloned by each method
+      {'reflink': n, 'copy': n}
+    """
+    counts = {'reflink': 0, 'copy': 0}
+    reflink = bool(fcntl)
+    if paths is not None:
+        paths = set(os.path.normpath(p) for p in paths)
+        for p in list(paths):
+            p = os.path.dirname(p)
+            while p and p not in paths:
+                paths.add(p)
+                p = os.path.dirname(p)
+    dirs = []
+    for root, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(root, src)
+        target = os.path.normpath(os.path.join(dst, rel))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        dirs.append((root, target))
+        if paths is not None:
+            dirnames[:] = [d for d in dirnames if os.path.normpath(
+                os.path.join(rel, d)) in paths]
+            filenames = [f for f in filenames if os.path.normpath(
+                os.path.join(rel, f)) in paths]
+        # Symlinks to directories are listed in dirnames but not followed
+        for name in dirnames + filenames:
+            s = os.path.join(root, name)
+            t = os.path.join(target, name)
+            if os.path.isdir(s) and not os.path.islink(s):
+                continue
+            if os.path.lexists(t):
+                os.unlink(t)
+            if os.path.islink(s):
+                os.symlink(os.readlink(s), t)
+                continue
+            if reflink:
+                try:
+                    _reflink(s, t)
+                    shutil.copymode(s, t)
+                    counts['reflink'] += 1
+                    continue
+                except (IOError, OSError) as e:
+                    if os.path.exists(t):
+                        os.unlink(t)
+                    if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP,
+                                       errno.ENOTTY, errno.EINVAL):
+                        raise
+                    log.debug('Reflinks not supported: %s', e)
+                    reflink = False
+            shutil.copy2(s, t)
+            counts['copy'] += 1
+
+    # Apply permissions deepest first so that read-only directories don't
+    # prevent changes to their contents
+    for root, target in reversed(dirs):
+        shutil.copymode(root, target)
+    return counts
+
+
+def dedup_tree(newdir, olddir, method='hardlink', subdirs=None):
+    """
+    Replace files in newdir with links to identical files in olddir to save
+    disk space. Files are matched by size, permissions and SHA-256 checksum,
+    and can be at any path in olddir.
+    newdir: The directory to be deduplicated
+    olddir: The directory containing existing files
+    method: 'hardlink' to share the inode of the old file, this means any
+      changes to the file will affect both trees, or 'reflink' to share the
+      data on a copy-on-write filesystem (Linux only)
+    subdirs: Only deduplicate these subdirectories of both trees, for
+      instance those which are never modified
+    return: A tuple of the number of files linked and the bytes saved
+    """
+    if method not in ('hardlink', 'reflink'):
+        raise Exception('Invalid dedup method: %s' % method)
+    if method == 'reflink' and not fcntl:
+        raise FileException('Reflinks are not supported', newdir)
+
+    def walk(top):
+        for subdir in (subdirs or ['.']):
+            for root, dirs, files in os.walk(os.path.join(top, subdir)):
+                for f in files:
+                    path = os.path.join(root, f)
+                    st = os.lstat(path)
+                    if os.path.isfile(path) and not os.path.islink(path):
+                        yield path, st
+
+    old = {}
+    for path, st in walk(olddir):
+        old.setdefault((st.st_size, st.st_mode), []).append((path, st))
+
+    hashes = {}
+
+    def sha256(path):
+        if path not in hashes:
+            hashes[path] = hash_file(path)
+        return hashes[path]
+
+    linked = 0
+    saved = 0
+    for path, st in walk(newdir):
+        candidates = old.get((st.st_size, st.st_mode))
+        if not candidates or not st.st_size:
+            continue
+        for oldpath, oldst in candidates:
+            if (oldst.st_dev, oldst.st_ino) == (st.st_dev, st.st_ino):
+                break
+            if sha256(oldpath) != sha256(path):
+                continue
+            tmpname = path + '.omego-dedup'
+            try:
+                if method == 'hardlink':
+                    os.link(oldpath, tmpname)
+                else:
+                    _reflink(oldpath, tmpname)
+                    os.chmod(tmpname, st.st_mode)
+                os.replace(tmpname, path)
+            except (IOError, OSError) as e:
+                if os.path.exists(tmpname):
+                    os.unlink(tmpname)
+                if e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+                               errno.EINVAL):
+                    # Not supported by this filesystem
+                    log.warning('Unable to %s %s to %s: %s',
+                                method, olddir, newdir, e)
+                    return linked, saved
+                log.warning('Failed to %s %s to %s: %s',
+                            method, oldpath, path, e)
+                break
+            log.debug('Linked %s to %s', path, oldpath)
+            linked += 1
+            saved += st.st_size
+            break
+
+    log.info('Deduplicated %d files (%d bytes) in %s against %s',
+             linked, saved, newdir, olddir)
+    return linked, saved
+
+
+def _file_id(path):
+    """
+    Return a tuple which changes if a file is replaced, or None if it
+    doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+
 def get_as_local_path(path, overwrite, progress=0,
-                      httpuser=None, httppassword=None):
+                      httpuser=None, httppassword=None, connections=1,
+                      resume=False, cachedir=None, cachesize=None,
+                      checksums=None, stream_unzip=None, delta_from=None,
+                      write_index=False):
     """
     Automatically handle local and remote URLs, files and directories
 
@@ -322,12 +2169,51 @@ def get_as_local_path(path, overwrite, progress=0,
       'keep': Keep the old file, don't overwrite or raise an exception
     progress: Number of progress dots, default 0 (don't print)
     httpuser, httppass: Credentials for HTTP authentication
+    connections: Maximum number of parallel connections for downloads
+    resume: Keep incomplete downloads and resume them on the next call
+    cachedir: If set fetch remote files through an ArtifactCache in this
+      directory, 'auto' for the default location
+    cachesize: The maximum size of the cache in MiB
+    checksums: A dictionary of expected {algorithm: hexdigest} of a remote
+      file, the download fails if these don't match
+    stream_unzip: If a dictionary of unzip() arguments is given a remote
+      zip is extracted whilst it is downloaded
+    delta_from: A local file containing an earlier version of a remote
+      file, only the changed blocks are downloaded if the server publishes
+      a block index
+    write_index: If True write a block index next to the local file
     return: A tuple (type, localpath)
       type:
         'file': localpath is the path to a local file
         'directory': localpath is the path to a local directory
         'unzipped': localpath is the path to a local unzipped directory
     """
+    def fetch():
+        kwargs = dict(httpuser=httpuser, httppassword=httppassword,
+                      connections=connections, resume=resume)
+        if delta_from:
+            kwargs['delta_from'] = delta_from
+        extractor = None
+        if stream_unzip is not None and is_archive(localpath):
+            extractor = ZipStreamExtractor(localpath, **stream_unzip)
+            kwargs['pipe'] = extractor
+        try:
+            if cachedir:
+                cached_download(path, localpath, ArtifactCache(
+                    cachedir, cachesize), progress, checksums=checksums,
+                    **kwargs)
+            else:
+                if checksums:
+                    kwargs['checksum'] = Checksum(checksums)
+                download(path, localpath, progress, **kwargs)
+        except BaseException:
+            if extractor:
+                extractor.abort()
+            raise
+        return extractor
+
+    extractor = None
+
     m = re.match('([A-Za-z]+)://', path)
     if m:
         # url_open handles multiple protocols so don't bother validating
@@ -339,24 +2225,36 @@ def get_as_local_path(path, overwrite, progress=0,
             raise FileException(
                 'Remote path appears to be a directory', path)
 
-        if os.path.exists(localpath):
-            if overwrite == 'error':
-                raise FileException('File already exists', localpath)
-            elif overwrite == 'keep':
-                log.info('Keeping existing %s', localpath)
-            elif overwrite == 'backup':
-                rename_backup(localpath)
-                download(path, localpath, progress, httpuser=httpuser,
-                         httppassword=httppassword)
+        # If another process is downloading the same file wait for it and
+        # use its copy
+        before = _file_id(localpath)
+        with FileLock(localpath + '.lock') as lock:
+            if lock.waited and _file_id(localpath) not in (None, before):
+                log.info('Using %s downloaded by another process', localpath)
+            elif os.path.exists(localpath):
+                if overwrite == 'error':
+                    raise FileException('File already exists', localpath)
+                elif overwrite == 'keep':
+                    log.info('Keeping existing %s', localpath)
+                elif overwrite == 'backup':
+                    rename_backup(localpath)
+                    extractor = fetch()
+                else:
+                    raise Exception('Invalid overwrite flag: %s' % overwrite)
             else:
-                raise Exception('Invalid overwrite flag: %s' % overwrite)
-        else:
-            download(path, localpath, progress, httpuser=httpuser,
-                     httppassword=httppassword)
+                extractor = fetch()
     else:
         localpath = path
     log.debug("Local path: %s", localpath)
 
+    if write_index and os.path.isfile(localpath):
+        write_block_index(localpath)
+
+    if extractor:
+        unzipped = extractor.close()
+        log.debug("Unzipped: %s", unzipped)
+        return 'unzipped', unzipped
+
     if os.path.isdir(localpath):
         return 'directory', localpath
     if os.path.exists(localpath):
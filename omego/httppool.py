@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from future import standard_library
+from builtins import object
+import http.client
+import logging
+import socket
+import ssl
+import threading
+import urllib.error
+import urllib.request
+
+standard_library.install_aliases()  # noqa
+log = logging.getLogger("omego.httppool")
+
+
+class ConnectionPool(object):
+    """
+    Idle HTTP keep-alive connections shared by all requests in this process
+    so that requests to the same server don't each need a new TCP and TLS
+    handshake. Connections are keyed by scheme, host and port, and by any
+    other setting that affects the connection such as SSL verification.
+    """
+
+    def __init__(self, maxidle=8):
+        """
+        maxidle: The maximum number of idle connections kept for each key
+        """
+        self.maxidle = maxidle
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key):
+        """
+        Remove and return an idle connection, or None if there isn't one
+        """
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+    def put(self, key, conn):
+        """
+        Return a connection to the pool, it is closed if the pool is full
+        """
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxidle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+pool = ConnectionPool()
+
+_ssl_lock = threading.Lock()
+_ssl_contexts = {}
+_ssl_sessions = {}
+
+
+def ssl_context(verify=True):
+    """
+    Return the SSL context for a verification mode. Contexts are created
+    once per process so the CA certificates are only loaded once, and so
+    that TLS sessions can be resumed.
+    verify: If False certificates and hostnames aren't verified
+    """
+    with _ssl_lock:
+        context = _ssl_contexts.get(verify)
+        if context is None:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _ssl_contexts[verify] = context
+    return context
+
+
+class ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """
+    An HTTPS connection which resumes the TLS session of an earlier
+    connection to the same server, skipping the full handshake
+    """
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self._session_key = (id(self._context), server_hostname, self.port)
+        with _ssl_lock:
+            session = _ssl_sessions.get(self._session_key)
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname, session=session)
+        if self.sock.session_reused:
+            log.debug('Resumed TLS session with %s', server_hostname)
+        self.save_session()
+
+    def save_session(self):
+        """
+        Store the TLS session for later connections. With TLS 1.3 the
+        session ticket is only received after the handshake, so this should
+        also be called once a response has been read.
+        """
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            with _ssl_lock:
+                _ssl_sessions[self._session_key] = session
+
+    def close(self):
+        # Called by getresponse() if the server closes the connection
+        self.save_session()
+        http.client.HTTPSConnection.close(self)
+
+
+class PooledResponse(http.client.HTTPResponse):
+    """
+    A response which returns its connection to the pool when it is closed,
+    provided the body was read completely and the server allows the
+    connection to be kept alive
+    """
+
+    release = None
+
+    def close(self):
+        reusable = not self.will_close and (
+            self.fp is None or (self.length == 0 and not self.chunked))
+        super(PooledResponse, self).close()
+        if self.release:
+            release = self.release
+            self.release = None
+            release(reusable)
+
+
+class _KeepAliveMixin(object):
+
+    def _open_pooled(self, http_class, req, key, **http_conn_args):
+        """
+        Make a request on a pooled connection, this is a version of
+        AbstractHTTPHandler.do_open that doesn't close the connection.
+        Requests through an HTTPS proxy tunnel aren't pooled.
+        """
+        if req._tunnel_host:
+            return self.do_open(http_class, req, **http_conn_args)
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+        key = key + (host,)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for (k, v) in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for (name, val) in headers.items())
+
+        h = pool.get(key)
+        while True:
+            reused = h is not None
+            if not reused:
+                h = http_class(host, timeout=req.timeout, **http_conn_args)
+                h.response_class = PooledResponse
+            else:
+                h.timeout = req.timeout
+                if h.sock:
+                    timeout = req.timeout
+                    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                        timeout = socket.getdefaulttimeout()
+                    h.sock.settimeout(timeout)
+            h.set_debuglevel(self._debuglevel)
+            try:
+                h.request(req.get_method(), req.selector, req.data, headers)
+                r = h.getresponse()
+                break
+            except (http.client.HTTPException, OSError) as err:
+                h.close()
+                if reused:
+                    # The server may have closed an idle connection
+                    log.debug('Pooled connection to %s failed: %s', host, err)
+                    h = None
+                    continue
+                if isinstance(err, OSError):
+                    raise urllib.error.URLError(err)
+                raise
+
+        if reused:
+            log.debug('Reusing connection to %s', host)
+
+        def release(reusable):
+            if hasattr(h, 'save_session'):
+                h.save_session()
+            if reusable:
+                pool.put(key, h)
+            else:
+                h.close()
+
+        r.release = release
+        r.url = req.get_full_url()
+        r.msg = r.reason
+        return r
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, urllib.request.HTTPHandler):
+    """
+    An HTTP handler which reuses connections from the pool
+    """
+
+    def http_open(self, req):
+        return self._open_pooled(http.client.HTTPConnection, req, ('http',))
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, urllib.request.HTTPSHandler):
+    """
+    An HTTPS handler which reuses connections from the pool
+    """
+
+    def __init__(self, verify=True):
+        """
+        verify: Whether certificates are verified, this selects the shared
+          SSL context, and connections are only shared between handlers with
+          the same setting
+        """
+        urllib.request.HTTPSHandler.__init__(
+            self, context=ssl_context(verify))
+        self.verify = verify
+
+    def https_open(self, req):
+        return self._open_pooled(
+            ResumingHTTPSConnection, req, ('https', self.verify),
+            context=self._context)
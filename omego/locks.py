@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from builtins import object
+import ctypes
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+log = logging.getLogger("omego.locks")
+
+
+# Windows process access rights and exit codes
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+ERROR_ACCESS_DENIED = 5
+STILL_ACTIVE = 259
+
+
+def _pid_alive_windows(pid):
+    # os.kill() on Windows sends CTRL_C_EVENT or terminates the process so
+    # can't be used to check whether it exists
+    kernel32 = ctypes.windll.kernel32
+    handle = kernel32.OpenProcess(
+        PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+    if not handle:
+        # The process exists but belongs to another user
+        return kernel32.GetLastError() == ERROR_ACCESS_DENIED
+    try:
+        code = ctypes.c_ulong()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+            return True
+        return code.value == STILL_ACTIVE
+    finally:
+        kernel32.CloseHandle(handle)
+
+
+def _pid_alive(pid):
+    if os.name == 'nt':
+        return _pid_alive_windows(pid)
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class FileLock(object):
+    """
+    A lock shared between processes, which may be on different hosts if the
+    lock file is on a shared filesystem. The lock file records its owner and
+    is touched periodically whilst the lock is held, so a lock left behind
+    by a process that crashed is detected and broken: either because the
+    owner is on this host and no longer running, or because the lock hasn't
+    been touched for stale seconds.
+    """
+
+    def __init__(self, path, stale=60, poll=0.5):
+        """
+        path: The lock file
+        stale: The number of seconds after which a lock that hasn't been
+          touched is considered abandoned
+        poll: The interval in seconds between attempts to take the lock
+        """
+        self.path = path
+        self.stale = stale
+        self.poll = poll
+        self.owner = {'host': socket.gethostname(), 'pid': os.getpid()}
+        self.waited = False
+        self.record = None
+        self._stop = None
+        self._heartbeat = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _create(self):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        self.record = dict(self.owner, time=time.time())
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.record, f)
+        return True
+
+    def _read_owner(self):
+        """
+        Return the contents and modification time of the lock file, or
+        (None, None) if it doesn't exist
+        """
+        try:
+            with open(self.path) as f:
+                content = f.read()
+            mtime = os.stat(self.path).st_mtime
+        except (IOError, OSError):
+            return None, None
+        return content, mtime
+
+    def is_stale(self, content, mtime):
+        if time.time() - mtime > self.stale:
+            return True
+        try:
+            owner = json.loads(content)
+        except ValueError:
+            # The owner may not have written the file yet
+            return False
+        return (owner.get('host') == self.owner['host'] and
+                not _pid_alive(owner.get('pid')))
+
+    def _break(self, content):
+        """
+        Remove a stale lock, unless it has been replaced since it was read
+        """
+        broken = '%s.%s-%d.stale' % (
+            self.path, self.owner['host'], self.owner['pid'])
+        try:
+            os.rename(self.path, broken)
+        except OSError:
+            return
+        with open(broken) as f:
+            replaced = f.read() != content
+        if replaced:
+            # Another process broke the lock first and took it, put it back
+            try:
+                os.link(broken, self.path)
+            except OSError:
+                pass
+        else:
+            log.warning('Breaking stale lock %s: %s', self.path, content)
+        os.unlink(broken)
+
+    def acquire(self, blocking=True):
+        """
+        Take the lock, waiting for any other owner to release it
+        blocking: If False return immediately if the lock is held
+        return: True if the lock was taken
+        """
+        while not self._create():
+            content, mtime = self._read_owner()
+            if content is None:
+                continue
+            if self.is_stale(content, mtime):
+                self._break(content)
+                continue
+            if not blocking:
+                return False
+            if not self.waited:
+                log.info('Waiting for lock %s held by %s', self.path, content)
+                self.waited = True
+            time.sleep(self.poll)
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._touch)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+        return True
+
+    def _touch(self):
+        while not self._stop.wait(self.stale / 4):
+            try:
+                os.utime(self.path, None)
+            except OSError as e:
+                log.warning('Failed to refresh lock %s: %s', self.path, e)
+
+    def release(self):
+        """
+        Release the lock. The lock file is only removed if it still belongs
+        to this lock, it may have been broken and taken by another process
+        if this one stopped refreshing it.
+        """
+        self._stop.set()
+        self._heartbeat.join()
+        content, mtime = self._read_owner()
+        try:
+            owner = json.loads(content) if content else None
+        except ValueError:
+            owner = None
+        if owner != self.record:
+            log.warning('Lock %s is no longer held by this process: %s',
+                        self.path, content)
+            return
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
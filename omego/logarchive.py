@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Incremental archiving of server logs. A manifest kept next to the archives
+records which archive holds the latest version of each log file, so each
+archive only needs to contain the files which are new or have changed.
+"""
+
+from __future__ import absolute_import
+from builtins import object
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+import zipfile
+
+from yaclifw.framework import Command, Stop
+
+from . import fileutils
+from .cache import hash_file
+
+log = logging.getLogger("omego.logarchive")
+
+MANIFEST = 'omego-logs-manifest.json'
+
+
+class LogManifest(object):
+    """
+    The archived log files. files is a dictionary of
+    {path: {size, mtime, sha256, archive, member}} where archive is the name
+    of an archive in the same directory as the manifest and member is the
+    name of the file in that archive, this may differ from path if a
+    rotated log was renamed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.archives = []
+        self.files = {}
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a manifest, returns an empty manifest if it doesn't exist
+        """
+        manifest = cls(filename)
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    d = json.load(f)
+                manifest.archives = d['archives']
+                manifest.files = d['files']
+            except (ValueError, KeyError) as e:
+                raise fileutils.FileException(
+                    'Invalid log manifest: %s' % e, filename)
+        return manifest
+
+    def save(self):
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump({
+                'version': 1,
+                'archives': self.archives,
+                'files': self.files,
+            }, f, indent=1, sort_keys=True)
+        os.replace(tmpname, self.filename)
+
+    def forget(self, archive):
+        """
+        Remove an archive which is about to be overwritten
+        """
+        if archive not in self.archives:
+            return
+        log.warning('Replacing %s, files only archived in it are lost',
+                    archive)
+        self.archives.remove(archive)
+        self.files = dict((k, v) for (k, v) in self.files.items()
+                          if v['archive'] != archive)
+
+
+def manifest_path(archive):
+    """
+    The manifest for an archive, this is shared by all archives in the
+    same directory
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(archive)), MANIFEST)
+
+
+def archive_incremental(archive, paths, strip_prefix='', **kwargs):
+    """
+    Archive the files which aren't in an earlier archive listed in the
+    manifest. Files are compared by size and modification time, and by
+    SHA-256 if these differ so that renamed files aren't archived again.
+    archive: The archive to be created, see fileutils.archive
+    paths, strip_prefix: See fileutils.archive
+    kwargs: Additional arguments passed to fileutils.archive
+    return: The archive, or None if there were no new files
+    """
+    manifest = LogManifest.load(manifest_path(archive))
+    name = os.path.basename(archive)
+    manifest.forget(name)
+
+    byhash = dict((v['sha256'], v) for v in manifest.files.values())
+    new = []
+    unchanged = 0
+    for f, arcname in fileutils.list_archive_files(paths, strip_prefix):
+        st = os.stat(f)
+        entry = manifest.files.get(arcname)
+        if entry and entry['size'] == st.st_size and (
+                entry['mtime'] == st.st_mtime):
+            unchanged += 1
+            continue
+        digest = hash_file(f)
+        entry = {'size': st.st_size, 'mtime': st.st_mtime,
+                 'sha256': digest}
+        if digest in byhash:
+            entry['archive'] = byhash[digest]['archive']
+            entry['member'] = byhash[digest]['member']
+            unchanged += 1
+        else:
+            entry['archive'] = name
+            entry['member'] = arcname
+            new.append(f)
+        manifest.files[arcname] = entry
+        byhash[digest] = entry
+
+    log.info('Archiving %d new or changed log files, %d already archived',
+             len(new), unchanged)
+    if new:
+        fileutils.archive(archive, new, strip_prefix, **kwargs)
+        manifest.archives.append(name)
+    manifest.save()
+    if new:
+        return archive
+    return None
+
+
+def _extract_member(src, path, mtime):
+    with open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.utime(path, (mtime, mtime))
+
+
+def restore(manifest, destdir):
+    """
+    Restore the latest version of every file in a manifest
+    manifest: The manifest file
+    destdir: The directory the files are restored into
+    return: The number of files restored
+    """
+    m = LogManifest.load(manifest)
+    if not m.files:
+        raise fileutils.FileException('No archived logs', manifest)
+    fileutils.check_extracted_paths(list(m.files.keys()))
+    archivedir = os.path.dirname(os.path.abspath(manifest))
+
+    # {archive: {member: [path, ...]}}
+    members = {}
+    for path, entry in m.files.items():
+        members.setdefault(entry['archive'], {}).setdefault(
+            entry['member'], []).append(path)
+
+    n = 0
+    for archive, wanted in sorted(members.items()):
+        log.info('Restoring %d files from %s', sum(
+            len(p) for p in wanted.values()), archive)
+        archive = os.path.join(archivedir, archive)
+        for member, path, src in _read_members(archive, wanted):
+            target = os.path.join(destdir, path)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            _extract_member(src, target, m.files[path]['mtime'])
+            n += 1
+    missing = sum(len(p) for w in members.values() for p in w.values()) - n
+    if missing:
+        raise fileutils.FileException(
+            '%d files were not found in the archives' % missing, manifest)
+    return n
+
+
+def _read_members(archive, wanted):
+    """
+    Generate (member, path, fileobj) for the members of an archive which
+    are restored as each path in wanted[member]. Tar archives are read as a
+    stream since compressed tars don't support random access.
+    """
+    for ext, compressor in fileutils.TAR_FORMATS:
+        if archive.endswith(ext):
+            break
+    else:
+        with zipfile.ZipFile(archive) as z:
+            for member, paths in sorted(wanted.items()):
+                for path in paths:
+                    with z.open(member) as src:
+                        yield member, path, src
+        return
+
+    with open(archive, 'rb') as f:
+        if compressor is fileutils._zstd_compressor:
+            if not fileutils.zstandard:
+                raise fileutils.FileException(
+                    'The zstandard module is required', archive)
+            f = fileutils.zstandard.ZstdDecompressor().stream_reader(f)
+        with tarfile.open(fileobj=f, mode='r|*') as t:
+            for info in t:
+                if info.name not in wanted:
+                    continue
+                paths = wanted[info.name]
+                if len(paths) == 1:
+                    yield info.name, paths[0], t.extractfile(info)
+                else:
+                    # A stream can only be read once
+                    data = t.extractfile(info).read()
+                    for path in paths:
+                        yield info.name, path, io.BytesIO(data)
+
+
+class RestoreLogsCommand(Command):
+    """
+    Restore the latest version of all logs archived by
+    install --archivelogs-incremental
+    """
+
+    NAME = "restore-logs"
+
+    def __init__(self, sub_parsers):
+        super(RestoreLogsCommand, self).__init__(sub_parsers)
+        self.parser.add_argument(
+            "manifest", help="The manifest %s in the directory containing "
+            "the log archives" % MANIFEST)
+        self.parser.add_argument(
+            "destdir", help="Restore the logs into this directory")
+
+    def __call__(self, args):
+        super(RestoreLogsCommand, self).__call__(args)
+        self.configure_logging(args)
+        try:
+            n = restore(args.manifest, args.destdir)
+        except (IOError, OSError, fileutils.FileException) as e:
+            raise Stop(70, 'Failed to restore logs: %s' % e)
+        log.info('Restored %d files to %s', n, args.destdir)
@@ -34,8 +34,10 @@ from yaclifw.framework import main, Stop
 from .artifacts import DownloadCommand
 from .convert import ConvertCommand
 from .db import DbCommand
+from .logarchive import RestoreLogsCommand
 from .upgrade import InstallCommand
 from .upgrade import UpgradeCommand
+from .verify import VerifyCommand
 from .version import Version
 
 
@@ -51,6 +53,8 @@ def entry_point():
             (ConvertCommand.NAME, ConvertCommand),
             (DownloadCommand.NAME, DownloadCommand),
             (DbCommand.NAME, DbCommand),
+            (RestoreLogsCommand.NAME, RestoreLogsCommand),
+            (VerifyCommand.NAME, VerifyCommand),
             (Version.NAME, Version)])
     except Stop as stop:
         if stop.rc != 0:
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+import logging
+import re
+import time
+from http.client import HTTPException
+
+from . import aio
+from . import fileutils
+from .cache import MirrorCache
+
+log = logging.getLogger("omego.mirrors")
+
+# The number of bytes requested when probing a mirror
+PROBE_BYTES = 64 * 1024
+# Mirrors are ranked by the estimated time to fetch this many bytes, so
+# latency dominates for nearby mirrors and throughput for distant ones
+REFERENCE_BYTES = 1024 * 1024
+
+
+def parse_mirrors(s):
+    """
+    Split a comma or whitespace separated list of base URLs
+    """
+    return [m.rstrip('/') for m in re.split(r'[,\s]+', s) if m]
+
+
+def probe(url, timeout=10, nbytes=PROBE_BYTES):
+    """
+    Measure the latency and throughput of a mirror by requesting the first
+    nbytes of its base URL
+    return: A dictionary {url, latency, throughput} in seconds and bytes per
+      second, or {url, error} if the mirror is unavailable
+    """
+    start = time.time()
+    try:
+        r = fileutils.open_url(url + '/', headers={
+            'Range': 'bytes=0-%d' % (nbytes - 1)}, timeout=timeout)
+        try:
+            latency = time.time() - start
+            data = r.read(nbytes)
+            elapsed = time.time() - start - latency
+        finally:
+            r.close()
+    except (IOError, OSError, HTTPException, ValueError) as e:
+        # A mirror that doesn't speak HTTP or drops the connection is ranked
+        # last rather than aborting the ranking
+        log.debug('Probe of %s failed: %s', url, e)
+        return {'url': url, 'error': str(e)}
+    return {
+        'url': url,
+        'latency': latency,
+        'throughput': len(data) / max(elapsed, 1e-3),
+    }
+
+
+def score(result):
+    """
+    The estimated time to fetch REFERENCE_BYTES from a probed mirror
+    """
+    return result['latency'] + REFERENCE_BYTES / max(
+        result['throughput'], 1)
+
+
+def rank(mirrors, cachedir='auto', ttl=3600, timeout=10):
+    """
+    Order mirrors with the fastest first. Mirrors are probed concurrently,
+    those which failed are placed last in their original order.
+    mirrors: A list of base URLs
+    cachedir: The omego cache directory used to store the ranking, None to
+      disable the cache
+    ttl: The number of seconds for which a cached ranking is used, 0 to
+      always probe
+    timeout: The timeout in seconds for each probe
+    return: The ordered list of base URLs
+    """
+    if len(mirrors) < 2:
+        return list(mirrors)
+
+    cache = None
+    if cachedir and ttl:
+        cache = MirrorCache(cachedir)
+        ranking = cache.get(mirrors, ttl)
+        if ranking:
+            log.debug('Using cached mirror ranking: %s', ranking)
+            return [r['url'] for r in ranking]
+
+    results = aio.run(aio.gather(
+        [aio.call(probe, m, timeout) for m in mirrors]))
+    healthy = sorted((r for r in results if 'error' not in r), key=score)
+    failed = [r for r in results if 'error' in r]
+    for r in healthy:
+        log.info('Mirror %s: latency %.0f ms, %.1f KiB/s', r['url'],
+                 r['latency'] * 1000, r['throughput'] / 1024)
+    for r in failed:
+        log.warning('Mirror %s is unavailable: %s', r['url'], r['error'])
+    ranking = healthy + failed
+    # Don't remember a ranking where every mirror failed
+    if cache and healthy:
+        cache.put(mirrors, ranking)
+    return [r['url'] for r in ranking]
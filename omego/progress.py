@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from builtins import object
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+log = logging.getLogger("omego.progress")
+
+
+class EventStream(object):
+    """
+    Writes progress events as JSON lines to a file descriptor so that other
+    processes can monitor downloads, extraction and archiving
+    """
+
+    def __init__(self, fd=None):
+        self.lock = threading.Lock()
+        self.f = None
+        self.configure(fd)
+
+    def configure(self, fd=None):
+        """
+        fd: The file descriptor events are written to. If None
+          OMEGO_PROGRESS_FD is used, if neither is set events are disabled.
+        """
+        if fd is None:
+            fd = os.getenv('OMEGO_PROGRESS_FD')
+        with self.lock:
+            self.f = None
+            if fd is None or fd == '':
+                return
+            try:
+                self.f = os.fdopen(int(fd), 'w', closefd=False)
+            except (ValueError, OSError) as e:
+                log.warning('Unable to write progress events to %s: %s',
+                            fd, e)
+
+    def emit(self, event, **fields):
+        if not self.f:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            try:
+                self.f.write(line + '\n')
+                self.f.flush()
+            except (IOError, OSError) as e:
+                log.warning('Disabling progress events: %s', e)
+                self.f = None
+
+
+events = EventStream()
+
+
+def format_bytes(n):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TiB'
+    if unit == 'bytes':
+        return '%d %s' % (n, unit)
+    return '%.1f %s' % (n, unit)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress(object):
+    """
+    Reports the progress of an operation on a number of bytes, at most once
+    per interval: as a bar printed to stdout showing the throughput and the
+    estimated time remaining, and as events on the event stream. When it is
+    used as a context manager a done or error event is sent on exit.
+    update() and add() may be called from multiple threads.
+    """
+
+    def __init__(self, operation, name, total, ndots=0, initial=0,
+                 interval=1.0):
+        """
+        operation: The type of operation, e.g. 'download'
+        name: The URL or file being processed
+        total: The total number of bytes, None if it isn't known
+        ndots: The length of the progress bar, use 0 to disable
+        initial: The number of bytes that were already processed, e.g. by an
+          earlier download that is being resumed
+        interval: The minimum time in seconds between reports
+        """
+        self.operation = operation
+        self.name = name
+        self.total = total
+        self.ndots = ndots
+        self.initial = initial
+        self.current = initial
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = None
+        self.reported = None
+        self.reported_bytes = initial
+        self.rate = 0
+        self.ndrawn = 0
+        self.drawn = False
+        self.tty = sys.stdout.isatty()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.done()
+        else:
+            self.error(exc_value)
+
+    def _emit(self, event, **fields):
+        events.emit(event, operation=self.operation, name=self.name,
+                    total=self.total, current=self.current, **fields)
+
+    def start(self):
+        self.started = self.reported = time.time()
+        self._emit('start')
+
+    def update(self, current):
+        """
+        Set the number of bytes processed
+        """
+        with self.lock:
+            self._update(current)
+
+    def add(self, n):
+        """
+        Add to the number of bytes processed
+        """
+        with self.lock:
+            self._update(self.current + n)
+
+    def _update(self, current):
+        self.current = current
+        now = time.time()
+        if self.started is None:
+            self.started = self.reported = now
+        # The final report is made by done()
+        if now - self.reported >= self.interval and (
+                self.total is None or current < self.total):
+            self._report(now)
+
+    def elapsed(self, now=None):
+        return (now or time.time()) - self.started
+
+    def average(self, now=None):
+        """
+        The average throughput in bytes per second since the start
+        """
+        elapsed = self.elapsed(now)
+        if elapsed <= 0:
+            return 0
+        return (self.current - self.initial) / elapsed
+
+    def _report(self, now, final=False):
+        if now > self.reported:
+            self.rate = (self.current - self.reported_bytes) / (
+                now - self.reported)
+        # Otherwise this immediately follows another report
+        rate = self.rate
+        average = self.average(now)
+        eta = None
+        if average > 0 and self.total is not None:
+            eta = max(self.total - self.current, 0) / average
+        self.reported = now
+        self.reported_bytes = self.current
+        self._emit('progress', rate=rate, average=average, eta=eta,
+                   elapsed=self.elapsed(now))
+        if not self.ndots:
+            return
+        if self.total is None:
+            # Only the amount transferred can be shown
+            n = 0
+            line = '%s %s/s (average %s/s)' % (
+                format_bytes(self.current), format_bytes(rate),
+                format_bytes(average))
+        else:
+            n = self.ndots
+            if self.total:
+                n = min(self.current * self.ndots // self.total, self.ndots)
+            line = '%s%s %s/%s %s/s (average %s/s)' % (
+                '*' * n, ' ' * (self.ndots - n), format_bytes(self.current),
+                format_bytes(self.total), format_bytes(rate),
+                format_bytes(average))
+        # Redraw in place on a terminal, otherwise only print a new line
+        # when the bar has grown
+        if not self.tty and n == self.ndrawn and not final:
+            return
+        self.ndrawn = n
+        if final:
+            line += ' in %s' % format_duration(self.elapsed(now))
+        elif eta is not None:
+            line += ' ETA %s' % format_duration(eta)
+        if self.tty:
+            print('\r' + line + '\033[K', end='\n' if final else '')
+            sys.stdout.flush()
+        else:
+            print(line)
+        self.drawn = not final
+
+    def done(self):
+        with self.lock:
+            now = time.time()
+            if self.started is None:
+                self.started = self.reported = now
+            self._report(now, True)
+            self._emit('done', elapsed=self.elapsed(now),
+                       average=self.average(now))
+
+    def error(self, e):
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            if self.tty and self.drawn:
+                print()
+            self._emit('error', error=str(e), elapsed=self.elapsed())
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import division
+from builtins import object
+import itertools
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from .cache import cache_dir
+from .locks import FileLock
+
+log = logging.getLogger("omego.scheduler")
+
+# Priority classes, lower values are started first
+PRIORITY_SERVER = 0
+PRIORITY_DEFAULT = 10
+
+
+def default_priority(filename):
+    """
+    Return the priority class of a download: servers are fetched before
+    clients and other artifacts
+    """
+    if re.search(r'OMERO\.server.*\.zip$', os.path.basename(filename)):
+        return PRIORITY_SERVER
+    return PRIORITY_DEFAULT
+
+
+class TokenBucket(object):
+    """
+    Limit the rate of a stream of bytes shared between threads
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        rate: The maximum average rate in bytes per second
+        burst: The maximum number of bytes that can be consumed at once
+          without waiting, default one second at the full rate
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """
+        Remove n tokens from the bucket, sleeping until they're available.
+        Requests larger than the bucket may leave it in debt.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SlotPool(object):
+    """
+    Transfer slots shared between processes, which may be on different hosts
+    if the directory is on a shared filesystem. Each slot is a FileLock.
+    Waiting transfers register themselves in the directory so that free
+    slots are taken by the highest priority waiters first.
+    """
+
+    def __init__(self, directory, slots, stale=60, poll=0.5):
+        """
+        directory: The directory holding the slot and waiter files
+        slots: The number of slots
+        stale: The number of seconds after which an abandoned slot or waiter
+          is ignored
+        poll: The interval in seconds between attempts to take a slot
+        """
+        self.directory = directory
+        self.slots = slots
+        self.stale = stale
+        self.poll = poll
+        self.counter = itertools.count()
+
+    def _waiter_priorities(self):
+        """
+        Return the priorities of all waiting transfers, removing abandoned
+        waiter files
+        """
+        priorities = []
+        for name in os.listdir(self.directory):
+            if not name.startswith('waiting-'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if time.time() - os.stat(path).st_mtime > self.stale:
+                    os.unlink(path)
+                    continue
+            except OSError:
+                continue
+            priorities.append(int(name.split('-')[1]))
+        return priorities
+
+    def acquire(self, priority):
+        """
+        Wait for a free slot
+        priority: The priority class of the transfer
+        return: The FileLock of the slot, which must be released
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        waiter = os.path.join(self.directory, 'waiting-%d-%s-%d-%d' % (
+            priority, socket.gethostname(), os.getpid(), next(self.counter)))
+        open(waiter, 'w').close()
+        try:
+            while True:
+                if min(self._waiter_priorities() + [priority]) >= priority:
+                    for n in range(self.slots):
+                        slot = FileLock(
+                            os.path.join(self.directory, 'slot-%d.lock' % n),
+                            stale=self.stale)
+                        if slot.acquire(blocking=False):
+                            return slot
+                time.sleep(self.poll)
+                # Show other processes this waiter is still alive
+                os.utime(waiter, None)
+        finally:
+            os.unlink(waiter)
+
+
+class Transfer(object):
+    """
+    A scheduled transfer, update() must be called with the number of bytes
+    received
+    """
+
+    def __init__(self, scheduler, url, priority):
+        self.scheduler = scheduler
+        self.url = url
+        self.priority = priority
+        self.nbytes = 0
+        self.start = None
+        self.end = None
+        self.slot = None
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.nbytes += n
+        if self.scheduler.bucket:
+            self.scheduler.bucket.consume(n)
+
+    def elapsed(self):
+        return (self.end or time.time()) - self.start
+
+    def throughput(self):
+        """
+        The achieved throughput in bytes per second
+        """
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0
+        return self.nbytes / elapsed
+
+    def __enter__(self):
+        self.scheduler._acquire(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.end = time.time()
+        self.scheduler._release(self)
+        log.info('Transferred %d bytes from %s in %.1fs (%.1f KiB/s)',
+                 self.nbytes, self.url, self.elapsed(),
+                 self.throughput() / 1024)
+
+
+class DownloadScheduler(object):
+    """
+    Limits the number of concurrent downloads and their total bandwidth.
+    Downloads waiting for a slot are started in order of priority.
+
+    The number of downloads is limited across all processes using the same
+    slot directory, the bandwidth is limited for this process only.
+    """
+
+    def __init__(self, max_transfers=0, bandwidth=0, slotdir=None):
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.active = 0
+        self.counter = itertools.count()
+        self.completed = []
+        self.configure(max_transfers, bandwidth, slotdir)
+
+    def configure(self, max_transfers=None, bandwidth=None, slotdir=None):
+        """
+        max_transfers: The maximum number of concurrent transfers, 0 for
+          unlimited. If None OMEGO_MAX_DOWNLOADS is used.
+        bandwidth: The maximum bandwidth of this process in KiB/s, 0 for
+          unlimited. If None OMEGO_DOWNLOAD_BANDWIDTH is used.
+        slotdir: The directory used to share transfer slots between
+          processes. If None OMEGO_DOWNLOAD_SLOTS is used, otherwise the
+          slots directory of the default omego cache.
+        """
+        if max_transfers is None:
+            max_transfers = int(os.getenv('OMEGO_MAX_DOWNLOADS', 0))
+        if bandwidth is None:
+            bandwidth = int(os.getenv('OMEGO_DOWNLOAD_BANDWIDTH', 0))
+        if slotdir is None:
+            slotdir = (os.getenv('OMEGO_DOWNLOAD_SLOTS') or
+                       cache_dir('auto', 'slots'))
+        with self.cond:
+            self.max_transfers = max_transfers
+            self.slots = None
+            if max_transfers:
+                self.slots = SlotPool(slotdir, max_transfers)
+            self.bucket = None
+            if bandwidth:
+                self.bucket = TokenBucket(bandwidth * 1024)
+            self.cond.notify_all()
+        log.debug('Maximum downloads: %s, bandwidth: %s KiB/s',
+                  max_transfers or 'unlimited', bandwidth or 'unlimited')
+
+    def transfer(self, url, priority=PRIORITY_DEFAULT):
+        """
+        Return a context manager which waits for a transfer slot
+        """
+        return Transfer(self, url, priority)
+
+    def _acquire(self, transfer):
+        entry = (transfer.priority, next(self.counter))
+        with self.cond:
+            self.waiting.append(entry)
+            if not self._ready(entry):
+                log.info('Waiting to download %s', transfer.url)
+            while not self._ready(entry):
+                self.cond.wait()
+            self.waiting.remove(entry)
+            self.active += 1
+            slots = self.slots
+            # Let the next waiter check whether it can also start
+            self.cond.notify_all()
+        if slots:
+            try:
+                transfer.slot = slots.acquire(transfer.priority)
+            except BaseException:
+                self._release(transfer, completed=False)
+                raise
+
+    def _ready(self, entry):
+        if self.max_transfers and self.active >= self.max_transfers:
+            return False
+        return entry == min(self.waiting)
+
+    def _release(self, transfer, completed=True):
+        if transfer.slot:
+            transfer.slot.release()
+            transfer.slot = None
+        with self.cond:
+            self.active -= 1
+            if completed:
+                self.completed.append(transfer)
+            self.cond.notify_all()
+
+
+scheduler = DownloadScheduler()
@@ -7,16 +7,21 @@ from past.builtins import basestring
 from builtins import object
 import argparse
 import copy
+import errno
 import os
 import shutil
 import tempfile
 import logging
 
 from .artifacts import Artifacts
+from .cache import ArtifactCache, TreeStore
 from .db import DbAdmin, DB_UPTODATE, DB_UPGRADE_NEEDED, DB_INIT_NEEDED
 from .external import External
 from yaclifw.framework import Command, Stop
 from . import fileutils
+from . import logarchive
+from .progress import events
+from .scheduler import scheduler
 from .env import (
     EnvDefault,
     DbParser,
@@ -24,6 +29,7 @@ from .env import (
     JenkinsParser,
     OmeroDeployParser,
     WINDOWS,
+    compression_level,
 )
 
 log = logging.getLogger("omego.upgrade")
@@ -144,6 +150,7 @@ class Install(object):
         Either downloads and/or unzips the server if necessary
         return: the directory of the unzipped server
         """
+        events.configure(self.args.progress_fd)
         if not self.args.server:
             if self.args.skipunzip:
                 raise Stop(0, 'Unzip disabled, exiting')
@@ -156,26 +163,84 @@ class Install(object):
             # TODO: Find a nicer way to do this?
             artifact_args = copy.copy(self.args)
             artifact_args.sym = ''
+            artifact_args.delta_from = self.delta_from()
             artifacts = Artifacts(artifact_args)
             server = artifacts.download('server')
         else:
+            checksums = None
+            if self.args.checksum:
+                checksums = fileutils.parse_checksum(self.args.checksum)
+            scheduler.configure(
+                self.args.max_downloads, self.args.download_bandwidth,
+                self.args.download_slots)
+            stream_unzip = None
+            if (self.args.stream_unzip and not self.args.skipunzip and
+                    not self.args.unzip_incremental and
+                    not self.args.unzip_store and
+                    not self.args.unzip_include and
+                    not self.args.unzip_exclude):
+                stream_unzip = {
+                    'match_dir': True, 'destdir': self.args.unzipdir,
+                    'workers': self.args.unzip_workers, 'manifest': True}
             progress = 0
             if self.args.verbose:
                 progress = 20
             ptype, server = fileutils.get_as_local_path(
                 self.args.server, self.args.overwrite, progress=progress,
                 httpuser=self.args.httpuser,
-                httppassword=self.args.httppassword)
-            if ptype == 'file':
+                httppassword=self.args.httppassword,
+                connections=self.args.download_connections,
+                resume=self.args.download_resume,
+                cachedir=self.args.cachedir, cachesize=self.args.cachesize,
+                checksums=checksums, stream_unzip=stream_unzip,
+                delta_from=self.delta_from(),
+                write_index=self.args.write_block_index)
+            if ptype == 'unzipped':
+                log.info('Unzipped %s', server)
+            elif ptype == 'file':
                 if self.args.skipunzip:
                     raise Stop(0, 'Unzip disabled, exiting')
                 log.info('Unzipping %s', server)
+                kwargs = {}
+                if self.args.unzip_store:
+                    kwargs['store'] = TreeStore(
+                        self.args.cachedir or 'auto',
+                        self.args.unzip_store_size)
+                    if self.args.cachedir:
+                        # Avoid hashing a zip from the download cache
+                        sha256 = ArtifactCache(self.args.cachedir).checksum(
+                            self.args.server, server)
+                        if sha256:
+                            kwargs['sha256'] = sha256
+                if self.args.unzip_include:
+                    kwargs['include'] = self.args.unzip_include
+                if self.args.unzip_exclude:
+                    kwargs['exclude'] = self.args.unzip_exclude
                 server = fileutils.unzip(
-                    server, match_dir=True, destdir=self.args.unzipdir)
+                    server, match_dir=True, destdir=self.args.unzipdir,
+                    workers=self.args.unzip_workers,
+                    incremental=self.args.unzip_incremental, manifest=True,
+                    **kwargs)
 
         log.debug('Server directory: %s', server)
         return server
 
+    def delta_from(self):
+        """
+        The local file used for delta downloads, 'auto' is the zip of the
+        current server if it was kept
+        """
+        if self.args.delta_from != 'auto':
+            return self.args.delta_from
+        try:
+            oldzip = self.readlink(self.args.sym) + '.zip'
+        except (IOError, OSError):
+            return None
+        if os.path.isfile(oldzip):
+            log.info('Using %s for delta downloads', oldzip)
+            return oldzip
+        return None
+
     def stop(self):
         try:
             log.info("Stopping server")
@@ -234,7 +299,15 @@ class Install(object):
             logdir = os.path.join(self.args.sym, 'var', 'log')
             archive = self.args.archivelogs
             log.info('Archiving logs to %s', archive)
-            fileutils.zip(archive, logdir, os.path.join(self.args.sym, 'var'))
+            kwargs = dict(workers=self.args.archivelogs_workers,
+                          level=self.args.archivelogs_level)
+            if self.args.archivelogs_incremental:
+                return logarchive.archive_incremental(
+                    archive, logdir, os.path.join(self.args.sym, 'var'),
+                    **kwargs)
+            fileutils.archive(
+                archive, logdir, os.path.join(self.args.sym, 'var'),
+                **kwargs)
             return archive
 
     def directories(self):
@@ -250,12 +323,25 @@ class Install(object):
             target = None
             targetzip = None
 
+        if self.args.dedup_old and target and not self.args.delete_old:
+            try:
+                fileutils.dedup_tree(self.dir, target, self.args.dedup_old,
+                                     subdirs=['lib'])
+            except (IOError, OSError, fileutils.FileException) as e:
+                log.error("Failed to deduplicate %s: %s", self.dir, e)
+
         if self.args.delete_old and target:
             try:
                 log.info("Deleting %s", target)
                 shutil.rmtree(target)
             except OSError as e:
                 log.error("Failed to delete %s: %s", target, e)
+            manifest = fileutils.extract_manifest_path(target)
+            try:
+                os.unlink(manifest)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    log.error("Failed to delete %s: %s", manifest, e)
 
         if not self.args.keep_old_zip and targetzip:
             try:
@@ -499,6 +585,26 @@ class InstallBaseCommand(Command):
         self.parser.add_argument(
             "--keep-old-zip", action="store_true",
             help="Don't delete the old server zip")
+        self.parser.add_argument(
+            "--dedup-old", choices=["hardlink", "reflink"],
+            help="Replace library files in the new server which are "
+            "identical to those in the old server with hardlinks, or "
+            "reflinks on a copy-on-write filesystem")
+        self.parser.add_argument(
+            "--archivelogs-workers", type=int, default=1,
+            help="Compress logs on this many parallel threads when using "
+            "--archivelogs (default 1)")
+        self.parser.add_argument(
+            "--archivelogs-level", type=compression_level, default=None,
+            help="Compression level used by --archivelogs, higher is "
+            "smaller but slower. 0-9 for zip, gzip and xz, 1-22 for zstd "
+            "(default depends on the format)")
+        self.parser.add_argument(
+            "--archivelogs-incremental", action="store_true",
+            help="Only archive logs which have changed since an earlier "
+            "archive in the same directory, recorded in %s. Use "
+            "'omego restore-logs' to restore all archived logs" %
+            logarchive.MANIFEST)
 
         # Record the values of these environment variables in a file
         envvars = "ICE_HOME PATH DYLD_LIBRARY_PATH LD_LIBRARY_PATH PYTHONPATH"
@@ -525,6 +631,14 @@ class InstallBaseCommand(Command):
                 log.debug("% 20s => %s" % (dest, replacement))
                 setattr(args, dest, replacement)
 
+        # Check before the server is stopped
+        if args.archivelogs and args.archivelogs_level is not None:
+            try:
+                fileutils.check_archive_level(
+                    args.archivelogs, args.archivelogs_level)
+            except ValueError as e:
+                self.parser.error(str(e))
+
         if args.dry_run:
             return
 
@@ -558,8 +672,10 @@ class InstallCommand(InstallBaseCommand):
             help="Initialise or upgrade the database if necessary")
         self.parser.add_argument(
             "--archivelogs", default=None, help=(
-                "If a logs directory exists archive to this zip file, "
-                "overwriting if it exists"))
+                "If a logs directory exists archive to this file, "
+                "overwriting if it exists. The format is chosen from the "
+                "extension: .tar.zst (requires zstandard), .tar.xz, "
+                ".tar.gz, .tar or zip"))
 
 
 class UpgradeCommand(InstallBaseCommand):
@@ -575,5 +691,6 @@ class UpgradeCommand(InstallBaseCommand):
             "--upgradedb", action="store_true", help="Upgrade the database")
         self.parser.add_argument(
             "--archivelogs", default=None, help=(
-                "Archive the logs directory to this zip file, "
-                "overwriting if it exists"))
+                "Archive the logs directory to this file, overwriting if it "
+                "exists. The format is chosen from the extension as for "
+                "install"))
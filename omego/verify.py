@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+"""
+Verification of unzipped trees against the manifest written when they were
+extracted, see fileutils.write_extract_manifest
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import json
+import logging
+import os
+import stat
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from yaclifw.framework import Command, Stop
+
+from . import fileutils
+from .progress import Progress
+
+log = logging.getLogger("omego.verify")
+
+# The types of difference between a tree and its manifest
+DRIFT = ('missing', 'modified', 'mode', 'added')
+
+
+def load_manifest(filename):
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except ValueError as e:
+        raise fileutils.FileException('Invalid manifest: %s' % e, filename)
+    if not isinstance(manifest, dict) or 'files' not in manifest:
+        raise fileutils.FileException('Invalid manifest', filename)
+    return manifest
+
+
+def _crc32(filename, progress, blocksize=1024 * 1024):
+    crc = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            crc = zlib.crc32(block, crc)
+            progress.add(len(block))
+    return crc & 0xFFFFFFFF
+
+
+def verify_tree(tree, manifest=None, workers=4, fast=False):
+    """
+    Compare an unzipped tree with its manifest
+    tree: The directory to be verified
+    manifest: The manifest, default is the one written next to the tree
+    workers: Hash files on this many parallel threads
+    fast: If True only hash files whose modification time has changed,
+      otherwise hash all files
+    return: A dictionary of sorted lists of paths relative to tree, keyed by
+      the type of difference:
+      'missing': Files in the manifest which don't exist
+      'modified': Files whose type, size or contents differ
+      'mode': Files whose permissions differ
+      'added': Files which aren't in the manifest
+    """
+    if not manifest:
+        manifest = fileutils.extract_manifest_path(tree)
+    files = load_manifest(manifest)['files']
+    drift = dict((k, []) for k in DRIFT)
+
+    check = []
+    for path, entry in files.items():
+        try:
+            st = os.lstat(os.path.join(tree, path))
+        except OSError:
+            drift['missing'].append(path)
+            continue
+        if not stat.S_ISREG(st.st_mode) or st.st_size != entry['size']:
+            drift['modified'].append(path)
+            continue
+        if st.st_mode & 0o7777 != entry['mode']:
+            drift['mode'].append(path)
+        if not fast or st.st_mtime != entry['mtime']:
+            check.append(path)
+
+    # Largest first to balance the workers
+    check.sort(key=lambda p: files[p]['size'], reverse=True)
+    with Progress('verify', tree, sum(
+            files[p]['size'] for p in check)) as progress:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            crcs = executor.map(lambda p: _crc32(
+                os.path.join(tree, p), progress), check)
+            for path, crc in zip(check, crcs):
+                if crc != files[path]['crc32']:
+                    drift['modified'].append(path)
+
+    for root, dirs, filenames in os.walk(tree):
+        for name in filenames:
+            path = os.path.relpath(os.path.join(root, name), tree)
+            if path not in files:
+                drift['added'].append(path)
+
+    for paths in drift.values():
+        paths.sort()
+    log.info('Verified %s: %d files, %d hashed, %s', tree, len(files),
+             len(check), ', '.join(
+                 '%d %s' % (len(drift[k]), k) for k in DRIFT))
+    return drift
+
+
+class VerifyCommand(Command):
+    """
+    Check whether an unzipped server or other artifact still matches the
+    zip it was extracted from
+    """
+
+    NAME = "verify"
+
+    def __init__(self, sub_parsers):
+        super(VerifyCommand, self).__init__(sub_parsers)
+        self.parser.add_argument(
+            "tree", help="The unzipped directory, e.g. OMERO.server-5.6.0")
+        self.parser.add_argument(
+            "--manifest", help="The manifest written when the tree was "
+            "unzipped, default is the tree name with the suffix %s" %
+            fileutils.EXTRACT_MANIFEST_SUFFIX)
+        self.parser.add_argument(
+            "--fast", action="store_true",
+            help="Only hash files whose size or modification time changed")
+        self.parser.add_argument(
+            "--workers", type=int, default=4,
+            help="Hash files on this many parallel threads (default 4)")
+
+    def __call__(self, args):
+        super(VerifyCommand, self).__call__(args)
+        self.configure_logging(args)
+        try:
+            drift = verify_tree(args.tree, args.manifest, args.workers,
+                                args.fast)
+        except (IOError, OSError, fileutils.FileException) as e:
+            raise Stop(80, 'Failed to verify %s: %s' % (args.tree, e))
+        n = 0
+        for kind in DRIFT:
+            for path in drift[kind]:
+                print('%s: %s' % (kind, path))
+                n += 1
+        if n:
+            raise Stop(81, '%d files differ from the manifest' % n)
+        log.info('%s matches its manifest', args.tree)
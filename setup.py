@@ -123,6 +123,10 @@ setup(name='omego',
           'future',
           'yaclifw>=0.1.1'
       ],
+      extras_require={
+          # Compress archived logs with zstd
+          'zstd': ['zstandard'],
+      },
 
       # Using global variables
       long_description=LONG_DESCRIPTION,
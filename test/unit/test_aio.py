@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from builtins import object
+import asyncio
+import pytest
+
+from omego import aio
+from omego import fileutils
+
+
+class TestAio(object):
+
+    def test_wrappers(self, monkeypatch):
+        calls = []
+
+        def mock(name):
+            def f(*args, **kwargs):
+                calls.append((name, args, kwargs))
+                return name
+            return f
+
+        for name in ('open_url', 'dereference_url', 'read', 'download'):
+            monkeypatch.setattr(fileutils, name, mock(name))
+
+        async def requests():
+            return await aio.gather([
+                aio.open_url('a', method='HEAD'),
+                aio.dereference_url('b'),
+                aio.read('c', httpuser='u', httppassword='p'),
+                aio.download('d', 'e', resume=True),
+            ])
+
+        assert aio.run(requests()) == [
+            'open_url', 'dereference_url', 'read', 'download']
+        assert sorted(calls) == [
+            ('dereference_url', ('b',), {}),
+            ('download', ('d', 'e'), {'resume': True}),
+            ('open_url', ('a',), {'method': 'HEAD'}),
+            ('read', ('c',), {
+                'cache': None, 'httpuser': 'u', 'httppassword': 'p'}),
+        ]
+
+    @pytest.mark.parametrize('results', [
+        [1, 2, 3], [None, 2, 3], [None, None, 3], [None, 2, None]])
+    def test_first_success(self, results):
+        async def f(n):
+            # Later coroutines finish first
+            await asyncio.sleep(0.01 * (3 - n))
+            if results[n] is None:
+                raise KeyError(n)
+            return results[n]
+
+        expected = [r for r in results if r is not None][0]
+        assert aio.run(aio.first_success(
+            [f(n) for n in range(3)], KeyError)) == expected
+
+    def test_first_success_fails(self):
+        async def f(n):
+            raise KeyError(n)
+
+        with pytest.raises(KeyError) as excinfo:
+            aio.run(aio.first_success([f(n) for n in range(3)], KeyError))
+        assert excinfo.value.args == (2,)
+
+        async def g():
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            aio.run(aio.first_success([g()], KeyError))
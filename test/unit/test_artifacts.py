@@ -22,7 +22,11 @@
 from builtins import str
 from builtins import object
 import pytest
+import socket
+import time
+from http.client import BadStatusLine, IncompleteRead
 from mox3 import mox
+from urllib.error import URLError
 
 from yaclifw.framework import Stop
 from omego.artifacts import ArtifactException, ArtifactsList
@@ -31,6 +35,9 @@ from omego.artifacts import Artifacts, JenkinsArtifacts, ReleaseArtifacts
 # with different versions
 from omego.artifacts import XML
 from omego import fileutils
+from omego import mirrors
+
+ACCEPT = {'Accept-Encoding': fileutils.ACCEPT_ENCODING}
 
 
 class TestArtifactsList(object):
@@ -102,6 +109,7 @@ class MockUrl(object):
 
     def __init__(self, matrix):
         self.code = 200
+        self.headers = {}
         self.matrix = matrix
         self.url = self.unlabelledurl if matrix else self.labelledurl
 
@@ -135,6 +143,7 @@ class MockDownloadUrl(object):
 
     def __init__(self, page):
         self.code = 200
+        self.headers = {}
         if page:
             self.url = self.pageurl
         else:
@@ -170,8 +179,27 @@ class Args(object):
         self.overwrite = 'error'
         self.httpuser = MockAuth.httpuser
         self.httppassword = MockAuth.httppassword
+        self.download_connections = 1
+        self.download_resume = False
+        self.cachedir = None
+        self.cachesize = 4096
+        self.checksum = None
+        self.stream_unzip = False
+        self.unzip_workers = 1
+        self.unzip_incremental = False
+        self.unzip_store = False
+        self.unzip_include = None
+        self.unzip_exclude = None
+        self.delta_from = None
+        self.progress_fd = None
+        self.write_block_index = False
+        self.max_downloads = None
+        self.download_bandwidth = None
+        self.download_slots = None
+        self.unzip_store_size = 4096
         self.branch = 'TEST-build'
         self.downloadurl = MockDownloadUrl.downloadurl
+        self.mirror_ttl = 3600
         self.sym = None
 
 
@@ -192,12 +220,12 @@ class TestJenkinsArtifacts(MoxBase):
         self.mox.StubOutWithMock(fileutils, 'open_url')
         if matrix:
             fileutils.open_url(
-                MockUrl.unlabelledurl + 'api/xml',
+                MockUrl.unlabelledurl + 'api/xml', headers=ACCEPT,
                 httpuser=MockAuth.httpuser,
                 httppassword=MockAuth.httppassword).AndReturn(
                 MockUrl(True))
         fileutils.open_url(
-            MockUrl.labelledurl + 'api/xml',
+            MockUrl.labelledurl + 'api/xml', headers=ACCEPT,
             httpuser=MockAuth.httpuser,
             httppassword=MockAuth.httppassword).AndReturn(
             MockUrl(False))
@@ -247,6 +275,57 @@ class TestJenkinsArtifacts(MoxBase):
 
         self.mox.VerifyAll()
 
+    def test_find_fingerprints(self):
+        a = self.partial_mock_artifacts(False)
+        url = 'http://example.org/artifact/a/OMERO.server-0.0.0.zip'
+        root = XML(
+            '<root><fingerprint><fileName>OMERO.server-0.0.0.zip</fileName>'
+            '<hash>abc</hash></fingerprint></root>')
+        a.find_fingerprints(root, [url])
+        assert a.get_checksums(url) == {'md5': 'abc'}
+        assert a.get_checksums(url + '.other') == {}
+
+    def test_get_checksums_files(self, monkeypatch):
+        a = self.partial_mock_artifacts(False)
+        url = 'http://example.org/artifact/a/OMERO.server-0.0.0.zip'
+        a.checksumfiles[url] = [url + '.sha256', url + '.sha1', url + '.md5']
+
+        digests = {'sha256': 'aa', 'sha1': 'bb'}
+
+        def read(checksumfile, cache=None):
+            if checksumfile.endswith('.md5'):
+                raise URLError('Not found')
+            return ('%s  OMERO.server-0.0.0.zip\n' % digests[
+                checksumfile.rsplit('.', 1)[1]]).encode()
+
+        monkeypatch.setattr(fileutils, 'read', read)
+        assert a.get_checksums(url) == digests
+
+    @pytest.mark.parametrize('found', [[], [1], [1, 2], [0, 1, 2]])
+    def test_expand_ci_server(self, monkeypatch, found):
+        a = self.partial_mock_artifacts(False)
+        guesses = [
+            'https://ci.openmicroscopy.org/jenkins',
+            'https://ci.openmicroscopy.org/',
+            'https://ci',
+        ]
+
+        def dereference_url(url):
+            n = guesses.index(url)
+            # The preferred guess is slowest
+            time.sleep(0.1 * (2 - n))
+            if n not in found:
+                raise URLError('Not found')
+            return url + '/final'
+
+        monkeypatch.setattr(fileutils, 'dereference_url', dereference_url)
+        assert a._expand_ci_server('ci.example.org') == 'ci.example.org'
+        if found:
+            assert a._expand_ci_server('ci') == guesses[found[0]] + '/final'
+        else:
+            with pytest.raises(Stop):
+                a._expand_ci_server('ci')
+
     def test_label_list_parser(self):
         a = self.partial_mock_artifacts(True)
         labels = a.label_list_parser(
@@ -271,8 +350,8 @@ class TestReleaseArtifacts(MoxBase):
 
         self.mox.StubOutWithMock(fileutils, 'open_url')
         fileutils.open_url(
-            MockDownloadUrl.pageurl +
-            MockDownloadUrl.artifactpath).AndReturn(
+            MockDownloadUrl.pageurl + MockDownloadUrl.artifactpath,
+            headers=ACCEPT).AndReturn(
             MockDownloadUrl(True))
         self.mox.ReplayAll()
         args = Args(False)
@@ -288,11 +367,40 @@ class TestReleaseArtifacts(MoxBase):
             MockDownloadUrl.artifactnames[1])
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('error', [
+        URLError('Connection refused'), socket.timeout('timed out'),
+        BadStatusLine('SSH-2.0-OpenSSH_8'), IncompleteRead(b'')])
+    def test_mirror_failover(self, error):
+        mirror = 'http://mirror.example.org'
+        self.mox.StubOutWithMock(mirrors, 'rank')
+        mirrors.rank([mirror, MockDownloadUrl.downloadurl], cachedir='auto',
+                     ttl=3600).AndReturn([mirror, MockDownloadUrl.downloadurl])
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(
+            mirror + '/omero/0.0.0/artifacts/', headers=ACCEPT).AndRaise(
+            error)
+        fileutils.open_url(
+            MockDownloadUrl.pageurl + MockDownloadUrl.artifactpath,
+            headers=ACCEPT).AndReturn(MockDownloadUrl(True))
+        self.mox.ReplayAll()
+
+        args = Args(False)
+        args.branch = '0.0.0'
+        args.downloadurl = '%s/, %s' % (mirror, MockDownloadUrl.downloadurl)
+        a = ReleaseArtifacts(args)
+        serverurl = '%s%s%s' % (
+            MockDownloadUrl.pageurl, MockDownloadUrl.artifactpath,
+            MockDownloadUrl.artifactnames[1])
+        assert a.get('server') == serverurl
+        assert a.alternatives(serverurl) == [
+            serverurl, serverurl.replace(MockDownloadUrl.downloadurl, mirror)]
+        self.mox.VerifyAll()
+
     def test_read_downloads(self):
         self.mox.StubOutWithMock(fileutils, 'open_url')
         fileutils.open_url(
-            MockDownloadUrl.pageurl + MockDownloadUrl.artifactpath).AndReturn(
-            MockDownloadUrl(True))
+            MockDownloadUrl.pageurl + MockDownloadUrl.artifactpath,
+            headers=ACCEPT).AndReturn(MockDownloadUrl(True))
         self.mox.ReplayAll()
 
         fullpath = '%s%s' % (
@@ -304,16 +412,40 @@ class TestReleaseArtifacts(MoxBase):
             }
         self.mox.VerifyAll()
 
+    def test_read_downloads_checksums(self):
+        dlurl = MockDownloadUrl.pageurl + MockDownloadUrl.artifactpath
+        self.mox.StubOutWithMock(fileutils, 'read')
+        fileutils.read(dlurl, cache=None).AndReturn(
+            b'<a href="a-ice36.zip">a</a><a href="a-ice36.zip.sha256">s</a>'
+            b'<a href="a-ice36.zip.md5">m</a>')
+        self.mox.ReplayAll()
+
+        checksumfiles = {}
+        assert ReleaseArtifacts.read_downloads(
+            dlurl, checksumfiles=checksumfiles) == {
+            'ice36': [dlurl + 'a-ice36.zip']}
+        assert checksumfiles == {
+            dlurl + 'a-ice36.zip': [
+                dlurl + 'a-ice36.zip.md5', dlurl + 'a-ice36.zip.sha256']}
+        self.mox.VerifyAll()
+
 
 class TestArtifacts(MoxBase):
 
     class MockArtifacts(Artifacts):
-        def __init__(self, component, url):
+        def __init__(self, component, url, alternatives=()):
             class A(object):
                 def get(self, c):
                     assert c == component
                     return url
 
+                def alternatives(self, u):
+                    return [u] + list(alternatives)
+
+                def get_checksums(self, u):
+                    assert u == url
+                    return {}
+
             self.args = Args(False)
             self.artifacts = A()
 
@@ -328,13 +460,41 @@ class TestArtifacts(MoxBase):
         self.mox.StubOutWithMock(fileutils, 'unzip')
         fileutils.get_as_local_path(
             url, 'error', progress=0, httpuser=auth['httpuser'],
-            httppassword=auth['httppassword']).AndReturn(
+            httppassword=auth['httppassword'], connections=1,
+            resume=False, cachedir=None, cachesize=4096,
+            checksums=None, stream_unzip=None, delta_from=None,
+            write_index=False).AndReturn(
             ('file', 'component-0.0.0.zip'))
         fileutils.unzip('component-0.0.0.zip', match_dir=True,
-                        destdir='unzip/dir').AndReturn('component-0.0.0')
+                        destdir='unzip/dir', workers=1,
+                        incremental=False, manifest=True).AndReturn(
+                            'component-0.0.0')
 
         self.mox.ReplayAll()
 
         assert a.download('testcomponent') == 'component-0.0.0'
 
         self.mox.VerifyAll()
+
+    def test_download_failover(self):
+        url = 'http://example.org/test/component-0.0.0.zip'
+        mirrorurl = 'http://mirror.example.org/test/component-0.0.0.zip'
+        a = self.MockArtifacts('testcomponent', url, [mirrorurl])
+        a.args.skipunzip = True
+
+        self.mox.StubOutWithMock(fileutils, 'get_as_local_path')
+        for u in (url, mirrorurl):
+            r = fileutils.get_as_local_path(
+                u, 'error', progress=0, httpuser=MockAuth.httpuser,
+                httppassword=MockAuth.httppassword, connections=1,
+                resume=False, cachedir=None, cachesize=4096,
+                checksums=None, stream_unzip=None, delta_from=None,
+                write_index=False)
+            if u == url:
+                r.AndRaise(URLError('Connection refused'))
+            else:
+                r.AndReturn(('file', 'component-0.0.0.zip'))
+        self.mox.ReplayAll()
+
+        assert a.download('testcomponent') == 'component-0.0.0.zip'
+        self.mox.VerifyAll()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from builtins import object
+import pytest
+
+import os
+
+from omego import cache
+from omego.cache import ArtifactCache, MetadataCache, TreeStore
+
+
+def write(path, content):
+    with open(str(path), 'wb') as f:
+        f.write(content)
+
+
+class TestValidators(object):
+
+    @pytest.mark.parametrize('cached,remote,expected', [
+        ({'etag': '"a"', 'last_modified': None, 'length': 1},
+         {'etag': '"a"', 'last_modified': None, 'length': 2}, True),
+        ({'etag': '"a"', 'last_modified': None, 'length': 1},
+         {'etag': '"b"', 'last_modified': None, 'length': 1}, False),
+        ({'etag': None, 'last_modified': 'x', 'length': 1},
+         {'etag': '"a"', 'last_modified': 'x', 'length': 1}, True),
+        ({'etag': None, 'last_modified': 'x', 'length': 1},
+         {'etag': None, 'last_modified': 'y', 'length': 1}, False),
+        ({'etag': None, 'last_modified': None, 'length': 1},
+         {'etag': None, 'last_modified': None, 'length': 1}, False),
+        (None, {'etag': '"a"'}, False),
+    ])
+    def test_validators_match(self, cached, remote, expected):
+        assert cache.validators_match(cached, remote) is expected
+
+
+class TestArtifactCache(object):
+
+    url = 'http://example.org/test/file.zip'
+    validators = {'etag': '"abc"', 'last_modified': None, 'length': 4}
+
+    def test_cache_dir(self, monkeypatch):
+        monkeypatch.setenv('XDG_CACHE_HOME', '/cache')
+        assert cache.cache_dir('auto', 'x') == os.path.join(
+            '/cache', 'omego', 'x')
+        assert cache.cache_dir('/a', 'x') == os.path.join('/a', 'x')
+
+    def test_add_find(self, tmpdir):
+        c = ArtifactCache(str(tmpdir.join('cache')))
+        assert c.find(self.url, self.validators) is None
+
+        tmpname = c.tmpname(self.url)
+        write(tmpname, b'test')
+        obj = c.add(self.url, self.validators, tmpname)
+        assert not os.path.exists(tmpname)
+        assert os.path.basename(obj) == cache.hash_file(obj)
+
+        assert c.find(self.url, self.validators) == obj
+        assert c.find(self.url, dict(self.validators, etag='"x"')) is None
+
+        dest = str(tmpdir.join('file.zip'))
+        c.materialise(obj, dest)
+        with open(dest, 'rb') as f:
+            assert f.read() == b'test'
+        assert c.checksum(self.url, dest) == os.path.basename(obj)
+
+        write(str(tmpdir.join('copy.zip')), b'test')
+        assert c.checksum(self.url, str(tmpdir.join('copy.zip'))) is None
+        assert c.checksum(self.url + '.x', dest) is None
+
+    def test_evict(self, tmpdir):
+        c = ArtifactCache(str(tmpdir), 1)
+        objs = []
+        for n in range(3):
+            url = '%s.%d' % (self.url, n)
+            tmpname = c.tmpname(url)
+            write(tmpname, str(n).encode() * (400 * 1024))
+            objs.append(c.add(url, self.validators, tmpname))
+            os.utime(objs[-1], (n, n))
+
+        assert [os.path.exists(o) for o in objs] == [False, True, True]
+        assert c.find(self.url + '.0', self.validators) is None
+        assert c.find(self.url + '.1', self.validators) == objs[1]
+
+    def test_evict_removed(self, tmpdir, monkeypatch):
+        c = ArtifactCache(str(tmpdir), 0)
+        listdir = os.listdir
+        # An object removed by another process after the directory is read
+        monkeypatch.setattr(cache.os, 'listdir',
+                            lambda d: listdir(d) + ['removed'])
+        tmpname = c.tmpname(self.url)
+        write(tmpname, b'test')
+        obj = c.add(self.url, self.validators, tmpname)
+        assert os.path.exists(obj)
+
+
+class TestMetadataCache(object):
+
+    url = 'http://example.org/test/api/xml'
+
+    def test_put_get(self, tmpdir):
+        c = MetadataCache(str(tmpdir))
+        assert c.conditional_headers(self.url) == {}
+
+        c.put(self.url, {}, b'ignored')
+        assert c.conditional_headers(self.url) == {}
+
+        c.put(self.url, {'ETag': '"a"', 'Last-Modified': 'x'}, b'body')
+        assert c.conditional_headers(self.url) == {
+            'If-None-Match': '"a"', 'If-Modified-Since': 'x'}
+        assert c.get(self.url) == b'body'
+
+
+class TestTreeStore(object):
+
+    def test_get(self, tmpdir):
+        store = TreeStore(str(tmpdir))
+        extracted = []
+
+        def extract(d):
+            extracted.append(d)
+            with open(os.path.join(d, 'a'), 'w') as f:
+                f.write('a')
+
+        for n in range(2):
+            with store.checkout('0123', extract) as tree:
+                assert tree == str(tmpdir.join('trees', '0123'))
+                assert os.listdir(tree) == ['a']
+                assert os.path.exists(tree + '.lock')
+        assert len(extracted) == 1
+        assert sorted(os.listdir(store.cachedir)) == [
+            '0123', '0123.json', 'tmp']
+
+    def test_get_failed(self, tmpdir):
+        store = TreeStore(str(tmpdir))
+
+        def extract(d):
+            os.mkdir(os.path.join(d, 'readonly'), 0o500)
+            raise IOError('Extraction failed')
+
+        with pytest.raises(IOError):
+            with store.checkout('0123', extract):
+                pass
+        assert os.listdir(store.tmp) == []
+        assert not os.path.exists(os.path.join(store.cachedir, '0123'))
+
+    def test_evict(self, tmpdir):
+        store = TreeStore(str(tmpdir), 1)
+
+        def extract(n):
+            def f(d):
+                os.mkdir(os.path.join(d, 'readonly'))
+                write(os.path.join(d, 'readonly', 'a'),
+                      str(n).encode() * (600 * 1024))
+                os.chmod(os.path.join(d, 'readonly'), 0o500)
+            return f
+
+        trees = []
+        for n in range(3):
+            with store.checkout('%04d' % n, extract(n)) as tree:
+                trees.append(tree)
+            os.utime(tree, (n, n))
+            if n == 0:
+                # Trees in use aren't evicted
+                in_use = store.checkout('0000', None)
+                in_use.__enter__()
+                os.utime(tree, (n, n))
+
+        assert [os.path.isdir(t) for t in trees] == [True, False, True]
+        assert not os.path.exists(trees[1] + '.json')
+        in_use.__exit__(None, None, None)
+
+        store.evict()
+        assert [os.path.isdir(t) for t in trees] == [False, False, True]
+        assert os.listdir(store.tmp) == []
@@ -26,11 +26,25 @@ from builtins import object
 import pytest
 from mox3 import mox
 
+import errno
+import hashlib
+import io
+import logging
 import os
 import re
+import subprocess
+import tarfile
+import threading
+import time
 import zipfile
+import zlib
+from urllib.error import HTTPError
 
 from omego import fileutils
+from omego.cache import ArtifactCache, MetadataCache, TreeStore, hash_file
+from omego.locks import FileLock
+from omego.progress import Progress
+from omego.scheduler import DownloadScheduler, PRIORITY_SERVER
 
 
 class TestFileutils(object):
@@ -43,15 +57,50 @@ class TestFileutils(object):
 
     class MockResponse(object):
 
-        def __init__(self, length):
+        def __init__(self, length, code=200, ranges=False, headers=None):
+            self.code = code
             self.headers = {'Content-Length': str(length)}
+            if ranges:
+                self.headers['Accept-Ranges'] = 'bytes'
+            if headers:
+                self.headers.update(headers)
             self.remaining = length
 
-        def read(self, blocksize):
+        def readinto(self, b):
             assert self.remaining > 0
-            r = min(blocksize, self.remaining)
+            r = min(len(b), self.remaining)
             self.remaining -= r
-            return b'x' * r
+            b[:r] = b'x' * r
+            return r
+
+        def close(self):
+            pass
+
+    class StreamResponse(object):
+        """
+        A response without a Content-Length, optionally compressed
+        """
+
+        def __init__(self, content, encoding=None, truncate=False):
+            self.code = 200
+            self.url = 'http://example.org/test'
+            self.headers = {}
+            if encoding:
+                self.headers['Content-Encoding'] = encoding
+            if encoding in ('gzip', 'deflate'):
+                wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else 15
+                c = zlib.compressobj(wbits=wbits)
+                content = c.compress(content) + c.flush()
+            if truncate:
+                content = content[:-8]
+            self.content = content
+
+        def read(self, n=-1):
+            if n < 0:
+                n = len(self.content)
+            r = self.content[:n]
+            self.content = self.content[n:]
+            return r
 
         def close(self):
             pass
@@ -59,8 +108,84 @@ class TestFileutils(object):
     # TODO
     # def test_open_url
 
-    # TODO
-    # def test_read
+    @pytest.mark.parametrize('modified', [True, False])
+    def test_read_cache(self, tmpdir, modified):
+        url = 'http://example.org/test/api/xml'
+        c = MetadataCache(str(tmpdir))
+        c.put(url, {'ETag': '"a"'}, b'old')
+
+        class MockReadResponse(object):
+            code = 200
+            url = 'http://example.org/test/api/xml'
+            headers = {'ETag': '"b"'}
+
+            def read(self):
+                return b'new'
+
+            def close(self):
+                pass
+
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        r = fileutils.open_url(url, headers={
+            'If-None-Match': '"a"',
+            'Accept-Encoding': fileutils.ACCEPT_ENCODING})
+        if modified:
+            r.AndReturn(MockReadResponse())
+        else:
+            r.AndRaise(HTTPError(url, 304, 'Not Modified', {}, None))
+        self.mox.ReplayAll()
+
+        if modified:
+            assert fileutils.read(url, cache=c) == b'new'
+            assert c.conditional_headers(url) == {'If-None-Match': '"b"'}
+        else:
+            assert fileutils.read(url, cache=c) == b'old'
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'identity'])
+    def test_read_encoded(self, encoding):
+        url = 'http://example.org/test/api/xml'
+        content = b'<root>' + b'<a/>' * 1000 + b'</root>'
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url, headers={
+            'Accept-Encoding': fileutils.ACCEPT_ENCODING}).AndReturn(
+            self.StreamResponse(content, encoding))
+        self.mox.ReplayAll()
+        assert fileutils.read(url) == content
+        self.mox.VerifyAll()
+
+    def test_read_unsupported_encoding(self):
+        r = self.StreamResponse(b'')
+        r.headers['Content-Encoding'] = 'compress'
+        with pytest.raises(fileutils.FileException):
+            fileutils.content_decoder(r)
+
+    @pytest.mark.parametrize('encoding', [None, 'gzip', 'deflate'])
+    @pytest.mark.parametrize('truncate', [False, True])
+    def test_download_stream(self, tmpdir, encoding, truncate):
+        url = 'http://example.org/test/dump.sql'
+        content = b''.join(
+            b'INSERT INTO t VALUES (%d);\n' % n for n in range(200000))
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url, headers={
+            'Accept-Encoding': fileutils.ACCEPT_ENCODING}).AndReturn(
+            self.StreamResponse(content, encoding, truncate))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            if truncate and encoding:
+                with pytest.raises(fileutils.FileException):
+                    fileutils.download(url)
+                assert os.listdir('.') == []
+            else:
+                checksum = fileutils.Checksum(algorithms=['sha256'])
+                assert fileutils.download(url, checksum=checksum) == 'dump.sql'
+                with open('dump.sql', 'rb') as f:
+                    expected = content[:-8] if truncate else content
+                    assert f.read() == expected
+                assert checksum.hexdigest('sha256') == hashlib.sha256(
+                    expected).hexdigest()
+        self.mox.VerifyAll()
 
     @pytest.mark.parametrize('filename', [True, False])
     @pytest.mark.parametrize('httpauth', [True, False])
@@ -97,6 +222,399 @@ class TestFileutils(object):
 
         self.mox.VerifyAll()
 
+    @pytest.mark.parametrize('ranges', [True, False])
+    def test_download_connections(self, tmpdir, ranges):
+        url = 'http://example.org/test/file.dat'
+        filesize = 2 * 1024 * 1024 + 1
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url).AndReturn(
+            self.MockResponse(filesize, ranges=ranges))
+        if ranges:
+            fileutils.open_url(
+                url, headers={'Range': 'bytes=1048576-2097151'}).InAnyOrder(
+                ).AndReturn(self.MockResponse(1024 * 1024, 206, headers={
+                    'Content-Range': 'bytes 1048576-2097151/2097153'}))
+            fileutils.open_url(
+                url, headers={'Range': 'bytes=2097152-2097152'}).InAnyOrder(
+                ).AndReturn(self.MockResponse(1, 206, headers={
+                    'Content-Range': 'bytes 2097152-2097152/2097153'}))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            f = fileutils.download(url, connections=3)
+            assert f == 'file.dat'
+            assert os.path.getsize(f) == filesize
+            assert len(tmpdir.listdir()) == 1
+
+        self.mox.VerifyAll()
+
+    def test_download_range_ignored(self, tmpdir):
+        url = 'http://example.org/test/file.dat'
+        filesize = 2 * 1024 * 1024
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url).AndReturn(
+            self.MockResponse(filesize, ranges=True))
+        fileutils.open_url(
+            url, headers={'Range': 'bytes=1048576-2097151'}).AndReturn(
+            self.MockResponse(filesize, 200))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            f = fileutils.download(url, connections=2)
+            assert f == 'file.dat'
+            assert os.path.getsize(f) == filesize
+            assert len(tmpdir.listdir()) == 1
+
+        self.mox.VerifyAll()
+
+    def test_download_some_ranges_ignored(self, tmpdir):
+        url = 'http://example.org/test/file.dat'
+        mib = 1024 * 1024
+        data = bytes(bytearray(i % 251 for i in range(3 * mib)))
+
+        def response(content, code=200, headers=None):
+            r = self.StreamResponse(content)
+            r.code = code
+            r.headers = {'Content-Length': str(len(content)),
+                         'Accept-Ranges': 'bytes'}
+            r.headers.update(headers or {})
+            return r
+
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url).AndReturn(response(data))
+        fileutils.open_url(
+            url, headers={'Range': 'bytes=1048576-2097151'}).InAnyOrder(
+            ).AndReturn(response(data[mib:2 * mib], 206, {
+                'Content-Range': 'bytes 1048576-2097151/3145728'}))
+        fileutils.open_url(
+            url, headers={'Range': 'bytes=2097152-3145727'}).InAnyOrder(
+            ).AndReturn(response(data))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            f = fileutils.download(url, connections=3)
+            with open(f, 'rb') as fh:
+                assert fh.read() == data
+
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('connections', [1, 2])
+    def test_download_scheduled(self, tmpdir, monkeypatch, connections):
+        url = 'http://example.org/test/OMERO.server-0.0.0.zip'
+        filesize = 4 * 1024 * 1024
+        s = DownloadScheduler()
+        monkeypatch.setattr(fileutils, 'scheduler', s)
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url).AndReturn(
+            self.MockResponse(filesize, ranges=True))
+        if connections == 2:
+            fileutils.open_url(url, headers={'Range': 'bytes=2097152-4194303'}
+                               ).AndReturn(self.MockResponse(
+                                   2 * 1024 * 1024, 206, headers={
+                                       'Content-Range':
+                                       'bytes 2097152-4194303/4194304'}))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            fileutils.download(url, connections=connections)
+        assert len(s.completed) == 1
+        assert s.completed[0].priority == PRIORITY_SERVER
+        assert s.completed[0].nbytes == filesize
+        self.mox.VerifyAll()
+
+    def test_adapt_blocksize(self):
+        mb = 1024 * 1024
+        assert fileutils._adapt_blocksize(mb, 0.01) == 2 * mb
+        assert fileutils._adapt_blocksize(mb, 0.25) == mb
+        assert fileutils._adapt_blocksize(mb, 1) == mb // 2
+        assert fileutils._adapt_blocksize(2 * mb, 0.01) == 2 * mb
+        assert fileutils._adapt_blocksize(64 * 1024, 1) == 64 * 1024
+
+    class MemoryResponse(object):
+        # A fast response for benchmarking, read() allocates a new block
+        # each time in the same way as a socket
+        def __init__(self, length):
+            self.code = 200
+            self.headers = {'Content-Length': str(length)}
+            self.remaining = length
+            self.data = memoryview(os.urandom(16 * 1024 * 1024))
+            self.allocated = 0
+
+        def read(self, n):
+            block = bytes(self.data[:min(n, self.remaining)])
+            self.remaining -= len(block)
+            self.allocated += len(block)
+            return block
+
+        def readinto(self, b):
+            n = min(len(b), self.remaining)
+            b[:n] = self.data[:n]
+            self.remaining -= n
+            return n
+
+        def close(self):
+            pass
+
+    def test_download_readinto(self, tmpdir):
+        filesize = 4 * 1024 * 1024
+        response = self.MemoryResponse(filesize)
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url('http://example.org/file.dat').AndReturn(response)
+        self.mox.ReplayAll()
+        with tmpdir.as_cwd():
+            fileutils.download('http://example.org/file.dat', 'new.dat')
+            assert os.path.getsize('new.dat') == filesize
+        # Blocks are read into a reused buffer
+        assert response.allocated == 0
+        self.mox.VerifyAll()
+
+    @pytest.mark.skipif(not os.getenv('OMEGO_BENCHMARK'),
+                        reason='Set OMEGO_BENCHMARK=1 to run benchmarks')
+    def test_download_benchmark(self, tmpdir):
+        # Compares the download loop with the original one which read a new
+        # 1 MiB block each time
+        filesize = 128 * 1024 * 1024
+
+        def original(response, filename):
+            progress = Progress('download', filename, filesize, 20)
+            with open(filename, 'wb') as output:
+                downloaded = 0
+                while downloaded < filesize:
+                    block = response.read(1024 * 1024)
+                    output.write(block)
+                    output.flush()
+                    downloaded += len(block)
+                    progress.update(downloaded)
+
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        original_cpu = new_cpu = float('inf')
+        # Take the best of several runs to exclude the page cache warming up
+        for n in range(3):
+            reference = self.MemoryResponse(filesize)
+            with tmpdir.as_cwd():
+                t = time.process_time()
+                original(reference, 'original.dat')
+                original_cpu = min(original_cpu, time.process_time() - t)
+                os.unlink('original.dat')
+
+            response = self.MemoryResponse(filesize)
+            fileutils.open_url('http://example.org/file.dat').AndReturn(
+                response)
+            self.mox.ReplayAll()
+            with tmpdir.as_cwd():
+                t = time.process_time()
+                fileutils.download('http://example.org/file.dat', 'new.dat',
+                                   20)
+                new_cpu = min(new_cpu, time.process_time() - t)
+                assert os.path.getsize('new.dat') == filesize
+                os.unlink('new.dat')
+            self.mox.VerifyAll()
+            self.mox.ResetAll()
+
+        assert reference.allocated == filesize
+        assert response.allocated == 0
+        assert new_cpu <= original_cpu
+
+    @pytest.mark.parametrize('changed', [True, False])
+    def test_download_resume(self, tmpdir, changed):
+        url = 'http://example.org/test/file.dat'
+        filesize = 3 * 1024 * 1024
+        etag = '"abc"'
+
+        class FailingResponse(self.MockResponse):
+            def readinto(self, b):
+                if self.remaining <= filesize - 1024 * 1024:
+                    raise IOError('Connection reset')
+                return super(FailingResponse, self).readinto(b)
+
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url).AndReturn(
+            FailingResponse(filesize, headers={'ETag': etag}))
+        headers = {'Range': 'bytes=1048576-3145727', 'If-Range': etag}
+        if changed:
+            fileutils.open_url(url, headers=headers).AndReturn(
+                self.MockResponse(filesize, headers={'ETag': '"def"'}))
+        else:
+            fileutils.open_url(url, headers=headers).AndReturn(
+                self.MockResponse(2 * 1024 * 1024, 206, headers={
+                    'ETag': etag,
+                    'Content-Range': 'bytes 1048576-3145727/3145728'}))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            with pytest.raises(IOError):
+                fileutils.download(url, resume=True)
+            # The part file is preallocated
+            assert os.path.getsize('file.dat.part') == filesize
+            state = fileutils.DownloadState.load('file.dat.part.json', url)
+            assert state.downloaded() == 1024 * 1024
+
+            f = fileutils.download(url, resume=True)
+            assert f == 'file.dat'
+            assert os.path.getsize(f) == filesize
+            assert sorted(tmpdir.listdir()) == [tmpdir.join('file.dat')]
+
+        self.mox.VerifyAll()
+
+    def test_download_resume_shrunk(self, tmpdir):
+        url = 'http://example.org/test/file.dat'
+        filesize = 1024 * 1024
+        etag = '"abc"'
+        headers = {'Range': 'bytes=1048576-3145727', 'If-Range': etag}
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url, headers=headers).AndRaise(HTTPError(
+            url, 416, 'Range Not Satisfiable', {}, io.BytesIO()))
+        fileutils.open_url(url).AndReturn(
+            self.MockResponse(filesize, headers={'ETag': '"def"'}))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            # A partial download of an earlier, longer version of the file
+            with open('file.dat.part', 'wb') as f:
+                f.write(b'x' * 3 * 1024 * 1024)
+            fileutils.DownloadState(
+                url, 3 * 1024 * 1024, etag, None,
+                [[0, 3 * 1024 * 1024, 1024 * 1024]]).save(
+                    'file.dat.part.json')
+
+            f = fileutils.download(url, resume=True)
+            assert f == 'file.dat'
+            assert os.path.getsize(f) == filesize
+            assert sorted(tmpdir.listdir()) == [tmpdir.join('file.dat')]
+
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('cached', [True, False])
+    def test_cached_download(self, tmpdir, cached):
+        url = 'http://example.org/test/file.dat'
+        headers = {'ETag': '"abc"'}
+        c = ArtifactCache(str(tmpdir.join('cache')))
+        if cached:
+            tmpname = c.tmpname(url)
+            with open(tmpname, 'wb') as f:
+                f.write(b'x' * 4)
+            c.add(url, {'etag': '"abc"'}, tmpname)
+
+        def mock_download(url, filename, *args, **kwargs):
+            with open(filename, 'wb') as f:
+                f.write(b'x' * 4)
+            kwargs['checksum'].update(b'x' * 4)
+            return filename
+
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        self.mox.StubOutWithMock(fileutils, 'download')
+        fileutils.open_url(url, httpuser=None, httppassword=None,
+                           method='HEAD').AndReturn(
+            self.MockResponse(4, headers=headers))
+        if not cached:
+            fileutils.download(url, c.tmpname(url), 0, httpuser=None,
+                               httppassword=None,
+                               checksum=mox.IsA(fileutils.Checksum)
+                               ).WithSideEffects(
+                mock_download).AndReturn(c.tmpname(url))
+        self.mox.ReplayAll()
+
+        with tmpdir.as_cwd():
+            f = fileutils.cached_download(url, 'file.dat', c)
+            assert f == 'file.dat'
+            assert os.path.getsize(f) == 4
+            assert os.stat(f).st_nlink == 2
+
+        self.mox.VerifyAll()
+
+    @pytest.mark.parametrize('cached', [True, False])
+    def test_get_as_local_path_coalesce(self, tmpdir, monkeypatch, cached):
+        url = 'http://example.org/test/file.dat'
+        downloads = []
+        results = []
+        cachedir = str(tmpdir.join('cache'))
+        c = ArtifactCache(cachedir)
+
+        def mock_open_url(url, **kwargs):
+            return self.MockResponse(4, headers={'ETag': '"abc"'})
+
+        monkeypatch.setattr(fileutils, 'open_url', mock_open_url)
+        monkeypatch.setattr(fileutils, 'download',
+                            lambda *args, **kwargs: downloads.append(args))
+
+        def get():
+            results.append(fileutils.get_as_local_path(
+                url, 'backup', cachedir=cachedir if cached else None))
+
+        with tmpdir.as_cwd():
+            # Another process is downloading the file
+            if cached:
+                lock = FileLock(c.tmpname(url) + '.lock', poll=0.01)
+            else:
+                lock = FileLock('file.dat.lock', poll=0.01)
+            lock.acquire()
+            t = threading.Thread(target=get)
+            t.start()
+            time.sleep(0.1)
+            with open('file.dat', 'wb') as f:
+                f.write(b'x' * 4)
+            if cached:
+                c.add(url, {'etag': '"abc"'}, 'file.dat')
+            lock.release()
+            t.join()
+            assert results == [('file', 'file.dat')]
+            assert os.path.getsize('file.dat') == 4
+        assert downloads == []
+
+    @pytest.mark.parametrize('connections', [1, 2])
+    @pytest.mark.parametrize('valid', [True, False])
+    def test_download_checksum(self, tmpdir, connections, valid):
+        url = 'http://example.org/test/file.dat'
+        filesize = 2 * 1024 * 1024
+        sha256 = hashlib.sha256(b'x' * filesize).hexdigest()
+        if not valid:
+            sha256 = sha256[::-1]
+        self.mox.StubOutWithMock(fileutils, 'open_url')
+        fileutils.open_url(url).AndReturn(
+            self.MockResponse(filesize, ranges=True))
+        if connections > 1:
+            fileutils.open_url(
+                url, headers={'Range': 'bytes=1048576-2097151'}).AndReturn(
+                self.MockResponse(1024 * 1024, 206, headers={
+                    'Content-Range': 'bytes 1048576-2097151/2097152'}))
+        self.mox.ReplayAll()
+
+        checksum = fileutils.Checksum({'sha256': sha256}, ['md5'])
+        with tmpdir.as_cwd():
+            if valid:
+                fileutils.download(url, connections=connections,
+                                   checksum=checksum)
+                assert os.path.getsize('file.dat') == filesize
+            else:
+                with pytest.raises(fileutils.FileException) as excinfo:
+                    fileutils.download(url, connections=connections,
+                                       checksum=checksum)
+                assert excinfo.value.args[0] == 'Checksum mismatch'
+                assert tmpdir.listdir() == []
+        assert checksum.hexdigest('md5') == hashlib.md5(
+            b'x' * filesize).hexdigest()
+
+        self.mox.VerifyAll()
+
+    def test_parse_checksum(self):
+        assert fileutils.parse_checksum('SHA256:ABC') == {'sha256': 'abc'}
+        with pytest.raises(fileutils.FileException):
+            fileutils.parse_checksum('abc')
+        with pytest.raises(fileutils.FileException):
+            fileutils.parse_checksum('unknown:abc')
+
+    def test_parse_checksum_file(self):
+        assert fileutils.parse_checksum_file('ABC\n') == 'abc'
+        assert fileutils.parse_checksum_file(
+            'abc  a.zip\ndef *b.zip\n', 'b.zip') == 'def'
+        with pytest.raises(fileutils.FileException):
+            fileutils.parse_checksum_file('abc  a.zip\ndef  b.zip', 'c.zip')
+
+    def test_split_ranges(self):
+        assert fileutils.split_ranges(10, 3) == [(0, 4), (4, 8), (8, 10)]
+        assert fileutils.split_ranges(10, 3, 6) == [(0, 6), (6, 10)]
+        assert fileutils.split_ranges(10, 1) == [(0, 10)]
+
     @pytest.mark.parametrize('exists', [True, False])
     @pytest.mark.parametrize('suffix', [True, False])
     def test_rename_backup(self, exists, suffix):
@@ -169,6 +687,7 @@ class TestFileutils(object):
             def __init__(self, name, perms):
                 self.filename = name
                 self.external_attr = perms << 16
+                self.file_size = 0
 
         self.mox.StubOutClassWithMocks(zipfile, 'ZipFile')
         self.mox.StubOutWithMock(os, 'chmod')
@@ -194,15 +713,410 @@ class TestFileutils(object):
 
         self.mox.VerifyAll()
 
+    class Unseekable(object):
+        # zipfile writes data descriptors to unseekable files
+        def __init__(self, f):
+            self.f = f
+
+        def write(self, b):
+            return self.f.write(b)
+
+        def flush(self):
+            self.f.flush()
+
+    def create_zip(self, filename, compression, unseekable=False):
+        with open(filename, 'wb') as f:
+            out = self.Unseekable(f) if unseekable else f
+            with zipfile.ZipFile(out, 'w', compression) as z:
+                d = zipfile.ZipInfo('test/')
+                d.external_attr = (0o40755 << 16) | 0x10
+                z.writestr(d, '')
+                a = zipfile.ZipInfo('test/a.txt')
+                a.external_attr = 0o100600 << 16
+                z.writestr(a, b'a' * 100000, compression)
+                b = zipfile.ZipInfo('test/b/c.sh')
+                b.external_attr = 0o100755 << 16
+                z.writestr(b, os.urandom(3000000), compression)
+
+    def stream_unzip(self, filename, destdir, blocksize=65536, **kwargs):
+        extractor = fileutils.ZipStreamExtractor(filename, destdir=destdir,
+                                                 **kwargs)
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                extractor.update(block)
+        return extractor
+
+    def assert_same_tree(self, a, b):
+        for root, dirs, files in os.walk(a):
+            for name in dirs + files:
+                pa = os.path.join(root, name)
+                pb = os.path.join(b, os.path.relpath(pa, a))
+                assert os.stat(pa).st_mode == os.stat(pb).st_mode
+                if os.path.isfile(pa):
+                    with open(pa, 'rb') as fa, open(pb, 'rb') as fb:
+                        assert fa.read() == fb.read()
+
+    @pytest.mark.parametrize('compression', [
+        zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+    @pytest.mark.parametrize('unseekable', [True, False])
+    def test_zip_stream_extractor(self, tmpdir, compression, unseekable):
+        with tmpdir.as_cwd():
+            self.create_zip('test.zip', compression, unseekable)
+            fileutils.unzip('test.zip', True, 'serial')
+
+            extractor = self.stream_unzip('test.zip', 'stream',
+                                          match_dir=True)
+            if compression == zipfile.ZIP_STORED and unseekable:
+                # Can't be streamed, falls back to unzip
+                assert extractor.unsupported
+            assert extractor.close() == os.path.join('stream', 'test')
+            if compression == zipfile.ZIP_DEFLATED:
+                assert extractor.complete
+            self.assert_same_tree('serial', 'stream')
+
+    def test_zip_stream_extractor_abort(self, tmpdir):
+        with tmpdir.as_cwd():
+            self.create_zip('test.zip', zipfile.ZIP_STORED)
+            with open('test.zip', 'rb') as f:
+                data = f.read()
+            extractor = fileutils.ZipStreamExtractor(
+                'test.zip', match_dir=True, destdir='stream')
+            # Part of the second entry
+            extractor.update(data[:200000])
+            extractor.abort()
+            assert os.listdir('stream') == []
+
+    def test_stream_unzip_checksum_mismatch(self, tmpdir, monkeypatch):
+        url = 'http://example.org/test/test.zip'
+        with tmpdir.as_cwd():
+            self.create_zip('source.zip', zipfile.ZIP_DEFLATED)
+            with open('source.zip', 'rb') as f:
+                data = f.read()
+            monkeypatch.setattr(fileutils, 'open_url',
+                                lambda *args, **kwargs: self.StreamResponse(
+                                    data))
+            with pytest.raises(fileutils.FileException):
+                fileutils.get_as_local_path(
+                    url, 'error', checksums={'sha256': '0' * 64},
+                    stream_unzip={'match_dir': True, 'destdir': 'stream'})
+            assert os.listdir('stream') == []
+            assert not os.path.exists('test.zip')
+
+    @pytest.mark.parametrize('workers', [2, 8])
+    def test_unzip_parallel(self, tmpdir, workers):
+        with tmpdir.as_cwd():
+            self.create_zip('test.zip', zipfile.ZIP_DEFLATED)
+            fileutils.unzip('test.zip', True, 'serial')
+            unzipped = fileutils.unzip('test.zip', True, 'parallel', workers)
+            assert unzipped == os.path.join('parallel', 'test')
+            self.assert_same_tree('serial', 'parallel')
+            self.assert_same_tree('parallel', 'serial')
+
+    @pytest.mark.parametrize('include,exclude,expected', [
+        (None, ['*/docs/*'], ['a/', 'a/lib/', 'a/lib/x.jar', 'a/bin/y']),
+        (['a/lib/*'], None, ['a/', 'a/lib/', 'a/lib/x.jar']),
+        (['a/*'], ['*.jar', 'a/docs'], ['a/', 'a/lib/', 'a/bin/y']),
+    ])
+    def test_select_members(self, include, exclude, expected):
+        infolist = [zipfile.ZipInfo(n) for n in (
+            'a/', 'a/lib/', 'a/lib/x.jar', 'a/docs/', 'a/docs/index.html',
+            'a/bin/y')]
+        assert [i.filename for i in fileutils.select_members(
+            infolist, include, exclude)] == expected
+
+    @pytest.mark.parametrize('mode', ['serial', 'parallel', 'store'])
+    def test_unzip_exclude(self, tmpdir, mode):
+        kwargs = {}
+        if mode == 'parallel':
+            kwargs['workers'] = 2
+        if mode == 'store':
+            kwargs['store'] = TreeStore(str(tmpdir.join('cache')))
+        with tmpdir.as_cwd():
+            self.create_zip('test.zip', zipfile.ZIP_DEFLATED)
+            fileutils.unzip('test.zip', True, 'out', exclude=['test/b/*'],
+                            **kwargs)
+            assert sorted(os.listdir(os.path.join('out', 'test'))) == [
+                'a.txt']
+            fileutils.unzip('test.zip', True, 'out', include=['*.sh'],
+                            incremental=True)
+            assert sorted(os.listdir(os.path.join('out', 'test'))) == ['b']
+            assert os.listdir(os.path.join('out', 'test', 'b')) == ['c.sh']
+
+    def test_unzip_store(self, tmpdir, caplog, monkeypatch):
+        caplog.set_level(logging.INFO, logger='omego.fileutils')
+        store = TreeStore(str(tmpdir.join('cache')))
+        with tmpdir.as_cwd():
+            self.create_zip('test.zip', zipfile.ZIP_DEFLATED)
+            fileutils.unzip('test.zip', True, 'serial')
+            for d in ('one', 'two'):
+                unzipped = fileutils.unzip('test.zip', True, d, store=store)
+                assert unzipped == os.path.join(d, 'test')
+                self.assert_same_tree('serial', d)
+                self.assert_same_tree(d, 'serial')
+                assert caplog.messages[-1].startswith(
+                    'Cloned test.zip from %s' % store.cachedir)
+            # Extracted once
+            sha256 = hash_file('test.zip')
+            assert sorted(os.listdir(store.cachedir)) == [
+                sha256, sha256 + '.json', 'tmp']
+
+            # A known checksum is used without hashing the zip
+            monkeypatch.setattr(fileutils, 'hash_file', None)
+            fileutils.unzip('test.zip', True, 'three', store=store,
+                            sha256=sha256)
+            self.assert_same_tree('serial', 'three')
+
+    @pytest.mark.parametrize('reflink', [True, False])
+    def test_clone_tree(self, tmpdir, monkeypatch, reflink):
+        if not reflink:
+            monkeypatch.setattr(fileutils, 'fcntl', None)
+        src = tmpdir.mkdir('src')
+        src.mkdir('d').join('rw').write('rw')
+        src.join('d', 'ro').write('ro')
+        src.join('d', 'ro').chmod(0o444)
+        os.symlink('d/rw', str(src.join('link')))
+        dst = str(tmpdir.join('dst'))
+
+        counts = fileutils.clone_tree(str(src), dst)
+        self.assert_same_tree(str(src), dst)
+        assert os.readlink(os.path.join(dst, 'link')) == 'd/rw'
+        if not reflink or not counts['reflink']:
+            assert counts == {'reflink': 0, 'copy': 2}
+        else:
+            assert counts == {'reflink': 2, 'copy': 0}
+
+        # Changing a clone of a read-only file doesn't change the source
+        ro = os.path.join(dst, 'd', 'ro')
+        assert os.stat(ro).st_ino != src.join('d', 'ro').stat().ino
+        os.chmod(ro, 0o644)
+        with open(ro, 'w') as f:
+            f.write('changed')
+        assert src.join('d', 'ro').read() == 'ro'
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_unzip_incremental(self, tmpdir, caplog, workers):
+        caplog.set_level(logging.INFO, logger='omego.fileutils')
+        with tmpdir.as_cwd():
+            self.create_zip('test.zip', zipfile.ZIP_DEFLATED)
+            fileutils.unzip('test.zip', True, 'serial')
+            fileutils.unzip('test.zip', True, 'incremental')
+
+            # Same size, different contents
+            with open(os.path.join('incremental', 'test', 'a.txt'),
+                      'r+b') as f:
+                f.write(b'b')
+            os.chmod(os.path.join('incremental', 'test', 'b', 'c.sh'), 0o600)
+            os.makedirs(os.path.join('incremental', 'test', 'd', 'e'))
+            with open(os.path.join('incremental', 'test', 'd', 'f'),
+                      'w') as f:
+                f.write('extra')
+
+            fileutils.unzip('test.zip', True, 'incremental', workers,
+                            incremental=True)
+            self.assert_same_tree('serial', 'incremental')
+            self.assert_same_tree('incremental', 'serial')
+            assert caplog.messages[-1] == (
+                'Unzipped test.zip incrementally: 1 unchanged, 1 extracted, '
+                '3 removed')
+
+            os.unlink(os.path.join('incremental', 'test', 'b', 'c.sh'))
+            fileutils.unzip('test.zip', True, 'incremental', workers,
+                            incremental=True)
+            self.assert_same_tree('serial', 'incremental')
+            assert caplog.messages[-1] == (
+                'Unzipped test.zip incrementally: 1 unchanged, 1 extracted, '
+                '0 removed')
+
+    def test_dedup_tree_reflink(self, tmpdir):
+        for d in ('old', 'new'):
+            tmpdir.join(d).mkdir()
+            tmpdir.join(d, 'a').write('aaaa')
+        with tmpdir.as_cwd():
+            r = fileutils.dedup_tree('new', 'old', 'reflink')
+        # Depends on the filesystem
+        assert r in ((0, 0), (1, 4))
+        assert tmpdir.join('new', 'a').read() == 'aaaa'
+        assert not os.path.exists(str(tmpdir.join('new', 'a.omego-dedup')))
+        assert not os.path.samefile(
+            str(tmpdir.join('new', 'a')), str(tmpdir.join('old', 'a')))
+
+    def test_dedup_tree(self, tmpdir):
+        def create(path, content, mode=0o644):
+            path = str(tmpdir.join(path))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+            os.chmod(path, mode)
+
+        create('old/lib/a.jar', 'aaaa')
+        create('old/lib/moved/b.py', 'bbbb')
+        create('old/lib/c.py', 'cccc')
+        create('old/lib/d.py', 'dddd', 0o755)
+        create('old/etc/e.xml', 'eeee')
+        create('new/lib/a.jar', 'aaaa')
+        create('new/lib/b.py', 'bbbb')
+        create('new/lib/c.py', 'CCCC')
+        create('new/lib/d.py', 'dddd')
+        create('new/etc/e.xml', 'eeee')
+
+        with tmpdir.as_cwd():
+            assert fileutils.dedup_tree(
+                'new', 'old', subdirs=['lib']) == (2, 8)
+            assert fileutils.dedup_tree(
+                'new', 'old', subdirs=['lib']) == (0, 0)
+
+        def same(a, b):
+            return os.path.samefile(str(tmpdir.join(a)), str(tmpdir.join(b)))
+
+        assert same('new/lib/a.jar', 'old/lib/a.jar')
+        assert same('new/lib/b.py', 'old/lib/moved/b.py')
+        assert not same('new/lib/c.py', 'old/lib/c.py')
+        assert not same('new/lib/d.py', 'old/lib/d.py')
+        assert not same('new/etc/e.xml', 'old/etc/e.xml')
+        assert tmpdir.join('new/lib/b.py').read() == 'bbbb'
+
+    def test_dedup_tree_failed(self, tmpdir, monkeypatch, caplog):
+        for d in ('old', 'new'):
+            tmpdir.join(d).mkdir()
+            tmpdir.join(d, 'a').write('aaaa')
+
+        def replace(src, dst):
+            raise OSError(errno.EACCES, 'Permission denied')
+
+        monkeypatch.setattr(fileutils.os, 'replace', replace)
+        with tmpdir.as_cwd():
+            assert fileutils.dedup_tree('new', 'old') == (0, 0)
+        assert sorted(os.listdir(str(tmpdir.join('new')))) == ['a']
+        assert [r.levelname for r in caplog.records
+                if r.message.startswith('Failed to hardlink')] == ['WARNING']
+
+    def create_release(self, filename, version, data):
+        # Successive releases share most of their contents but the entries
+        # move because earlier ones change size
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('server/VERSION', version * 100)
+            z.writestr('server/lib/a.jar', data[0])
+            z.writestr('server/lib/b.jar', data[1])
+
+    class RangeResponse(object):
+
+        url = 'http://example.org/'
+
+        def __init__(self, content, start=0, end=None):
+            self.content = content[start:end]
+            if end is None:
+                self.code = 200
+            else:
+                self.code = 206
+            self.headers = {'Content-Length': str(len(self.content))}
+            if self.code == 206:
+                self.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                    start, end - 1, len(content))
+
+        def read(self, n=-1):
+            if n < 0:
+                n = len(self.content)
+            data = self.content[:n]
+            self.content = self.content[n:]
+            return data
+
+        def close(self):
+            pass
+
+    def test_block_index(self, tmpdir):
+        data = [os.urandom(300000), os.urandom(200000)]
+        with tmpdir.as_cwd():
+            self.create_release('old.zip', '1', data)
+            self.create_release('new.zip', '22', data)
+            old = fileutils.block_index('old.zip', 65536)
+            new = fileutils.block_index('new.zip', 65536)
+            assert new['length'] == os.path.getsize('new.zip')
+            assert sum(b[0] for b in new['blocks']) == new['length']
+            assert max(b[0] for b in new['blocks']) == 65536
+            assert new['sha256'] == hashlib.sha256(
+                open('new.zip', 'rb').read()).hexdigest()
+            # Only the changed entry, the headers and central directory
+            shared = set(b[1] for b in old['blocks']).intersection(
+                b[1] for b in new['blocks'])
+            assert sum(b[0] for b in new['blocks'] if b[1] in shared) > 500000
+
+            open('data.bin', 'wb').write(b'x' * 100001)
+            index = fileutils.block_index('data.bin', 65536)
+            assert [b[0] for b in index['blocks']] == [65536, 34465]
+
+    @pytest.mark.parametrize('indexed', [True, False])
+    def test_download_delta(self, tmpdir, monkeypatch, indexed):
+        url = 'http://example.org/test/new.zip'
+        data = [os.urandom(300000), os.urandom(200000)]
+        requests = []
+        with tmpdir.as_cwd():
+            self.create_release('old.zip', '1', data)
+            self.create_release('new.zip', '22', data)
+            if indexed:
+                assert fileutils.write_block_index('new.zip', 65536) == (
+                    'new.zip.blockindex')
+            os.rename('new.zip', 'remote.zip')
+            content = open('remote.zip', 'rb').read()
+
+            def open_url(u, headers=None):
+                if u == url + '.blockindex':
+                    if not indexed:
+                        raise HTTPError(u, 404, 'Not Found', {}, None)
+                    return self.RangeResponse(
+                        open('new.zip.blockindex', 'rb').read())
+                assert u == url
+                requests.append(headers)
+                if headers:
+                    start, end = re.match(
+                        r'bytes=(\d+)-(\d+)', headers['Range']).groups()
+                    return self.RangeResponse(
+                        content, int(start), int(end) + 1)
+                return self.RangeResponse(content)
+
+            monkeypatch.setattr(fileutils, 'open_url', open_url)
+            checksum = fileutils.Checksum(
+                {'sha256': hashlib.sha256(content).hexdigest()})
+            assert fileutils.download(url, delta_from='old.zip',
+                                      checksum=checksum) == 'new.zip'
+            assert open('new.zip', 'rb').read() == content
+            assert not checksum.mismatches()
+            assert sorted(os.listdir('.')) == sorted(
+                ['old.zip', 'remote.zip', 'new.zip'] +
+                ['new.zip.blockindex'] * indexed)
+        if indexed:
+            assert all(requests)
+            fetched = sum(int(h['Range'].split('-')[1]) + 1 - int(
+                h['Range'].split('=')[1].split('-')[0]) for h in requests)
+            assert fetched < len(content) // 4
+        else:
+            assert requests == [None]
+
+    def test_zip_stream_extractor_insecure(self, tmpdir):
+        with tmpdir.as_cwd():
+            with zipfile.ZipFile('test.zip', 'w') as z:
+                z.writestr('test/a', b'a')
+                z.writestr('other/b', b'b')
+            with pytest.raises(fileutils.FileException) as excinfo:
+                extractor = self.stream_unzip('test.zip', 'stream', 1,
+                                              match_dir=True)
+                extractor.close()
+            assert excinfo.value.args[0] == (
+                'Path in zipfile is not in required subdir')
+            assert not os.path.exists(os.path.join('stream', 'other'))
+
     def test_zip(self):
         self.mox.StubOutClassWithMocks(zipfile, 'ZipFile')
         self.mox.StubOutWithMock(os, 'walk')
         self.mox.StubOutWithMock(os.path, 'isfile')
+        self.mox.StubOutWithMock(os.path, 'getsize')
 
         # files = ['test', 'test/a', 'test/b', 'test/b/c']
         os.walk('test').AndReturn([
             ('test', ['b'], ['a']), ('test/b', [], ['c'])])
         os.path.isfile('test').AndReturn(False)
+        os.path.getsize('test/a').AndReturn(1)
+        os.path.getsize('test/b/c').AndReturn(2)
 
         mockzip = zipfile.ZipFile(
             'path/to/test.zip', 'w', zipfile.ZIP_DEFLATED)
@@ -214,6 +1128,104 @@ class TestFileutils(object):
         fileutils.zip('path/to/test.zip', ['test'], 'test')
         self.mox.VerifyAll()
 
+    def test_zip_parallel_unsupported(self, tmpdir, monkeypatch):
+        # Falls back to the serial writer if the ZipFile internals change
+        monkeypatch.setattr(fileutils, 'ZIP_INTERNALS',
+                            fileutils.ZIP_INTERNALS + ('_removed',))
+
+        def fail(*args):
+            raise AssertionError('_zip_parallel must not be called')
+
+        monkeypatch.setattr(fileutils, '_zip_parallel', fail)
+        tmpdir.ensure('logs/a.log').write_binary(b'a' * 1000)
+        with tmpdir.as_cwd():
+            fileutils.zip('parallel.zip', ['logs'], 'logs', 4)
+            with zipfile.ZipFile('parallel.zip') as z:
+                assert z.testzip() is None
+                assert z.read('a.log') == b'a' * 1000
+
+    @pytest.mark.parametrize('filename,level,valid', [
+        ('logs.zip', 0, True), ('logs.zip', 9, True), ('logs.zip', 10, False),
+        ('logs.tar.gz', 9, True), ('logs.tar.xz', 12, False),
+        ('logs.tar.zst', 22, True), ('logs.tar.zst', 0, False),
+    ])
+    def test_check_archive_level(self, filename, level, valid):
+        if valid:
+            fileutils.check_archive_level(filename, level)
+        else:
+            with pytest.raises(ValueError):
+                fileutils.check_archive_level(filename, level)
+
+    @pytest.mark.parametrize('level', [None, 1, 9])
+    def test_zip_parallel(self, tmpdir, level):
+        files = {
+            'logs/empty.log': b'',
+            'logs/small.log': b'small',
+            'logs/large.log': b''.join(
+                b'%d INFO Repeated log message\n' % n
+                for n in range(200000)),
+            'logs/sub/random.bin': os.urandom(3000000),
+        }
+        for name, content in files.items():
+            tmpdir.ensure(name).write_binary(content)
+        with tmpdir.as_cwd():
+            fileutils.zip('serial.zip', ['logs'], 'logs', level=level)
+            fileutils.zip('parallel.zip', ['logs'], 'logs', 4, level)
+            with zipfile.ZipFile('parallel.zip') as z:
+                assert z.testzip() is None
+                assert sorted(z.namelist()) == sorted(
+                    n[5:] for n in files)
+                for name, content in files.items():
+                    assert z.read(name[5:]) == content
+            # Chunks are compressed with the preceding data as a dictionary
+            assert os.path.getsize('parallel.zip') < 1.01 * os.path.getsize(
+                'serial.zip')
+            try:
+                assert subprocess.call(['unzip', '-tq', 'parallel.zip']) == 0
+            except OSError:
+                # unzip isn't installed
+                pass
+
+    @pytest.mark.parametrize('ext', [
+        '.tar', '.tar.gz', '.tgz', '.tar.xz', '.tar.zst', '.zip'])
+    def test_archive(self, tmpdir, ext):
+        if ext == '.tar.zst' and not fileutils.zstandard:
+            pytest.skip('zstandard is not installed')
+        files = {
+            'logs/empty.log': b'',
+            'logs/Blitz-0.log': b'INFO message\n' * 100000,
+            'logs/sub/x.bin': os.urandom(1500000),
+        }
+        for name, content in files.items():
+            tmpdir.ensure(name).write_binary(content)
+        os.chmod(str(tmpdir.join('logs/sub/x.bin')), 0o600)
+        with tmpdir.as_cwd():
+            fileutils.archive('logs' + ext, 'logs', 'logs', level=1)
+            if ext == '.zip':
+                assert zipfile.is_zipfile('logs.zip')
+                return
+            if ext == '.tar.zst':
+                dctx = fileutils.zstandard.ZstdDecompressor()
+                with open('logs.tar.zst', 'rb') as f:
+                    with open('logs.tar', 'wb') as out:
+                        dctx.copy_stream(f, out)
+                ext = '.tar'
+            assert os.path.getsize('logs' + ext) % 512 == 0 or (
+                ext != '.tar')
+            with tarfile.open('logs' + ext) as t:
+                assert sorted(t.getnames()) == sorted(n[5:] for n in files)
+                for name, content in files.items():
+                    assert t.extractfile(name[5:]).read() == content
+                assert t.getmember('sub/x.bin').mode == 0o600
+
+    def test_archive_zstd_missing(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(fileutils, 'zstandard', None)
+        tmpdir.ensure('logs/a.log')
+        with tmpdir.as_cwd():
+            with pytest.raises(fileutils.FileException):
+                fileutils.archive('logs.tar.zst', 'logs', 'logs')
+            assert not os.path.exists('logs.tar.zst')
+
     @pytest.mark.parametrize('exists', [True, False])
     @pytest.mark.parametrize('remote', [True, False])
     @pytest.mark.parametrize('overwrite', ['error', 'backup', 'keep'])
@@ -244,7 +1256,8 @@ class TestFileutils(object):
 
         if (remote and exists and overwrite == 'backup') or (
                 remote and not exists):
-            fileutils.download(p, expectedp, 0, **kwargs)
+            fileutils.download(p, expectedp, 0, connections=1, resume=False,
+                               **kwargs)
 
         if not remote or (remote and not exists) or (
                 remote and exists and overwrite != 'error'):
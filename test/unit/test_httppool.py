@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from builtins import object
+import pytest
+from mox3 import mox
+import http.client
+import logging
+import os
+import ssl
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from omego import fileutils
+from omego import httppool
+from omego.httppool import (
+    ConnectionPool,
+    KeepAliveHTTPSHandler,
+    ResumingHTTPSConnection,
+    pool,
+    ssl_context,
+)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.append(self.client_address)
+        body = b'x' * 100000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/drop':
+            # Close without telling the client
+            self.close_connection = True
+
+    def do_HEAD(self):
+        self.server.clients.append(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Length', '100000')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpPool(object):
+
+    def setup_method(self, method):
+        pool.clear()
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.clients = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def teardown_method(self, method):
+        pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        assert fileutils.read(self.url + '/a') == b'x' * 100000
+        r = fileutils.open_url(self.url + '/b', method='HEAD')
+        r.close()
+        assert fileutils.read(self.url + '/c') == b'x' * 100000
+        assert len(self.server.clients) == 3
+        assert len(set(self.server.clients)) == 1
+
+    def test_incomplete_not_reused(self):
+        r = fileutils.open_url(self.url + '/a')
+        r.read(10)
+        r.close()
+        fileutils.read(self.url + '/b')
+        assert len(set(self.server.clients)) == 2
+
+    def test_concurrent(self):
+        r1 = fileutils.open_url(self.url + '/a')
+        r2 = fileutils.open_url(self.url + '/b')
+        r1.read()
+        r2.read()
+        r1.close()
+        r2.close()
+        fileutils.read(self.url + '/c')
+        fileutils.read(self.url + '/d')
+        assert len(set(self.server.clients)) == 2
+
+    def test_stale_connection(self):
+        fileutils.read(self.url + '/drop')
+        assert fileutils.read(self.url + '/a') == b'x' * 100000
+        assert len(set(self.server.clients)) == 2
+
+    def test_download(self, tmpdir):
+        with tmpdir.as_cwd():
+            fileutils.download(self.url + '/file.dat')
+            fileutils.download(self.url + '/file.dat', 'file2.dat')
+            assert tmpdir.join('file2.dat').size() == 100000
+        assert len(set(self.server.clients)) == 1
+
+
+class MockConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(object):
+
+    @pytest.mark.parametrize('maxidle', [1, 2])
+    def test_put_get(self, maxidle):
+        p = ConnectionPool(maxidle)
+        c1 = MockConnection()
+        c2 = MockConnection()
+        p.put('a', c1)
+        p.put('a', c2)
+        assert c2.closed == (maxidle == 1)
+        assert p.get('b') is None
+        if maxidle == 2:
+            assert p.get('a') is c2
+        assert p.get('a') is c1
+        assert p.get('a') is None
+
+    def test_clear(self):
+        p = ConnectionPool()
+        c = MockConnection()
+        p.put('a', c)
+        p.clear()
+        assert c.closed
+        assert p.get('a') is None
+
+
+class TestSsl(object):
+
+    def setup_method(self, method):
+        self.mox = mox.Mox()
+
+    def teardown_method(self, method):
+        self.mox.UnsetStubs()
+        httppool._ssl_sessions.clear()
+
+    def test_ssl_context(self):
+        assert ssl_context() is ssl_context(True)
+        assert ssl_context(False) is ssl_context(False)
+        assert ssl_context(False) is not ssl_context(True)
+        assert ssl_context().verify_mode == ssl.CERT_REQUIRED
+        assert ssl_context(False).verify_mode == ssl.CERT_NONE
+        assert not ssl_context(False).check_hostname
+
+    @pytest.mark.parametrize('verify', [True, False])
+    def test_handler_context(self, verify):
+        h1 = KeepAliveHTTPSHandler(verify)
+        h2 = KeepAliveHTTPSHandler(verify)
+        assert h1._context is h2._context is ssl_context(verify)
+
+    def test_session_resumption(self):
+        class MockSocket(object):
+            def __init__(self, session, reused):
+                self.session = session
+                self.session_reused = reused
+
+        class MockContext(object):
+            check_hostname = True
+            verify_mode = ssl.CERT_REQUIRED
+            post_handshake_auth = None
+
+            def __init__(self):
+                self.sessions = []
+
+            def wrap_socket(self, sock, server_hostname, session):
+                assert server_hostname == 'example.org'
+                self.sessions.append(session)
+                return MockSocket('session1', session is not None)
+
+        context = MockContext()
+        self.mox.StubOutWithMock(http.client.HTTPConnection, 'connect')
+        for n in range(2):
+            http.client.HTTPConnection.connect(
+                mox.IsA(ResumingHTTPSConnection))
+        self.mox.ReplayAll()
+
+        c1 = ResumingHTTPSConnection('example.org', context=context)
+        c1.connect()
+        c2 = ResumingHTTPSConnection('example.org', context=context)
+        c2.connect()
+        assert context.sessions == [None, 'session1']
+        assert c2.sock.session_reused
+        self.mox.VerifyAll()
+
+    def test_tls_session_resumption(self, tmpdir, caplog, monkeypatch):
+        key = str(tmpdir.join('key.pem'))
+        cert = str(tmpdir.join('cert.pem'))
+        try:
+            subprocess.check_call([
+                'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                '-keyout', key, '-out', cert, '-days', '1',
+                '-subj', '/CN=localhost'], stderr=subprocess.STDOUT,
+                stdout=open(os.devnull, 'w'))
+        except (OSError, subprocess.CalledProcessError):
+            pytest.skip('openssl is required to create a certificate')
+
+        server = Server(('127.0.0.1', 0), Handler)
+        server.clients = []
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        monkeypatch.setenv('OMEGO_SSL_NO_VERIFY', '1')
+        caplog.set_level(logging.DEBUG, logger='omego.httppool')
+        try:
+            url = 'https://localhost:%d/close' % server.server_address[1]
+            for n in range(2):
+                assert fileutils.read(url) == b'x' * 100000
+        finally:
+            pool.clear()
+            server.shutdown()
+            server.server_close()
+        assert len(set(server.clients)) == 2
+        assert 'Resumed TLS session with localhost' in caplog.messages
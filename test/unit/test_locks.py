@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from builtins import object
+import json
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import time
+
+from omego import locks
+from omego.locks import FileLock
+
+
+class TestFileLock(object):
+
+    def write_lock(self, path, pid, age=0):
+        with open(path, 'w') as f:
+            json.dump({'host': FileLock(path).owner['host'], 'pid': pid}, f)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def test_lock(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        with FileLock(path) as lock:
+            assert not lock.waited
+            with open(path) as f:
+                assert json.load(f)['pid'] == os.getpid()
+        assert not os.path.exists(path)
+
+    def test_wait(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        order = []
+        first = FileLock(path)
+        first.acquire()
+
+        def wait():
+            with FileLock(path, poll=0.01) as lock:
+                order.append(lock.waited)
+
+        t = threading.Thread(target=wait)
+        t.start()
+        time.sleep(0.1)
+        order.append('released')
+        first.release()
+        t.join()
+        assert order == ['released', True]
+
+    def test_stale_pid(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        p = subprocess.Popen([sys.executable, '-c', ''])
+        p.wait()
+        self.write_lock(path, p.pid)
+        with FileLock(path):
+            pass
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_stale_age(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        # The owner appears to be running, but hasn't touched the lock
+        self.write_lock(path, os.getpid(), 120)
+        lock = FileLock(path, stale=60)
+        with open(path) as f:
+            content = f.read()
+        assert lock.is_stale(content, os.stat(path).st_mtime)
+        with lock:
+            assert not lock.waited
+
+    def test_not_stale(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        self.write_lock(path, os.getpid())
+        lock = FileLock(path)
+        with open(path) as f:
+            assert not lock.is_stale(f.read(), os.stat(path).st_mtime)
+
+    def test_release_taken(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        lock = FileLock(path)
+        lock.acquire()
+        # The lock was broken and taken by another process
+        self.write_lock(path, os.getpid() + 1)
+        with open(path) as f:
+            content = f.read()
+        lock.release()
+        with open(path) as f:
+            assert f.read() == content
+
+    def test_release_removed(self, tmpdir):
+        path = str(tmpdir.join('a.lock'))
+        lock = FileLock(path)
+        lock.acquire()
+        os.unlink(path)
+        lock.release()
+        assert not os.path.exists(path)
+
+
+class MockKernel32(object):
+
+    def __init__(self, processes):
+        # {pid: exit code}
+        self.processes = processes
+        self.closed = []
+
+    def OpenProcess(self, access, inherit, pid):
+        if pid in self.processes:
+            return pid
+        return 0
+
+    def GetLastError(self):
+        return 87
+
+    def GetExitCodeProcess(self, handle, code):
+        code._obj.value = self.processes[handle]
+        return 1
+
+    def CloseHandle(self, handle):
+        self.closed.append(handle)
+
+
+class TestPidAliveWindows(object):
+
+    @pytest.mark.parametrize('pid,alive', [(1, True), (2, False), (3, False)])
+    def test_pid_alive(self, monkeypatch, pid, alive):
+        kernel32 = MockKernel32({1: locks.STILL_ACTIVE, 2: 0})
+
+        class WinDLL(object):
+            pass
+
+        windll = WinDLL()
+        windll.kernel32 = kernel32
+        monkeypatch.setattr(locks.ctypes, 'windll', windll, raising=False)
+        monkeypatch.setattr(locks.os, 'name', 'nt')
+
+        def kill(pid, sig):
+            raise AssertionError('os.kill must not be called on Windows')
+
+        monkeypatch.setattr(locks.os, 'kill', kill)
+        assert locks._pid_alive(pid) is alive
+        assert kernel32.closed == ([pid] if pid in (1, 2) else [])
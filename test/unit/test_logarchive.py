@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+from builtins import object
+import pytest
+
+import json
+import os
+import time
+
+from omego import fileutils
+from omego.logarchive import (
+    MANIFEST,
+    archive_incremental,
+    restore,
+)
+
+
+class TestLogArchive(object):
+
+    def write(self, tmpdir, name, content, age=0):
+        f = tmpdir.ensure('var', 'log', name)
+        f.write(content)
+        t = time.time() - 1000 + age
+        os.utime(str(f), (t, t))
+
+    def archive(self, tmpdir, name):
+        with tmpdir.as_cwd():
+            return archive_incremental(
+                os.path.join('archives', name), os.path.join('var', 'log'),
+                'var')
+
+    def manifest(self, tmpdir):
+        with open(str(tmpdir.join('archives', MANIFEST))) as f:
+            return json.load(f)
+
+    @pytest.mark.parametrize('ext', ['.zip', '.tar.gz', '.tar.xz'])
+    def test_archive_incremental(self, tmpdir, ext):
+        tmpdir.ensure('archives', dir=True)
+        self.write(tmpdir, 'Blitz-0.log', 'blitz 1\n')
+        self.write(tmpdir, 'Blitz-0.log.1', 'rotated 1\n')
+        self.write(tmpdir, 'master.out', '')
+        assert self.archive(tmpdir, 'logs-1' + ext) == os.path.join(
+            'archives', 'logs-1' + ext)
+
+        # Unchanged
+        assert self.archive(tmpdir, 'logs-2' + ext) is None
+        assert not tmpdir.join('archives', 'logs-2' + ext).exists()
+
+        # Rotate and add a new file
+        tmpdir.join('var', 'log', 'Blitz-0.log.1').rename(
+            tmpdir.join('var', 'log', 'Blitz-0.log.2'))
+        tmpdir.join('var', 'log', 'Blitz-0.log').rename(
+            tmpdir.join('var', 'log', 'Blitz-0.log.1'))
+        self.write(tmpdir, 'Blitz-0.log', 'blitz 2\n', 10)
+        self.write(tmpdir, 'sub/new.log', 'new\n', 10)
+        assert self.archive(tmpdir, 'logs-3' + ext)
+
+        m = self.manifest(tmpdir)
+        assert m['archives'] == ['logs-1' + ext, 'logs-3' + ext]
+        files = m['files']
+        assert files['log/Blitz-0.log.2']['archive'] == 'logs-1' + ext
+        assert files['log/Blitz-0.log.2']['member'] == 'log/Blitz-0.log.1'
+        assert files['log/Blitz-0.log.1']['member'] == 'log/Blitz-0.log'
+        assert files['log/Blitz-0.log']['archive'] == 'logs-3' + ext
+        assert files['log/sub/new.log']['archive'] == 'logs-3' + ext
+
+        with tmpdir.as_cwd():
+            assert restore(os.path.join('archives', MANIFEST), 'restored') == 5
+        for name in ('Blitz-0.log', 'Blitz-0.log.1', 'Blitz-0.log.2',
+                     'master.out', 'sub/new.log'):
+            original = tmpdir.join('var', 'log', name)
+            restored = tmpdir.join('restored', 'log', name)
+            assert restored.read() == original.read()
+            assert restored.mtime() == original.mtime()
+
+    def test_archive_replaced(self, tmpdir):
+        tmpdir.ensure('archives', dir=True)
+        self.write(tmpdir, 'a.log', 'a')
+        self.archive(tmpdir, 'logs.zip')
+        self.write(tmpdir, 'b.log', 'b')
+        self.archive(tmpdir, 'logs.zip')
+        m = self.manifest(tmpdir)
+        assert m['archives'] == ['logs.zip']
+        assert sorted(m['files']) == ['log/a.log', 'log/b.log']
+        with tmpdir.as_cwd():
+            assert restore(os.path.join('archives', MANIFEST), 'restored') == 2
+
+    def test_restore_missing(self, tmpdir):
+        with pytest.raises(fileutils.FileException):
+            restore(str(tmpdir.join(MANIFEST)), str(tmpdir))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from builtins import object
+import pytest
+import socket
+import threading
+from urllib.error import URLError
+
+from omego import mirrors
+from omego.mirrors import parse_mirrors, probe, rank
+
+
+class MockClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class MockResponse(object):
+
+    def __init__(self, clock, delay):
+        self.clock = clock
+        self.delay = delay
+
+    def read(self, n):
+        self.clock.now += self.delay
+        return b'x' * n
+
+    def close(self):
+        pass
+
+
+class TestMirrors(object):
+
+    def test_parse_mirrors(self):
+        assert parse_mirrors(
+            'https://a.example.org/, https://b.example.org\n'
+            'https://c.example.org') == [
+            'https://a.example.org', 'https://b.example.org',
+            'https://c.example.org']
+
+    def test_probe(self, monkeypatch):
+        clock = MockClock()
+        requests = []
+
+        def open_url(url, headers, timeout):
+            requests.append((url, headers, timeout))
+            clock.now += 0.05
+            return MockResponse(clock, 0.5)
+
+        monkeypatch.setattr(mirrors, 'time', clock)
+        monkeypatch.setattr(mirrors.fileutils, 'open_url', open_url)
+        r = probe('https://a.example.org', 5)
+        assert requests == [('https://a.example.org/', {
+            'Range': 'bytes=0-65535'}, 5)]
+        assert r['url'] == 'https://a.example.org'
+        assert r['latency'] == pytest.approx(0.05)
+        assert r['throughput'] == pytest.approx(65536 / 0.5)
+
+    def test_probe_error(self, monkeypatch):
+        def open_url(url, headers, timeout):
+            raise URLError('Connection refused')
+
+        monkeypatch.setattr(mirrors.fileutils, 'open_url', open_url)
+        r = probe('https://a.example.org')
+        assert r['url'] == 'https://a.example.org'
+        assert 'Connection refused' in r['error']
+
+    @pytest.mark.parametrize('reply', [
+        # Not HTTP
+        b'SSH-2.0-OpenSSH_8\r\n',
+        # Binary data after a valid status line
+        b'HTTP/1.1 200 OK\r\n' + b'\x00' * 70000,
+    ])
+    def test_probe_garbage(self, reply):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+
+        def serve():
+            conn, addr = server.accept()
+            conn.recv(4096)
+            conn.sendall(reply)
+            conn.close()
+
+        t = threading.Thread(target=serve)
+        t.start()
+        url = 'http://127.0.0.1:%d' % server.getsockname()[1]
+        try:
+            r = probe(url, 5)
+        finally:
+            t.join()
+            server.close()
+        assert r['url'] == url
+        assert 'error' in r
+
+    @pytest.fixture
+    def probes(self, monkeypatch):
+        results = {
+            # Nearby but slow
+            'https://near.example.org': {
+                'latency': 0.01, 'throughput': 100 * 1024},
+            # Further away but fast
+            'https://far.example.org': {
+                'latency': 0.2, 'throughput': 10 * 1024 * 1024},
+            'https://down.example.org': {'error': 'Connection refused'},
+        }
+        probed = []
+
+        def mock_probe(url, timeout):
+            probed.append(url)
+            return dict(results[url], url=url)
+
+        monkeypatch.setattr(mirrors, 'probe', mock_probe)
+        return probed
+
+    def test_rank(self, probes):
+        urls = ['https://down.example.org', 'https://near.example.org',
+                'https://far.example.org']
+        assert rank(urls, cachedir=None) == [
+            'https://far.example.org', 'https://near.example.org',
+            'https://down.example.org']
+        assert sorted(probes) == sorted(urls)
+
+    def test_rank_concurrent(self, monkeypatch):
+        urls = ['https://%d.example.org' % n for n in range(3)]
+        # Fails if the probes are run one at a time
+        barrier = threading.Barrier(len(urls), timeout=5)
+
+        def mock_probe(url, timeout):
+            barrier.wait()
+            return {'url': url, 'latency': 0.1, 'throughput': 1024}
+
+        monkeypatch.setattr(mirrors, 'probe', mock_probe)
+        assert rank(urls, cachedir=None) == urls
+
+    def test_rank_single(self, probes):
+        assert rank(['https://down.example.org']) == [
+            'https://down.example.org']
+        assert probes == []
+
+    @pytest.mark.parametrize('ttl', [0, 3600])
+    def test_rank_cache(self, tmpdir, probes, ttl):
+        urls = ['https://near.example.org', 'https://far.example.org']
+        for n in range(2):
+            assert rank(urls, cachedir=str(tmpdir), ttl=ttl) == [
+                'https://far.example.org', 'https://near.example.org']
+        assert len(probes) == (4 if ttl == 0 else 2)
+
+    def test_rank_all_failed(self, tmpdir, probes):
+        urls = ['https://down.example.org', 'https://down.example.org']
+        for n in range(2):
+            assert rank(urls, cachedir=str(tmpdir)) == urls
+        # A ranking without a healthy mirror isn't cached
+        assert len(probes) == 4
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+from builtins import object
+import pytest
+
+import json
+import os
+
+from omego import progress
+from omego.progress import EventStream, Progress, format_bytes
+
+
+class MockTime(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class TestProgress(object):
+
+    @pytest.fixture(autouse=True)
+    def mock_time(self, monkeypatch):
+        self.clock = MockTime()
+        monkeypatch.setattr(progress, 'time', self.clock)
+
+    @pytest.fixture
+    def eventlog(self, tmpdir, monkeypatch):
+        filename = str(tmpdir.join('events.jsonl'))
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT)
+        monkeypatch.setattr(progress, 'events', EventStream(fd))
+
+        def read():
+            with open(filename) as f:
+                return [json.loads(line) for line in f]
+        yield read
+        os.close(fd)
+
+    def test_format_bytes(self):
+        assert format_bytes(10) == '10 bytes'
+        assert format_bytes(1536) == '1.5 KiB'
+        assert format_bytes(3 * 1024 ** 3) == '3.0 GiB'
+        assert format_bytes(2 * 1024 ** 4) == '2.0 TiB'
+
+    def test_rate_limited(self, capsys):
+        with Progress('download', 'test', 1000, 10) as p:
+            for n in range(1, 41):
+                # 25 bytes every 0.25s
+                self.clock.now += 0.25
+                p.update(n * 25)
+        out = capsys.readouterr().out.splitlines()
+        assert len(out) == 10
+        assert out[0] == (
+            '*          100 bytes/1000 bytes 100 bytes/s '
+            '(average 100 bytes/s) ETA 0:00:09')
+        assert out[-1] == (
+            '********** 1000 bytes/1000 bytes 100 bytes/s '
+            '(average 100 bytes/s) in 0:00:10')
+
+    def test_unknown_total(self, capsys):
+        with Progress('download', 'test', None, 10) as p:
+            for n in range(1, 9):
+                self.clock.now += 0.25
+                p.update(n * 256)
+        # Without a bar there's nothing to redraw except on a terminal
+        out = capsys.readouterr().out.splitlines()
+        assert out == [
+            '2.0 KiB 1.0 KiB/s (average 1.0 KiB/s) in 0:00:02']
+
+    def test_no_bar(self, capsys):
+        with Progress('unzip', 'test', 1000) as p:
+            self.clock.now += 2
+            p.add(1000)
+        assert capsys.readouterr().out == ''
+
+    def test_events(self, eventlog):
+        with Progress('download', 'http://example.org/a', 300, initial=100
+                      ) as p:
+            self.clock.now += 1
+            p.update(150)
+            self.clock.now += 1
+            p.update(300)
+        events = eventlog()
+        assert [e['event'] for e in events] == [
+            'start', 'progress', 'progress', 'done']
+        for e in events:
+            assert e['operation'] == 'download'
+            assert e['name'] == 'http://example.org/a'
+            assert e['total'] == 300
+        assert events[1]['current'] == 150
+        assert events[1]['rate'] == 50
+        assert events[1]['eta'] == 3
+        assert events[2]['rate'] == 150
+        assert events[2]['average'] == 100
+        assert events[2]['eta'] == 0
+        assert events[3]['elapsed'] == 2
+
+    def test_error(self, eventlog):
+        with pytest.raises(IOError):
+            with Progress('zip', 'test.zip', 100):
+                self.clock.now += 0.5
+                raise IOError('Disk full')
+        events = eventlog()
+        assert [e['event'] for e in events] == ['start', 'error']
+        assert events[1]['error'] == 'Disk full'
+        assert events[1]['elapsed'] == 0.5
+
+    def test_configure(self, monkeypatch):
+        monkeypatch.delenv('OMEGO_PROGRESS_FD', raising=False)
+        assert EventStream().f is None
+        monkeypatch.setenv('OMEGO_PROGRESS_FD', '1')
+        assert EventStream().f is not None
+        assert EventStream('invalid').f is None
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from builtins import object
+import os
+import pytest
+import threading
+import time
+
+from omego import scheduler as sched
+from omego.scheduler import (
+    DownloadScheduler,
+    PRIORITY_DEFAULT,
+    PRIORITY_SERVER,
+    SlotPool,
+    TokenBucket,
+    default_priority,
+)
+
+
+class MockClock(object):
+
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        self.sleeps = []
+        monkeypatch.setattr(sched.time, 'time', lambda: self.now)
+        monkeypatch.setattr(sched.time, 'sleep', self.sleep)
+
+    def sleep(self, t):
+        self.sleeps.append(t)
+        self.now += t
+
+
+class TestScheduler(object):
+
+    @pytest.mark.parametrize('filename,priority', [
+        ('OMERO.server-5.6.0-ice36.zip', PRIORITY_SERVER),
+        ('cache/tmp/0123-OMERO.server-5.6.0-ice36.zip', PRIORITY_SERVER),
+        ('OMERO.insight-5.6.0-win.zip', PRIORITY_DEFAULT),
+        ('OMERO.server-5.6.0-ice36.zip.sha256', PRIORITY_DEFAULT),
+    ])
+    def test_default_priority(self, filename, priority):
+        assert default_priority(filename) == priority
+
+    def test_token_bucket(self, monkeypatch):
+        clock = MockClock(monkeypatch)
+        b = TokenBucket(1000)
+        # The initial burst
+        b.consume(1000)
+        assert clock.sleeps == []
+        b.consume(500)
+        assert clock.sleeps == [0.5]
+        clock.now += 2
+        # Refilled to the maximum burst only
+        b.consume(1500)
+        assert clock.sleeps == [0.5, 0.5]
+
+    def test_configure(self, monkeypatch, tmpdir):
+        monkeypatch.setenv('OMEGO_MAX_DOWNLOADS', '2')
+        monkeypatch.setenv('OMEGO_DOWNLOAD_BANDWIDTH', '10')
+        monkeypatch.setenv('OMEGO_DOWNLOAD_SLOTS', str(tmpdir))
+        s = DownloadScheduler()
+        assert s.max_transfers == 0
+        assert s.bucket is None
+        s.configure()
+        assert s.max_transfers == 2
+        assert s.bucket.rate == 10240
+        assert s.slots.directory == str(tmpdir)
+        assert s.slots.slots == 2
+        s.configure(3, 0)
+        assert s.max_transfers == 3
+        assert s.bucket is None
+
+    def test_throughput(self, monkeypatch):
+        clock = MockClock(monkeypatch)
+        s = DownloadScheduler()
+        with s.transfer('http://example.org/a') as t:
+            t.update(1000)
+            clock.now += 4
+            t.update(1000)
+        assert t.throughput() == 500
+        assert s.completed == [t]
+
+    def test_priority(self, tmpdir):
+        s = DownloadScheduler(max_transfers=1, slotdir=str(tmpdir))
+        started = []
+        first = s.transfer('first')
+        first.__enter__()
+
+        def run(url, priority):
+            with s.transfer(url, priority):
+                started.append(url)
+
+        threads = []
+        for url, priority in [('client1', PRIORITY_DEFAULT),
+                              ('server', PRIORITY_SERVER),
+                              ('client2', PRIORITY_DEFAULT)]:
+            th = threading.Thread(target=run, args=(url, priority))
+            th.start()
+            threads.append(th)
+            # Wait for the transfer to be queued
+            while len(s.waiting) < len(threads):
+                time.sleep(0.01)
+
+        assert started == []
+        first.__exit__(None, None, None)
+        for th in threads:
+            th.join()
+        assert started == ['server', 'client1', 'client2']
+
+    def test_start_all_ready(self, tmpdir):
+        s = DownloadScheduler(max_transfers=1, slotdir=str(tmpdir))
+        first = s.transfer('first')
+        first.__enter__()
+        started = []
+
+        def run(url):
+            with s.transfer(url):
+                started.append(url)
+                while len(started) < 2:
+                    time.sleep(0.01)
+
+        threads = [threading.Thread(target=run, args=(url,))
+                   for url in ('a', 'b')]
+        for th in threads:
+            th.start()
+        while len(s.waiting) < 2:
+            time.sleep(0.01)
+        # Both waiting transfers can start without the first finishing
+        s.configure(3, 0, str(tmpdir))
+        for th in threads:
+            th.join()
+        assert sorted(started) == ['a', 'b']
+        first.__exit__(None, None, None)
+
+    def test_shared_slots(self, tmpdir):
+        # Schedulers in different processes sharing a slot directory
+        s1 = DownloadScheduler(max_transfers=1, slotdir=str(tmpdir))
+        s2 = DownloadScheduler(max_transfers=1, slotdir=str(tmpdir))
+        s2.slots.poll = 0.01
+        order = []
+        first = s1.transfer('first')
+        first.__enter__()
+
+        def run():
+            with s2.transfer('second'):
+                order.append('second')
+
+        th = threading.Thread(target=run)
+        th.start()
+        time.sleep(0.1)
+        order.append('released')
+        first.__exit__(None, None, None)
+        th.join()
+        assert order == ['released', 'second']
+        assert os.listdir(str(tmpdir)) == []
+
+    def test_shared_slots_priority(self, tmpdir):
+        pool = SlotPool(str(tmpdir), 1, poll=0.01)
+        # A server download is waiting in another process
+        waiter = str(tmpdir.join('waiting-0-otherhost-1-0'))
+        open(waiter, 'w').close()
+        acquired = []
+
+        def run():
+            acquired.append(pool.acquire(PRIORITY_DEFAULT))
+
+        th = threading.Thread(target=run)
+        th.start()
+        time.sleep(0.1)
+        assert acquired == []
+        os.unlink(waiter)
+        th.join()
+        acquired[0].release()
+
+    def test_shared_slots_abandoned_waiter(self, tmpdir):
+        pool = SlotPool(str(tmpdir), 1, stale=60)
+        waiter = str(tmpdir.join('waiting-0-otherhost-1-0'))
+        open(waiter, 'w').close()
+        mtime = time.time() - 120
+        os.utime(waiter, (mtime, mtime))
+        slot = pool.acquire(PRIORITY_DEFAULT)
+        slot.release()
+        assert os.listdir(str(tmpdir)) == []
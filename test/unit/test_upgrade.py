@@ -24,12 +24,15 @@ from builtins import object
 import pytest
 from mox3 import mox
 
+import argparse
 import copy
+import errno
 import os
 import shutil
 
 from omego.external import External
 from omego import fileutils
+from omego import logarchive
 import omego.upgrade
 from omego.upgrade import UnixInstall
 
@@ -43,6 +46,7 @@ class TestUpgrade(object):
             self.no_web = False
             self.delete_old = False
             self.keep_old_zip = False
+            self.dedup_old = None
             self.verbose = False
             for k, v in args.items():
                 setattr(self, k, v)
@@ -92,22 +96,39 @@ class TestUpgrade(object):
 
         args = self.Args({'server': None, 'skipunzip': False,
                           'overwrite': 'error', 'unzipdir': None,
-                          'httpuser': 'user', 'httppassword': 'password'})
+                          'httpuser': 'user', 'httppassword': 'password',
+                          'download_connections': 1,
+                          'download_resume': False,
+                          'cachedir': None, 'cachesize': 4096,
+                          'checksum': None, 'stream_unzip': False,
+                          'unzip_workers': 1, 'max_downloads': None,
+                          'download_bandwidth': None,
+                          'download_slots': None,
+                          'unzip_store_size': 4096,
+                          'unzip_incremental': False, 'unzip_store': False,
+                          'unzip_include': None, 'unzip_exclude': None,
+                          'delta_from': None,
+                          'write_block_index': False, 'progress_fd': None})
         if server == 'local':
             args.server = 'local-server-dir'
             fileutils.get_as_local_path(
                 args.server, args.overwrite, progress=0,
-                httpuser=args.httpuser, httppassword=args.httppassword
-                ).AndReturn(('directory', 'local-server-dir'))
+                httpuser=args.httpuser, httppassword=args.httppassword,
+                connections=1, resume=False, cachedir=None, cachesize=4096,
+                checksums=None, stream_unzip=None, delta_from=None,
+                write_index=False).AndReturn(('directory', 'local-server-dir'))
             expected = 'local-server-dir'
         elif server == 'remote':
             args.server = 'http://example.org/remote/server.zip'
             fileutils.get_as_local_path(
                 args.server, args.overwrite, progress=0,
-                httpuser=args.httpuser, httppassword=args.httppassword
-                ).AndReturn(('file', 'server.zip'))
+                httpuser=args.httpuser, httppassword=args.httppassword,
+                connections=1, resume=False, cachedir=None, cachesize=4096,
+                checksums=None, stream_unzip=None, delta_from=None,
+                write_index=False).AndReturn(('file', 'server.zip'))
             fileutils.unzip(
-                'server.zip', match_dir=True, destdir=args.unzipdir
+                'server.zip', match_dir=True, destdir=args.unzipdir,
+                workers=1, incremental=False, manifest=True
                 ).AndReturn('server')
             expected = 'server'
         else:
@@ -145,15 +166,23 @@ class TestUpgrade(object):
         pass
 
     @pytest.mark.parametrize('archivelogs', [None, 'archivelogs.zip'])
-    def test_archive_logs(self, archivelogs):
-        self.mox.StubOutWithMock(fileutils, 'zip')
+    @pytest.mark.parametrize('incremental', [True, False])
+    def test_archive_logs(self, archivelogs, incremental):
+        self.mox.StubOutWithMock(fileutils, 'archive')
+        self.mox.StubOutWithMock(logarchive, 'archive_incremental')
         if archivelogs:
-            fileutils.zip(
-                archivelogs, os.path.join('sym', 'var', 'log'),
-                os.path.join('sym', 'var'))
+            if incremental:
+                f = logarchive.archive_incremental
+            else:
+                f = fileutils.archive
+            f(archivelogs, os.path.join('sym', 'var', 'log'),
+              os.path.join('sym', 'var'), workers=4, level=None)
         self.mox.ReplayAll()
 
-        args = self.Args({'archivelogs': archivelogs})
+        args = self.Args({'archivelogs': archivelogs,
+                          'archivelogs_workers': 4,
+                          'archivelogs_level': None,
+                          'archivelogs_incremental': incremental})
         upgrade = self.PartialMockUnixInstall(args, None)
         upgrade.archive_logs()
         self.mox.VerifyAll()
@@ -197,9 +226,12 @@ class TestUpgrade(object):
 
     @pytest.mark.parametrize('deleteold', [True, False])
     @pytest.mark.parametrize('keepoldzip', [True, False])
-    def test_directories(self, deleteold, keepoldzip):
+    @pytest.mark.parametrize('dedup', [None, 'hardlink'])
+    @pytest.mark.parametrize('manifest', [True, False])
+    def test_directories(self, deleteold, keepoldzip, dedup, manifest):
         args = self.Args({'delete_old': deleteold,
-                          'keep_old_zip': keepoldzip})
+                          'keep_old_zip': keepoldzip,
+                          'dedup_old': dedup})
         upgrade = self.PartialMockUnixInstall(args, None)
         upgrade.dir = 'new'
 
@@ -208,11 +240,19 @@ class TestUpgrade(object):
         self.mox.StubOutWithMock(shutil, 'rmtree')
         self.mox.StubOutWithMock(os, 'unlink')
         self.mox.StubOutWithMock(upgrade, 'symlink')
+        self.mox.StubOutWithMock(fileutils, 'dedup_tree')
 
         os.path.samefile('new', 'sym').AndReturn(False)
         os.readlink('sym').AndReturn('old/')
+        if dedup and not deleteold:
+            fileutils.dedup_tree('new', 'old', dedup, subdirs=['lib'])
         if deleteold:
             shutil.rmtree('old')
+            if manifest:
+                os.unlink('old.manifest.json')
+            else:
+                os.unlink('old.manifest.json').AndRaise(
+                    OSError(errno.ENOENT, 'No such file or directory'))
         if not keepoldzip:
             os.unlink('old.zip')
         os.unlink('sym')
@@ -232,3 +272,30 @@ class TestUpgrade(object):
 
         upgrade.symlink('new', 'sym')
         self.mox.VerifyAll()
+
+
+class TestInstallCommand(object):
+
+    def parser(self):
+        parser = argparse.ArgumentParser()
+        sub_parsers = parser.add_subparsers()
+        omego.upgrade.InstallCommand(sub_parsers)
+        return parser
+
+    @pytest.mark.parametrize('level', ['x', '-1', '23'])
+    def test_archivelogs_level_invalid(self, level):
+        with pytest.raises(SystemExit):
+            self.parser().parse_args(['install', '--archivelogs-level', level])
+
+    def test_archivelogs_level_format(self, monkeypatch):
+        def install(*args):
+            raise AssertionError('Install must not be started')
+
+        monkeypatch.setattr(omego.upgrade, 'UnixInstall', install)
+        monkeypatch.setattr(omego.upgrade, 'WindowsInstall', install)
+        args = self.parser().parse_args([
+            'install', '--archivelogs', 'logs.zip',
+            '--archivelogs-level', '12'])
+        assert args.archivelogs_level == 12
+        with pytest.raises(SystemExit):
+            args.func(args)
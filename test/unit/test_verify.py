@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright (C) 2026 University of Dundee & Open Microscopy Environment
+# All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+from builtins import object
+import pytest
+
+import json
+import os
+import zipfile
+
+from omego import fileutils
+from omego.verify import verify_tree
+
+
+class TestVerify(object):
+
+    def create_tree(self, tmpdir, **kwargs):
+        with zipfile.ZipFile(str(tmpdir.join('test.zip')), 'w') as z:
+            for name, perms in (('a.txt', 0o644), ('b/c.sh', 0o755),
+                                ('b/d.txt', 0o600)):
+                info = zipfile.ZipInfo('test/' + name)
+                info.external_attr = (0o100000 | perms) << 16
+                z.writestr(info, name * 1000)
+        with tmpdir.as_cwd():
+            return fileutils.unzip('test.zip', True, 'out', manifest=True,
+                                   **kwargs)
+
+    @pytest.mark.parametrize('kwargs', [
+        {}, {'workers': 2}, {'exclude': ['*/d.txt']}])
+    def test_manifest(self, tmpdir, kwargs):
+        tree = self.create_tree(tmpdir, **kwargs)
+        with tmpdir.as_cwd():
+            with open(fileutils.extract_manifest_path(tree)) as f:
+                manifest = json.load(f)
+            assert manifest['archive'] == 'test.zip'
+            files = manifest['files']
+            expected = ['a.txt', os.path.join('b', 'c.sh')]
+            if not kwargs.get('exclude'):
+                expected.append(os.path.join('b', 'd.txt'))
+            assert sorted(files) == expected
+            assert files['a.txt']['size'] == 5000
+            assert files['a.txt']['mode'] == 0o644
+            assert all(not v for v in verify_tree(tree).values())
+
+    @pytest.mark.parametrize('fast', [True, False])
+    def test_drift(self, tmpdir, fast):
+        tree = str(tmpdir.join(self.create_tree(tmpdir)))
+        a = os.path.join(tree, 'a.txt')
+        st = os.stat(a)
+        with open(a, 'r+b') as f:
+            f.write(b'x')
+        # A change that can only be detected by hashing the file
+        os.utime(a, (st.st_atime, st.st_mtime))
+        with open(os.path.join(tree, 'b', 'c.sh'), 'ab') as f:
+            f.write(b'x')
+        os.unlink(os.path.join(tree, 'b', 'd.txt'))
+        with open(os.path.join(tree, 'b', 'd.txt'), 'w') as f:
+            f.write('b/d.txt' * 1000)
+        os.chmod(os.path.join(tree, 'b', 'd.txt'), 0o644)
+        with open(os.path.join(tree, 'e'), 'w') as f:
+            f.write('e')
+
+        drift = verify_tree(tree, fast=fast)
+        modified = [os.path.join('b', 'c.sh')]
+        if not fast:
+            modified.insert(0, 'a.txt')
+        assert drift == {
+            'missing': [],
+            'modified': modified,
+            'mode': [os.path.join('b', 'd.txt')],
+            'added': ['e'],
+        }
+
+    def test_missing(self, tmpdir):
+        tree = str(tmpdir.join(self.create_tree(tmpdir)))
+        os.unlink(os.path.join(tree, 'a.txt'))
+        assert verify_tree(tree, workers=1)['missing'] == ['a.txt']
+
+    def test_invalid_manifest(self, tmpdir):
+        tree = str(tmpdir.join(self.create_tree(tmpdir)))
+        with open(fileutils.extract_manifest_path(tree), 'w') as f:
+            f.write('[]')
+        with pytest.raises(fileutils.FileException):
+            verify_tree(tree)